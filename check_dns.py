@@ -9,49 +9,113 @@
 #   command_line                   $USER1$/check_dns.py $ARG1$ $ARG2$
 # }
 
+# Perfdata: the response time of every authoritive nameserver address is
+# reported as 'ns_<address>' together with the number of answering, timed-out
+# and disagreeing nameservers. Use --trace FILE to also dump the timings as
+# JSON.
+
+# Startup: dns.message, dns.query and dns.resolver take most of the start
+# time of this plugin, they are only imported once the arguments are valid.
+
+# Profiling: NAEMON_PROFILE=cpu,mem profiles the check, see plugin_profile.
+
+from __future__ import print_function
+
+import json
 import optparse
 import os
+import plugin_profile
 import dns
 import dns.exception
 import dns.rdatatype
-import dns.resolver
 import sys
+import time
 
-def dnscheck(domain, rdtype, expected=None, timeout=None):
+def dnscheck(domain, rdtype, expected=None, timeout=None, trace=None,
+        port=53):
     """
     Queries the rdtype records of the domain its authoritive nameservers and
     checks whether the received answers are all equal to the expected answer.
+    The response time of every nameserver address is reported as perfdata.
     """
     if timeout is None: timeout = 10.0
-    answers = resolve_authoritive(domain, rdtype, timeout)
+    stats = {}
+    answers = resolve_authoritive(domain, rdtype, timeout, stats, port)
+    if trace:
+        write_trace(trace, domain, rdtype, stats)
+    timeouts = [nsaddress for nsaddress, stat in sorted(stats.items())
+                if stat['status'] == 'timeout']
+    if stats and len(timeouts) == len(stats):
+        raise dns.exception.Timeout()
+    perf = perfdata(stats, answers, rdtype)
     if not answers:
-        print "%s %s no answer" % (domain, dns.rdatatype.to_text(rdtype))
+        print("%s %s no answer | %s" % (domain,
+                dns.rdatatype.to_text(rdtype), perf))
         return False
     elif not equal_answers(answers):
-        print "%s %s different answers, expected %s" % (domain,
-                dns.rdatatype.to_text(rdtype), list_to_text(expected))
-        for nameserver, answer in answers.items():
+        print("%s %s different answers, expected %s | %s" % (domain,
+                dns.rdatatype.to_text(rdtype), list_to_text(expected), perf))
+        for nameserver, answer in sorted(answers.items()):
             rrs = get_rrs(answer, rdtype)
-            print " nameserver %s: %s %s" % (nameserver,
-                    dns.rdatatype.to_text(rdtype), list_to_text(rrs))
+            print(" nameserver %s: %s %s" % (nameserver,
+                    dns.rdatatype.to_text(rdtype), list_to_text(rrs)))
+        print_timeouts(timeouts)
         return False
-    answer = answers.values()[0]
+    answer = list(answers.values())[0]
     rrs = get_rrs(answer, rdtype)
     if set(rrs) == set(expected):
-        print "%s %s %s" % (domain, dns.rdatatype.to_text(rdtype),
-                list_to_text(rrs))
-        return True
+        print("%s %s %s | %s" % (domain, dns.rdatatype.to_text(rdtype),
+                list_to_text(rrs), perf))
+        print_timeouts(timeouts)
+        return not timeouts
     else:
-        print "%s %s %s, expected %s" % (domain,
+        print("%s %s %s, expected %s | %s" % (domain,
                 dns.rdatatype.to_text(rdtype), list_to_text(rrs),
-                list_to_text(expected))
+                list_to_text(expected), perf))
+        print_timeouts(timeouts)
         return False
 
 
+def print_timeouts(timeouts):
+    for nsaddress in timeouts:
+        print(" nameserver %s: timeout" % nsaddress)
+
 def equal_answers(answers):
-    rrsets = answers.values()
+    rrsets = list(answers.values())
     return all(rrset == rrsets[0] for rrset in rrsets[1:]) if rrsets else True
 
+def count_disagreeing(answers, rdtype):
+    """
+    Returns the number of nameservers whose answer differs from the answer
+    given by the majority of the nameservers.
+    """
+    votes = {}
+    for answer in answers.values():
+        rrs = tuple(sorted(get_rrs(answer, rdtype)))
+        votes[rrs] = votes.get(rrs, 0) + 1
+    return len(answers) - max(votes.values()) if votes else 0
+
+def perfdata(stats, answers, rdtype):
+    timeouts = len([stat for stat in stats.values()
+                    if stat['status'] == 'timeout'])
+    perf = ["answering=%d;;;0" % len(answers),
+            "timeouts=%d;;;0" % timeouts,
+            "disagreeing=%d;;;0" % count_disagreeing(answers, rdtype)]
+    for nsaddress, stat in sorted(stats.items()):
+        if stat['status'] != 'timeout':
+            perf.append("'ns_%s'=%.6fs;;;0" % (nsaddress, stat['time']))
+    return ' '.join(perf)
+
+def write_trace(filename, domain, rdtype, stats):
+    trace = {
+        'timestamp': time.time(),
+        'domain': domain,
+        'type': dns.rdatatype.to_text(rdtype),
+        'nameservers': stats,
+    }
+    with open(filename, 'w') as f:
+        json.dump(trace, f, indent=2, sort_keys=True)
+
 def get_rrs(answer, rdtype):
     rrsets = [rrset for rrset in answer if rrset.rdtype == rdtype]
     if rrsets:
@@ -64,7 +128,17 @@ def get_rrs(answer, rdtype):
 def list_to_text(l):
     return ','.join(l) if l else 'EMPTY'
 
-def resolve_authoritive(domain, rdtype, timeout):
+def resolve_authoritive(domain, rdtype, timeout, stats=None, port=53):
+    """
+    Queries every address of every authoritive nameserver of the domain.
+    When a stats dict is passed the status and response time in seconds of
+    every nameserver address are stored in it.
+    """
+    import dns.message
+    import dns.query
+    import dns.resolver
+
+    if stats is None: stats = {}
     nameservers = find_nameservers(domain)
     nsanswers = {}
     for nameserver in nameservers:
@@ -72,16 +146,27 @@ def resolve_authoritive(domain, rdtype, timeout):
         nsaddresses = [answer.address for answer in answers]
         for nsaddress in nsaddresses:
             request = dns.message.make_query(domain, rdtype)
+            stat = stats[nsaddress] = {'nameserver': str(nameserver)}
+            start = time.time()
             try:
-                response = dns.query.udp(request, nsaddress, timeout)
+                response = dns.query.udp(request, nsaddress, timeout, port)
+            except dns.exception.Timeout:
+                stat.update(status='timeout', time=time.time() - start)
+                continue
             except dns.resolver.NXDOMAIN:
+                stat.update(status='nxdomain', time=time.time() - start)
                 continue
+            stat['time'] = time.time() - start
             if response is None:
+                stat['status'] = 'noresponse'
                 continue
+            stat['status'] = 'answer'
             nsanswers[nsaddress] = response.answer
     return nsanswers
 
 def find_nameservers(domain):
+    import dns.resolver
+
     while domain:
         try:
             answers = dns.resolver.query(domain, dns.rdatatype.NS)
@@ -98,7 +183,7 @@ def find_nameservers(domain):
 
 def error(argv, msg):
     basename = os.path.basename(argv[0])
-    print >>sys.stderr, "%s: error: %s" % (basename, msg)
+    print("%s: error: %s" % (basename, msg), file=sys.stderr)
     sys.exit(2)
 
 class ExampleHelpFormatter(optparse.IndentedHelpFormatter):
@@ -124,6 +209,13 @@ Examples:
             type="float", default=10.0,
             help="set the DNS query timeout to TIMEOUT seconds",
             metavar="TIMEOUT")
+    parser.add_option("--trace", dest="trace",
+            help="write the nameserver response times as JSON to FILE",
+            metavar="FILE")
+    parser.add_option("-p", "--port", dest="port",
+            type="int", default=53,
+            help="query the authoritive nameservers on PORT",
+            metavar="PORT")
 
     # Parse command line
     (options, args) = parser.parse_args()
@@ -143,11 +235,14 @@ Examples:
     expected = exparg.split(',') if exparg else ()
 
     # Execute DNS check
+    import dns.resolver
     try:
-        return 0 if dnscheck(domain, rdtype, expected, options.timeout) else 1
-    except dns.resolver.NoAnswer, e:
-        error(argv, e.message)
-    except dns.exception.Timeout, e:
+        with plugin_profile.Profile('check_dns'):
+            return 0 if dnscheck(domain, rdtype, expected, options.timeout,
+                    options.trace, options.port) else 1
+    except dns.resolver.NoAnswer as e:
+        error(argv, str(e))
+    except dns.exception.Timeout:
         error(argv, "timeout waiting for nameserver")
 
 if __name__ == "__main__":
@@ -0,0 +1,112 @@
+#!/usr/bin/python3
+
+"""Offline throughput benchmark for check_dns.
+
+Runs check_dns.dnscheck against in-process stub nameservers (see dns_stub)
+and reports the number of checks per second and the time spent in
+resolve_authoritive, both for checks run one after another and for checks
+run concurrently from a pool of threads.
+
+Example:
+  ./check_dns_bench.py -n 200 --nameservers 3 --latency 0.005 --threads 8
+"""
+
+import argparse
+import contextlib
+import io
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dns.exception
+import dns.rdatatype
+
+import check_dns
+from dns_stub import StubNetwork
+
+DOMAIN = 'example.nl'
+RECORDS = {('www.example.nl', 'A'): ['192.0.2.1']}
+
+
+class ResolveTimer(object):
+    """Wraps check_dns.resolve_authoritive and sums the time spent in it."""
+
+    def __init__(self):
+        self.total = 0.0
+        self.calls = 0
+        self._lock = threading.Lock()
+        self._resolve = check_dns.resolve_authoritive
+
+    def __enter__(self):
+        check_dns.resolve_authoritive = self
+        return self
+
+    def __exit__(self, *exc_info):
+        check_dns.resolve_authoritive = self._resolve
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return self._resolve(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.total += time.perf_counter() - start
+                self.calls += 1
+
+
+def run(checks, threads, port, timeout):
+    def one(_):
+        # With --loss every nameserver can time out, a failed check
+        try:
+            return check_dns.dnscheck('www.example.nl', dns.rdatatype.A,
+                                      ['192.0.2.1'], timeout, port=port)
+        except dns.exception.Timeout:
+            return False
+
+    # redirect_stdout swaps sys.stdout globally, so not per thread
+    with ResolveTimer() as timer, contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        if threads > 1:
+            with ThreadPoolExecutor(threads) as pool:
+                results = list(pool.map(one, range(checks)))
+        else:
+            results = [one(i) for i in range(checks)]
+        elapsed = time.perf_counter() - start
+    return elapsed, timer, results.count(False)
+
+
+def report(name, checks, elapsed, timer, failed):
+    print('%-12s %6d checks %8.3f s %9.1f checks/s  '
+          'resolve_authoritive %7.3f ms/call  %d failed' % (
+              name, checks, elapsed, checks / elapsed,
+              1000 * timer.total / max(timer.calls, 1), failed))
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argp.add_argument('-n', '--checks', type=int, default=100,
+                      help='number of checks per run (default: 100)')
+    argp.add_argument('--nameservers', type=int, default=2,
+                      help='number of stub nameservers (default: 2)')
+    argp.add_argument('--latency', type=float, default=0.0,
+                      help='latency in seconds per stub nameserver answer')
+    argp.add_argument('--loss', type=float, default=0.0,
+                      help='fraction of queries dropped by every nameserver')
+    argp.add_argument('--threads', type=int, default=4,
+                      help='threads for the concurrent run (default: 4)')
+    argp.add_argument('-t', '--timeout', type=float, default=1.0,
+                      help='DNS query timeout in seconds (default: 1.0)')
+    args = argp.parse_args()
+
+    nameservers = [{'latency': args.latency, 'loss': args.loss, 'seed': i}
+                   for i in range(args.nameservers)]
+    with StubNetwork(DOMAIN, RECORDS, nameservers) as port:
+        report('sequential', args.checks,
+               *run(args.checks, 1, port, args.timeout))
+        if args.threads > 1:
+            report('threads=%d' % args.threads, args.checks,
+                   *run(args.checks, args.threads, port, args.timeout))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+
+import dns.exception
+import dns.rdatatype
+
+import check_dns
+import check_dns_bench
+from dns_stub import StubNetwork
+
+RECORDS = {
+    ('www.example.nl', 'A'): ['192.0.2.1'],
+    ('fr.example.nl', 'CNAME'): ['www.example.nl.'],
+    ('example.nl', 'MX'): ['10 mx1.example.nl.', '20 mx2.example.nl.'],
+}
+
+
+def dnscheck(*args, **kwargs):
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        result = check_dns.dnscheck(*args, **kwargs)
+    return result, output.getvalue()
+
+
+class TestDnsCheck(unittest.TestCase):
+    def test_consistent(self):
+        with StubNetwork('example.nl', RECORDS, [{}, {}]) as port:
+            result, output = dnscheck('www.example.nl', dns.rdatatype.A,
+                                      ['192.0.2.1'], 1.0, port=port)
+        self.assertTrue(result)
+        self.assertIn('www.example.nl A 192.0.2.1 |', output)
+        self.assertIn('answering=2;;;0 timeouts=0;;;0 disagreeing=0;;;0', output)
+        self.assertIn("'ns_127.0.0.2'=", output)
+        self.assertIn("'ns_127.0.0.3'=", output)
+
+    def test_cname_mx(self):
+        with StubNetwork('example.nl', RECORDS) as port:
+            self.assertTrue(dnscheck('fr.example.nl', dns.rdatatype.CNAME,
+                                     ['www.example.nl'], 1.0, port=port)[0])
+            self.assertTrue(dnscheck('example.nl', dns.rdatatype.MX,
+                                     ['10:mx1.example.nl', '20:mx2.example.nl'],
+                                     1.0, port=port)[0])
+
+    def test_unexpected(self):
+        with StubNetwork('example.nl', RECORDS) as port:
+            result, output = dnscheck('www.example.nl', dns.rdatatype.A,
+                                      ['192.0.2.2'], 1.0, port=port)
+        self.assertFalse(result)
+        self.assertIn('expected 192.0.2.2', output)
+
+    def test_disagreeing(self):
+        nameservers = [{}, {}, {'records': {('www.example.nl', 'A'): ['192.0.2.9']}}]
+        with StubNetwork('example.nl', RECORDS, nameservers) as port:
+            result, output = dnscheck('www.example.nl', dns.rdatatype.A,
+                                      ['192.0.2.1'], 1.0, port=port)
+        self.assertFalse(result)
+        self.assertIn('different answers', output)
+        self.assertIn('disagreeing=1;;;0', output)
+        self.assertIn(' nameserver 127.0.0.4: A 192.0.2.9', output)
+
+    def test_timeout(self):
+        with StubNetwork('example.nl', RECORDS, [{}, {'loss': 1.0}]) as port:
+            result, output = dnscheck('www.example.nl', dns.rdatatype.A,
+                                      ['192.0.2.1'], 0.2, port=port)
+        self.assertFalse(result)
+        self.assertIn('answering=1;;;0 timeouts=1;;;0', output)
+        self.assertIn(' nameserver 127.0.0.3: timeout', output)
+        self.assertNotIn("'ns_127.0.0.3'", output)
+
+    def test_all_timeout(self):
+        with StubNetwork('example.nl', RECORDS, [{'loss': 1.0}]) as port:
+            self.assertRaises(dns.exception.Timeout, dnscheck, 'www.example.nl',
+                              dns.rdatatype.A, ['192.0.2.1'], 0.1, port=port)
+
+    def test_latency_trace(self):
+        fd, trace = tempfile.mkstemp(suffix='.json')
+        os.close(fd)
+        self.addCleanup(os.remove, trace)
+        with StubNetwork('example.nl', RECORDS, [{}, {'latency': 0.1}]) as port:
+            self.assertTrue(dnscheck('www.example.nl', dns.rdatatype.A,
+                                     ['192.0.2.1'], 1.0, trace, port)[0])
+        with open(trace) as f:
+            data = json.load(f)
+        self.assertEqual(data['domain'], 'www.example.nl')
+        self.assertEqual(data['type'], 'A')
+        nameservers = data['nameservers']
+        self.assertEqual(nameservers['127.0.0.3']['status'], 'answer')
+        self.assertEqual(nameservers['127.0.0.3']['nameserver'], 'ns2.example.nl.')
+        self.assertGreaterEqual(nameservers['127.0.0.3']['time'], 0.1)
+        self.assertLess(nameservers['127.0.0.2']['time'], 0.1)
+
+
+class TestDnsBench(unittest.TestCase):
+    def test_loss(self):
+        with StubNetwork('example.nl', RECORDS, [{'loss': 1.0}]) as port:
+            elapsed, timer, failed = check_dns_bench.run(4, 2, port, 0.05)
+        self.assertEqual(failed, 4)
+        self.assertEqual(timer.calls, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,91 +1,256 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 # 28/12/2019 Changed to https and changed www.icanhazip.com to icanhazip.com
 # Import the necessary python modules.
 # 01/03/2021 Changed user agent from default Python-urllib/2.7 to
 # Mozilla/4.0 etc.. because of 403
+# Ported to Python 3, queries several providers for IPv4 and IPv6
+# concurrently and answers with the first address enough providers agree on.
 
-from urllib2 import Request, urlopen, URLError, HTTPError
 from sys import argv, exit
 from os import path
 import argparse
+import fcntl
+import ipaddress
+import json
+import os
+import plugin_profile
+import queue
+import result_cache
+import tempfile
+import threading
+import time
 
-user_agent = 'Mozilla/4.0 (compatible; MSIE 5.5; Windows NT)'
 user_agent = 'Mozilla/5.0'
-# Setup our help output.
-
-parser = argparse.ArgumentParser(
-     description='Checks the external IP dynamically assigned by the service provider.',
-     epilog="""This plugin is designed for those who need to know the IP address dynamically
-            assigned to them by their service provider. The plugin checks with an external
-            website to find out what public IP address has been assigned by the service
-            providers. The results of the check are stored in a temp file located in /tmp.
+
+PROVIDERS = {
+    4: ['https://ipv4.icanhazip.com', 'https://api.ipify.org', 'https://v4.ident.me'],
+    6: ['https://ipv6.icanhazip.com', 'https://api6.ipify.org', 'https://v6.ident.me'],
+}
+STATE_FILE = '/tmp/.external_ip_address.json'
+
+STATES = ['OK', 'WARNING', 'CRITICAL', 'UNKNOWN']
+
+
+def fetch(url, timeout):
+    """Return the address text of one echo provider."""
+    # Imported here, it is as slow to load as the rest of the plugin
+    from urllib.request import Request, urlopen
+
+    request = Request(url)
+    request.add_header('User-agent', user_agent)
+    with urlopen(request, timeout=timeout) as response:
+        return response.read().decode('ascii', 'replace').strip()
+
+
+def _worker(family, url, timeout, results):
+    try:
+        address = ipaddress.ip_address(fetch(url, timeout))
+        if address.version != family:
+            raise ValueError('got IPv%d address %s' % (address.version, address))
+        results.put((family, url, str(address), None))
+    except Exception as e:
+        results.put((family, url, None, e))
+
+
+def lookup(providers, timeout, quorum=2):
+    """Query all providers concurrently under one overall deadline.
+
+    A family is answered as soon as quorum providers agree on its address,
+    or when all its providers finished with the address most of them gave.
+    Providers still running when every family is answered or the deadline
+    passes are abandoned; they run in daemon threads.
+
+    :param providers: dict mapping family 4 or 6 to a list of URLs
+    :param timeout: overall deadline in seconds
+    :param quorum: number of providers that must agree on an address
+    :returns: ({family: address}, {family: [error text, ...]})
+    """
+    deadline = time.monotonic() + timeout
+    results = queue.Queue()
+    pending = {}
+    for family, urls in providers.items():
+        pending[family] = len(urls)
+        for url in urls:
+            thread = threading.Thread(target=_worker,
+                                      args=(family, url, timeout, results))
+            thread.daemon = True
+            thread.start()
+
+    votes = dict((family, {}) for family in providers)
+    errors = dict((family, []) for family in providers)
+    answers = {}
+    while any(pending[family] and family not in answers for family in providers):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            family, url, address, error = results.get(timeout=remaining)
+        except queue.Empty:
+            break
+        pending[family] -= 1
+        if family in answers:
+            continue
+        if address is None:
+            errors[family].append('%s: %s' % (url, error))
+        else:
+            votes[family][address] = votes[family].get(address, 0) + 1
+            if votes[family][address] >= min(quorum, len(providers[family])):
+                answers[family] = address
+                continue
+        if not pending[family] and votes[family]:
+            answers[family] = max(votes[family], key=votes[family].get)
+
+    for family in providers:
+        if family not in answers:
+            if votes[family]:
+                answers[family] = max(votes[family], key=votes[family].get)
+            elif pending[family]:
+                errors[family].append('no answer within %s seconds' % timeout)
+    return answers, errors
+
+
+def cached_lookup(cache, providers, timeout, quorum=2):
+    """lookup() through a result_cache.ResultCache.
+
+    Only an answer for every family is kept, a provider failure is retried
+    by the next run.
+    """
+    answers, errors = cache.get(lambda: lookup(providers, timeout, quorum),
+                                keep=lambda value: len(value[0]) == len(providers))
+    # JSON turned the families into strings
+    return (dict((int(family), address) for family, address in answers.items()),
+            dict((int(family), texts) for family, texts in errors.items()))
+
+
+def read_state(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def read_legacy_state(filename):
+    """Return the addresses stored by the Python 2 plugin next to filename.
+
+    It kept one address per file, <base>_ipv4, <base>_ipv6 and, for either
+    family, <base> itself.
+    """
+    base = path.splitext(filename)[0]
+    state = {}
+    for legacy in (base, base + '_ipv4', base + '_ipv6'):
+        try:
+            with open(legacy) as f:
+                address = ipaddress.ip_address(f.read().strip())
+        except (IOError, OSError, ValueError):
+            continue
+        state['ipv%d' % address.version] = str(address)
+    return state
+
+
+def write_state(filename, state):
+    """Write the addresses of all families in one atomic replace."""
+    fd, tmpname = tempfile.mkstemp(dir=path.dirname(path.abspath(filename)),
+                                   prefix='.external_ip-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(state, f, sort_keys=True)
+    os.replace(tmpname, filename)
+
+
+def check(families, providers, state_file, timeout, quorum, required, cache=None):
+    """Return (exit code, output line) for the requested families.
+
+    :param cache: result_cache.ResultCache for the provider answers
+    """
+    providers = dict((family, providers[family]) for family in families)
+    if cache is None:
+        answers, errors = lookup(providers, timeout, quorum)
+    else:
+        answers, errors = cached_lookup(cache, providers, timeout, quorum)
+    missing = [family for family in families if family not in answers]
+    if not answers or (required and missing):
+        detail = '; '.join('IPv%d %s' % (family, ', '.join(errors[family]))
+                           for family in missing)
+        return 3, 'UNKNOWN - Failed to reach providers: %s' % detail
+
+    # Runs for other families share the state file
+    with open(state_file + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        stored = read_state(state_file)
+        previous = stored or read_legacy_state(state_file)
+        state = dict(previous)
+        code = 0
+        texts = []
+        for family in sorted(answers):
+            key = 'ipv%d' % family
+            address = answers[family]
+            state[key] = address
+            if key not in previous:
+                code = max(code, 1)
+                texts.append('New File Created with IP Address: %s' % address)
+            elif previous[key] != address:
+                code = max(code, 2)
+                texts.append('IP Address has changed to %s' % address)
+            else:
+                texts.append('Current IP Address: %s' % address)
+        if state != stored:
+            write_state(state_file, state)
+    return code, '%s - %s' % (STATES[code], ', '.join(texts))
+
+
+def main():
+    # Setup our help output.
+    parser = argparse.ArgumentParser(
+        description='Checks the external IP dynamically assigned by the service provider.',
+        epilog="""This plugin is designed for those who need to know the IP address dynamically
+            assigned to them by their service provider. The plugin checks with several external
+            websites at once to find out what public IP address has been assigned by the service
+            providers. The results of the check are stored in a state file located in /tmp.
             If the results from the current IP check differs from the pervious results an
             alert is triggered. These alerts contain the current IP address assigned.
 
-            This plugin doesn't require any arguments, and will work for both IPv4 and IPv6
-            address assignments. However if you have a dual stack network connection you can
-            test either the IPv4 address or the IPv6 independently using the appropriate flag
-            It is recommended that the max check attempts be set to 1 for this service check.
+            This plugin doesn't require any arguments, and will report both the IPv4 and IPv6
+            address assignments that can be found. However if you have a dual stack network
+            connection you can require either the IPv4 address or the IPv6 using the appropriate
+            flag. It is recommended that the max check attempts be set to 1 for this service check.
             Failure to do will result is missed alerts when a new IP address is assigned.
             """.format(path.basename(argv[0])))
 
-# Setup our mutally exclusive group and add the option for IPv4 or IPv6.
-group = parser.add_mutually_exclusive_group()
-group.add_argument('-4', '--ipv4', action="store_true", help='Connect using IPv4')
-group.add_argument('-6', '--ipv6', action="store_true", help='Connect using IPv6')
-
-# Store our command line arugments in a dictionary.
-
-args = vars(parser.parse_args())
-
-# Set the appropriate URL and temp file depending on the command line
-# argument supplied. Default to an URL that will work against IPv4 or IPv6.
-
-if args['ipv4'] is True:
-    url = Request("https://ipv4.icanhazip.com")
-    ipAddressFile = '/tmp/.external_ip_address_ipv4'
-elif args['ipv6'] is True:
-    url = Request("https://ipv6.icanhazip.com")
-    ipAddressFile = '/tmp/.external_ip_address_ipv6'
-else:
-    url = Request("https://icanhazip.com")
-    ipAddressFile = '/tmp/.external_ip_address'
-
-url.add_header('User-agent', user_agent)
-
-# Try and connect to the URL, and report any failures
-try:
-    external_ip_address = urlopen(url).read().rstrip('\n')
-except HTTPError as e:
-    print "Server couldn\'t fulfill the request. Error code: %s" % e.code
-    exit(3)
-except URLError as e:
-    print "Failed to reach server. Reason: %s" % e.reason
-    exit(3)
-
-# Try and open our temp file to compare the pervious IP address. If no temp file
-# exist create a new one and send a warning about missing file. Compare results
-# and warn when IP address changes.
-
-try:
-    open(ipAddressFile)
-except IOError:
-    f = open(ipAddressFile,'w')
-    f.write(external_ip_address)
-    f.close
-    print "WARNING - New File Created with IP Address: %s" % external_ip_address
-    exit(1)
-else:
-    f = open(ipAddressFile,'r+')
-    current_ip_address = f.read()
-    f.close
-    if current_ip_address == external_ip_address:
-         print "OK - Current IP Address: %s" % external_ip_address
-         exit(0)
+    # Setup our mutally exclusive group and add the option for IPv4 or IPv6.
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('-4', '--ipv4', action="store_true", help='Only check and require IPv4')
+    group.add_argument('-6', '--ipv6', action="store_true", help='Only check and require IPv6')
+    parser.add_argument('-t', '--timeout', type=float, default=10,
+                        help='overall deadline in seconds (default: 10)')
+    parser.add_argument('-q', '--quorum', type=int, default=2,
+                        help='number of providers that must agree (default: 2)')
+    parser.add_argument('--provider4', action='append', metavar='URL',
+                        help='IPv4 echo provider URL, may be repeated')
+    parser.add_argument('--provider6', action='append', metavar='URL',
+                        help='IPv6 echo provider URL, may be repeated')
+    parser.add_argument('-f', '--state-file', default=STATE_FILE,
+                        help='file with the previous addresses (default: %(default)s)')
+    plugin_profile.add_arguments(parser)
+    result_cache.add_arguments(parser)
+    args = parser.parse_args()
+
+    providers = {4: args.provider4 or PROVIDERS[4],
+                 6: args.provider6 or PROVIDERS[6]}
+    if args.ipv4:
+        families = [4]
+    elif args.ipv6:
+        families = [6]
     else:
-         f = open(ipAddressFile,'w')
-         f.write(external_ip_address)
-         f.close()
-         print "CRITICAL - IP Address has changed to %s" % external_ip_address
-         exit(2)
+        families = [4, 6]
+
+    with plugin_profile.Profile('check_external_ip', args.profile, args.profile_dir):
+        code, output = check(families, providers, args.state_file, args.timeout,
+                             args.quorum, args.ipv4 or args.ipv6,
+                             result_cache.from_arguments('check_external_ip', args))
+    print(output)
+    return code
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+import fcntl
+import http.server
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import check_external_ip
+import result_cache
+
+
+class EchoHandler(http.server.BaseHTTPRequestHandler):
+    """Local stand-in for an address echo provider like icanhazip."""
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        if self.server.status != 200:
+            self.send_error(self.server.status)
+            return
+        body = (self.server.address + '\n').encode('ascii')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestExternalIp(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tmpdir, 'external_ip.json')
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def provider(self, address, delay=0, status=200):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), EchoHandler)
+        server.address = address
+        server.delay = delay
+        server.status = status
+        server.daemon_threads = True
+        server.block_on_close = False
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return 'http://127.0.0.1:%d/' % server.server_port
+
+    def test_quorum_before_slow_provider(self):
+        providers = {4: [self.provider('192.0.2.1'), self.provider('192.0.2.1'),
+                         self.provider('192.0.2.9', delay=2)]}
+        start = time.monotonic()
+        answers, errors = check_external_ip.lookup(providers, 5)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(answers, {4: '192.0.2.1'})
+
+    def test_failing_providers(self):
+        providers = {4: [self.provider('192.0.2.1', status=403), self.provider('garbage'),
+                         self.provider('2001:db8::1'), self.provider('192.0.2.1')],
+                     6: [self.provider('2001:db8::1'), self.provider('2001:db8::1')]}
+        answers, errors = check_external_ip.lookup(providers, 5)
+        self.assertEqual(answers, {4: '192.0.2.1', 6: '2001:db8::1'})
+        self.assertEqual(len(errors[4]), 3)
+
+    def test_deadline(self):
+        providers = {4: [self.provider('192.0.2.1', delay=2)],
+                     6: [self.provider('2001:db8::1')]}
+        start = time.monotonic()
+        answers, errors = check_external_ip.lookup(providers, 0.5)
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(answers, {6: '2001:db8::1'})
+        self.assertEqual(errors[4], ['no answer within 0.5 seconds'])
+
+    def test_state(self):
+        providers = {4: [self.provider('192.0.2.1')], 6: [self.provider('2001:db8::1')]}
+        code, output = check_external_ip.check([4, 6], providers, self.state_file, 5, 2, False)
+        self.assertEqual(code, 1)
+        self.assertTrue(output.startswith('WARNING - New File Created'))
+        with open(self.state_file) as f:
+            self.assertEqual(json.load(f), {'ipv4': '192.0.2.1', 'ipv6': '2001:db8::1'})
+
+        code, output = check_external_ip.check([4, 6], providers, self.state_file, 5, 2, False)
+        self.assertEqual((code, output), (0, 'OK - Current IP Address: 192.0.2.1, '
+                                             'Current IP Address: 2001:db8::1'))
+
+        providers[4] = [self.provider('192.0.2.2')]
+        code, output = check_external_ip.check([4], providers, self.state_file, 5, 2, True)
+        self.assertEqual((code, output), (2, 'CRITICAL - IP Address has changed to 192.0.2.2'))
+        with open(self.state_file) as f:
+            self.assertEqual(json.load(f), {'ipv4': '192.0.2.2', 'ipv6': '2001:db8::1'})
+
+    def test_legacy_state(self):
+        # Files of the Python 2 plugin for external_ip.json
+        with open(os.path.join(self.tmpdir, 'external_ip'), 'w') as f:
+            f.write('192.0.2.9\n')
+        with open(os.path.join(self.tmpdir, 'external_ip_ipv4'), 'w') as f:
+            f.write('192.0.2.1\n')
+        with open(os.path.join(self.tmpdir, 'external_ip_ipv6'), 'w') as f:
+            f.write('2001:db8::1')
+        providers = {4: [self.provider('192.0.2.1')], 6: [self.provider('2001:db8::2')]}
+        code, output = check_external_ip.check([4, 6], providers, self.state_file, 5, 2, False)
+        self.assertEqual((code, output), (2, 'CRITICAL - Current IP Address: 192.0.2.1, '
+                                             'IP Address has changed to 2001:db8::2'))
+        with open(self.state_file) as f:
+            self.assertEqual(json.load(f), {'ipv4': '192.0.2.1', 'ipv6': '2001:db8::2'})
+
+    def test_state_lock(self):
+        providers = {4: [self.provider('192.0.2.1')]}
+        results = []
+        with open(self.state_file + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            thread = threading.Thread(target=lambda: results.append(check_external_ip.check(
+                [4], providers, self.state_file, 5, 2, True)))
+            thread.start()
+            thread.join(0.5)
+            self.assertTrue(thread.is_alive())
+            # Stored by a run for another family meanwhile
+            check_external_ip.write_state(self.state_file, {'ipv4': '192.0.2.1',
+                                                            'ipv6': '2001:db8::1'})
+        thread.join(5)
+        self.assertEqual(results, [(0, 'OK - Current IP Address: 192.0.2.1')])
+        with open(self.state_file) as f:
+            self.assertEqual(json.load(f), {'ipv4': '192.0.2.1', 'ipv6': '2001:db8::1'})
+
+    def test_required_family_missing(self):
+        providers = {4: [self.provider('192.0.2.1')], 6: [self.provider('x', status=500)]}
+        code, output = check_external_ip.check([4, 6], providers, self.state_file, 5, 2, False)
+        self.assertEqual(code, 1)
+        code, output = check_external_ip.check([6], providers, self.state_file, 5, 2, True)
+        self.assertEqual(code, 3)
+        self.assertTrue(output.startswith('UNKNOWN - Failed to reach providers: IPv6'))
+
+    def test_result_cache(self):
+        providers = {4: [self.provider('192.0.2.1')]}
+        cache = result_cache.ResultCache('check_external_ip', 'ipv4', 60, self.tmpdir)
+        check_external_ip.check([4], providers, self.state_file, 5, 2, True, cache)
+        # Within the ttl the providers are not asked again
+        self.servers[0].address = '192.0.2.2'
+        code, output = check_external_ip.check([4], providers, self.state_file, 5, 2, True, cache)
+        self.assertEqual((code, output), (0, 'OK - Current IP Address: 192.0.2.1'))
+
+        # A failed lookup is not kept
+        providers = {6: [self.provider('x', status=500)]}
+        cache = result_cache.ResultCache('check_external_ip', 'ipv6', 60, self.tmpdir)
+        self.assertEqual(check_external_ip.check([6], providers, self.state_file, 5, 2, True,
+                                                 cache)[0], 3)
+        self.servers[1].status = 200
+        self.servers[1].address = '2001:db8::1'
+        self.assertEqual(check_external_ip.check([6], providers, self.state_file, 5, 2, True,
+                                                 cache)[0], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
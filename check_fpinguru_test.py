@@ -0,0 +1,97 @@
+#!/usr/bin/python3
+
+import importlib.machinery
+import importlib.util
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+import fping_shard
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# check_fpinguru has no .py extension
+_loader = importlib.machinery.SourceFileLoader('check_fpinguru',
+                                               os.path.join(HERE, 'check_fpinguru'))
+_spec = importlib.util.spec_from_loader('check_fpinguru', _loader)
+check_fpinguru = importlib.util.module_from_spec(_spec)
+_loader.exec_module(check_fpinguru)
+
+# fping -C output on stderr, one line per host
+FPING_OUTPUT = '''\
+host1.bocuse.nl (10.20.11.1)  : 1.10 1.20 1.30 1.40 1.50 1.60 1.70 1.80 1.90 2.00
+host2.bocuse.nl (10.20.11.2)  : 150.00 160.00 170.00 180.00 190.00 150.00 160.00 170.00 180.00 190.00
+host3.bocuse.nl (10.20.11.3)  : - - - - - - - - - -
+'''
+
+
+class TestRttLossLogging(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fping = os.path.join(self.tmpdir, 'fping')
+        with open(self.fping, 'w') as f:
+            f.write('#!/bin/sh\ncat >&2 <<EOF\n%sEOF\n' % FPING_OUTPUT)
+        os.chmod(self.fping, stat.S_IRWXU)
+        self.saved = check_fpinguru.FPING, list(logging.root.handlers), logging.root.level
+        check_fpinguru.FPING = self.fping
+        self.log_file = os.path.join(self.tmpdir, 'check_rttloss.log')
+
+    def tearDown(self):
+        check_fpinguru.FPING, handlers, level = self.saved
+        logging.root.handlers[:] = handlers
+        logging.root.setLevel(level)
+        shutil.rmtree(self.tmpdir)
+
+    def run_tests(self, verbosity, workers=None):
+        listener = check_fpinguru.configure_logging(verbosity, self.log_file, 1024 * 1024, 2)
+        resource = check_fpinguru.RttLoss(100, 1, ['host1.bocuse.nl', 'host2.bocuse.nl',
+                                                   'host3.bocuse.nl'], None, 'targetip', 'test',
+                                          workers)
+        resource.do_rtt_loss_tests()
+        listener.stop()
+        with open(self.log_file) as f:
+            return resource, f.read()
+
+    def test_summary(self):
+        resource, logged = self.run_tests(1)
+        self.assertEqual((resource.rtt_hosts, resource.loss_hosts), (1, 1))
+        self.assertEqual(len(logged.splitlines()), 2)
+        self.assertIn('Run summary: hosts=3 results=3 responding=2 rtt_problems=1 '
+                      'loss_problems=1 median_rtt=85.78 max_median_rtt=170.0', logged)
+
+    def test_hosts_at_debug(self):
+        resource, logged = self.run_tests(2)
+        self.assertIn('host2.bocuse.nl (10.20.11.2): min 150.00 avg 170.00 max 190.00 '
+                      'median 170.00 jitter 13.33 loss 0%', logged)
+        self.assertIn('host3.bocuse.nl (10.20.11.3): no responses', logged)
+
+    def test_workers(self):
+        local, logged = self.run_tests(0)
+        address = os.path.join(self.tmpdir, 'worker.sock')
+        server = fping_shard.make_server(address, self.fping)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            sharded, logged = self.run_tests(1, [address])
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(sharded.status, local.status)
+        self.assertEqual(sharded.problem_targets, {'host2.bocuse.nl', 'host3.bocuse.nl'})
+        self.assertIn('workers=1', logged)
+
+    def test_rotation(self):
+        listener = check_fpinguru.configure_logging(0, self.log_file, 1024, 2)
+        for record in range(6):
+            check_fpinguru.log.warning('%s', 'x' * 600)
+        listener.stop()
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['check_rttloss.log', 'check_rttloss.log.1', 'check_rttloss.log.2',
+                          'fping'])
+
+
+if __name__ == '__main__':
+    unittest.main()
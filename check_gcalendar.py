@@ -9,13 +9,27 @@
 # DEPENDANCIES:
 #  pip install --upgrade google-api-python-client
 
+# CACHING:
+#  The API discovery document and the access token are kept in --cache-file,
+#  so a run with a valid cached token only makes the events().list call.
+
+# STARTUP:
+#  The Google API client libraries take most of the start time, they are
+#  imported in the functions that use them, so --help and argument errors
+#  return without loading them.
+
 from datetime import datetime, timedelta
-from apiclient.discovery import build
-from google.oauth2 import service_account
 import argparse
+import calendar
+import json
 import nagiosplugin
 import logging
+import os
+import plugin_profile
 import re
+import result_cache
+import tempfile
+import time
 
 _log = logging.getLogger('nagiosplugin')
 
@@ -27,6 +41,14 @@ _log = logging.getLogger('nagiosplugin')
 # SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
 SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
 
+SECRETS = '/etc/naemon/secrets/gsecrets.json'
+CACHE_FILE = '/usr/local/naemon/var/check_gcalendar_cache.json'
+# Refresh the access token when it expires within TOKEN_MARGIN seconds
+TOKEN_MARGIN = 300
+CALENDAR_ID = 'paulboot@gmail.com'
+# Events synced with --sync are kept for KEEP_DAYS days
+KEEP_DAYS = 62
+
 TIMEZONE = 'Europe/Amsterdam'
 EVENTSTART = '2020-06-18T08:00:00'
 EVENTEND = '2020-06-18T08:30:00'
@@ -49,10 +71,16 @@ class Calendar(nagiosplugin.Resource):
 
     """
 
-    def __init__(self, gcalendar):
+    def __init__(self, gcalendar, days=None, sync=False, cache_file=CACHE_FILE):
         self.gcalendar = gcalendar
+        self.days = days
+        self.sync = sync
+        self.cache_file = cache_file
 
     def probe(self):
+        if self.days:
+            return self._probedays()
+
         eventsum = self._eventsum()
         if eventsum.startswith("Vrij"):
             eventhours = 0
@@ -68,7 +96,7 @@ class Calendar(nagiosplugin.Resource):
         now_start_rfc = now.strftime("%Y-%m-%dT08:00:00+01:00")
         now_end_rfc = now.strftime("%Y-%m-%dT08:30:00+01:00")
 
-        events = self.gcalendar.events().list(calendarId='paulboot@gmail.com',
+        events = self.gcalendar.events().list(calendarId=CALENDAR_ID,
                                               timeMin=now_start_rfc,
                                               timeMax=now_end_rfc,
                                               maxResults=10,
@@ -77,12 +105,122 @@ class Calendar(nagiosplugin.Resource):
 
         return self._eventgetsummary(events, now_start_rfc, now_end_rfc)
 
+    def _daywindows(self):
+        """Return (day, start_rfc, end_rfc) from yesterday back self.days days."""
+        windows = []
+        for days in range(self.days, 0, -1):
+            day = datetime.utcnow() - timedelta(days=days)
+            windows.append((day.strftime("%Y-%m-%d"),
+                            day.strftime("%Y-%m-%dT08:00:00+01:00"),
+                            day.strftime("%Y-%m-%dT08:30:00+01:00")))
+        return windows
+
+    def _eventsrange(self, start_rfc, end_rfc):
+        """All events between start_rfc and end_rfc, following nextPageToken."""
+        items = []
+        request = self.gcalendar.events().list(calendarId=CALENDAR_ID,
+                                               timeMin=start_rfc,
+                                               timeMax=end_rfc,
+                                               maxResults=250,
+                                               singleEvents=True,
+                                               orderBy='startTime')
+        while request is not None:
+            events = request.execute()
+            items.extend(events.get('items', []))
+            request = self.gcalendar.events().list_next(request, events)
+        return {'items': items}
+
+    def _eventssync(self):
+        """All kept events, brought up to date with the stored sync token.
+
+        The first run, or a run after the token expired (HTTP 410), does a
+        full sync of the last KEEP_DAYS days; later runs only fetch the
+        changes since the last run. Events older than KEEP_DAYS days are
+        dropped on every run.
+        """
+        from googleapiclient.errors import HttpError
+
+        keep = datetime.utcnow() - timedelta(days=KEEP_DAYS)
+        cache = load_cache(self.cache_file)
+        store = cache.get('sync', {})
+        events = store.get('events', {}) if store.get('token') else {}
+        token = store.get('token')
+        while True:
+            try:
+                pagetoken = None
+                changes = []
+                while True:
+                    kwargs = {'calendarId': CALENDAR_ID, 'singleEvents': True,
+                              'maxResults': 250}
+                    if token:
+                        kwargs['syncToken'] = token
+                    else:
+                        # Not allowed together with a sync token
+                        kwargs['timeMin'] = keep.strftime("%Y-%m-%dT00:00:00Z")
+                    if pagetoken:
+                        kwargs['pageToken'] = pagetoken
+                    page = self.gcalendar.events().list(**kwargs).execute()
+                    changes.extend(page.get('items', []))
+                    pagetoken = page.get('nextPageToken')
+                    if not pagetoken:
+                        break
+                break
+            except HttpError as e:
+                if e.resp.status != 410 or not token:
+                    raise
+                _log.info('Sync token expired, doing a full sync')
+                token = None
+                events = {}
+        _log.info('Synced %d changed events', len(changes))
+
+        for event in changes:
+            if event.get('status') == 'cancelled':
+                events.pop(event['id'], None)
+            else:
+                events[event['id']] = {'summary': event.get('summary', ''),
+                                       'start': event['start'],
+                                       'end': event['end']}
+        keepday = keep.strftime("%Y-%m-%d")
+        events = dict((eventid, event) for eventid, event in events.items()
+                      if _eventstart(event)[:10] >= keepday)
+
+        # Reload, build_calendar may have updated the cache meanwhile
+        cache = load_cache(self.cache_file)
+        cache['sync'] = {'token': page.get('nextSyncToken'), 'events': events}
+        save_cache(self.cache_file, cache)
+        return {'items': sorted(events.values(), key=_eventstart)}
+
+    def _probedays(self):
+        """Metrics for every day in the range plus the total hours."""
+        windows = self._daywindows()
+        if self.sync:
+            events = self._eventssync()
+        else:
+            events = self._eventsrange(windows[0][1], windows[-1][2])
+
+        metrics = []
+        totalhours = 0
+        for day, start_rfc, end_rfc in windows:
+            eventsum = self._eventgetsummary(events, start_rfc, end_rfc)
+            if eventsum.startswith("Vrij"):
+                eventhours = 0
+            else:
+                eventhours = self._eventgethours(eventsum)
+            totalhours += eventhours
+            metrics.append(nagiosplugin.Metric('calendar_' + day, eventsum,
+                                               context='calendar'))
+            metrics.append(nagiosplugin.Metric('hour_' + day, eventhours,
+                                               min=0, max=24, context='hour'))
+        metrics.append(nagiosplugin.Metric('total', totalhours, min=0))
+        return metrics
+
     def _eventgetsummary(self, events, now_start_rfc, now_end_rfc):
         eventsum = ''
         for event in events['items']:
             _log.debug(event)
-            if (event['start']['dateTime'] == now_start_rfc and
-                    event['end']['dateTime'] == now_end_rfc):
+            # All-day events only have a start and end date
+            if (event['start'].get('dateTime') == now_start_rfc and
+                    event['end'].get('dateTime') == now_end_rfc):
                 if (event['summary'].startswith("Uren: ") or
                         event['summary'].startswith("Vrij")):
                     _log.info("Found summary: " + event['summary'])
@@ -107,7 +245,7 @@ class Calendar(nagiosplugin.Resource):
 
             hourall, kmall = m.groups()
             for custhour in hourall.split():
-                m = re.match(r'([A-Z]{1,2})(\d{1,2})\?{0,1}', custhour)
+                m = re.match(r'([A-Z]{1,2})(\d{1,2})\?{0,1}$', custhour)
                 if not m:
                     raise ValueError('Invalid hour sequence in re.match')
                 hours += int(m.group(2))
@@ -115,6 +253,102 @@ class Calendar(nagiosplugin.Resource):
         return hours
 
 
+def _eventstart(event):
+    """Start of event as RFC 3339 string, the date of an all-day event."""
+    start = event.get('start', {})
+    return start.get('dateTime') or start.get('date', '')
+
+
+def load_cache(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_cache(filename, cache):
+    """Atomically replace the cache, readable by the owner only."""
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                   prefix='.check_gcalendar-')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(cache, f)
+    os.replace(tmpname, filename)
+
+
+def discovery_document(cache):
+    """Return the calendar v3 discovery document, stored in the cache."""
+    if cache.get('discovery'):
+        return cache['discovery'], False
+    from googleapiclient import discovery_cache
+    from googleapiclient.discovery import build
+
+    document = discovery_cache.get_static_doc('calendar', 'v3')
+    if document is None:
+        _log.info('No static discovery document, fetching it')
+        service = build('calendar', 'v3', static_discovery=False,
+                        cache_discovery=False)
+        document = json.dumps(service._rootDesc)
+    cache['discovery'] = document
+    return document, True
+
+
+def cached_credentials(gcredentials, cache):
+    """Reuse the cached access token until it is about to expire.
+
+    :returns: True when a new token was minted and the cache changed
+    """
+    key = '%s %s' % (gcredentials.service_account_email, ' '.join(SCOPES))
+    token = cache.get('token', {})
+    if token.get('key') == key and token.get('expiry', 0) - time.time() > TOKEN_MARGIN:
+        _log.debug('Using cached access token')
+        gcredentials.token = token['token']
+        gcredentials.expiry = datetime.utcfromtimestamp(token['expiry'])
+        return False
+
+    from google.auth.transport.requests import Request
+
+    _log.info('Minting a new access token')
+    gcredentials.refresh(Request())
+    cache['token'] = {'key': key,
+                      'token': gcredentials.token,
+                      'expiry': calendar.timegm(gcredentials.expiry.utctimetuple())}
+    return True
+
+
+def build_calendar(secrets=SECRETS, cache_file=CACHE_FILE):
+    """Build the calendar service from the cached discovery document and token.
+
+    When NAEMON_REPLAY is set the API responses are recorded to or, without
+    secrets or network, replayed from that cassette, see replay.
+    """
+    from googleapiclient.discovery import build_from_document
+    from google.oauth2 import service_account
+    import replay
+
+    cassette = replay.from_environment()
+    if cassette is not None and not cassette.recording:
+        document, changed = discovery_document(load_cache(cache_file))
+        return build_from_document(document, http=replay.ReplayHttp(cassette))
+
+    try:
+        gcredentials = service_account.Credentials.from_service_account_file(
+            secrets, scopes=SCOPES)
+    except FileNotFoundError:
+        raise FileNotFoundError('File with gsecrets not found') from None
+
+    cache = load_cache(cache_file)
+    document, changed = discovery_document(cache)
+    changed = cached_credentials(gcredentials, cache) or changed
+    if changed:
+        save_cache(cache_file, cache)
+    if cassette is not None:
+        import google_auth_httplib2
+        http = google_auth_httplib2.AuthorizedHttp(gcredentials)
+        return build_from_document(document, http=replay.ReplayHttp(cassette, http))
+    return build_from_document(document, credentials=gcredentials)
+
+
 class UrenContext(nagiosplugin.Context):
 
     def evaluate(self, metric, resource):
@@ -149,7 +383,9 @@ def main():
     Nagios check an Google calendar if an event is found starting 08:00 and
     ending 08:30 in now() minus 1 day that has a calendar summary
     description starting with "Uren " or "Vrij" then Ok state
-    else Critical state.
+    else Critical state. With --days the same is checked for every day of
+    the range, fetched in one paginated request or with --sync from the
+    changes since the previous run, and the total hours are reported.
 
     """
     argp = argparse.ArgumentParser()
@@ -161,25 +397,44 @@ def main():
                       help='increase output verbosity (use up to 3 times)')
     argp.add_argument('-t', '--timeout', default=30,
                       help='abort execution after TIMEOUT seconds')
+    argp.add_argument('--cache-file', default=CACHE_FILE,
+                      help='cache for the discovery document and access token '
+                           '(default: %(default)s)')
+    argp.add_argument('-d', '--days', type=int,
+                      help='check the last DAYS days in one request instead of yesterday')
+    argp.add_argument('-s', '--sync', action='store_true',
+                      help='with --days, only fetch changed events using a sync token')
+    argp.add_argument('-W', '--warning-total', metavar='RANGE',
+                      help='with --days, warning if total hour count is outside RANGE')
+    argp.add_argument('-C', '--critical-total', metavar='RANGE',
+                      help='with --days, critical if total hour count is outside RANGE')
+    plugin_profile.add_arguments(argp)
+    result_cache.add_arguments(argp)
     args = argp.parse_args()
-
-    try:
-        gcredentials = service_account.Credentials.from_service_account_file(
-            '/etc/naemon/secrets/gsecrets.json', scopes=SCOPES)
-    except FileNotFoundError:
-        raise FileNotFoundError('File with gsecrets not found') from None
-    except Exception:
-        raise
-
-    gcalendar = build('calendar', 'v3', credentials=gcredentials)
-
-    check = nagiosplugin.Check(Calendar(gcalendar),
-                               UrenContext('calendar'),
-                               nagiosplugin.ScalarContext('hour',
-                               args.warning_hour, args.critical_hour,
-                               fmt_metric='{value} uren geschreven'))
-
-    check.main(args.verbose)
+    if args.sync and not args.days:
+        argp.error('--sync requires --days')
+    if args.days and args.sync and args.days > KEEP_DAYS:
+        argp.error('--days can be at most %d with --sync' % KEEP_DAYS)
+
+    # Building the service mints the access token, it is profiled as well.
+    # With a fresh result in the result cache the service is not built.
+    with plugin_profile.Profile('check_gcalendar', args.profile, args.profile_dir):
+        def calendar():
+            return Calendar(build_calendar(SECRETS, args.cache_file), args.days,
+                            args.sync, args.cache_file)
+
+        check = nagiosplugin.Check(result_cache.cached_resource(
+                                       result_cache.from_arguments('check_gcalendar', args),
+                                       calendar, 'Calendar'),
+                                   UrenContext('calendar'),
+                                   nagiosplugin.ScalarContext('hour',
+                                   args.warning_hour, args.critical_hour,
+                                   fmt_metric='{value} uren geschreven'),
+                                   nagiosplugin.ScalarContext('total',
+                                   args.warning_total, args.critical_total,
+                                   fmt_metric='{value} uren totaal'))
+
+        check.main(args.verbose)
 
 
 if __name__ == '__main__':
@@ -1,20 +1,72 @@
 #!/usr/bin/python3
 
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
 import unittest
-from check_gcalendar import Calendar
-from apiclient.discovery import build
-from google.oauth2 import service_account
+from datetime import datetime, timedelta
 
-SCOPES = ['https://www.googleapis.com/auth/calendar.readonly']
+from googleapiclient.discovery import build_from_document
+
+import replay
+from check_gcalendar import (KEEP_DAYS, Calendar, build_calendar, discovery_document,
+                             load_cache)
+
+# The Google API responses are replayed from a cassette, no secrets or
+# network are needed. Record a real cassette with:
+#   NAEMON_REPLAY=gcalendar.json NAEMON_REPLAY_MODE=record ./check_gcalendar.py
+
+
+def event(days, summary, start='08:00', end='08:30'):
+    day = datetime.utcnow() - timedelta(days=days)
+    return {'id': 'event%d' % days,
+            'summary': summary,
+            'start': {'dateTime': day.strftime('%Y-%m-%dT' + start + ':00+01:00')},
+            'end': {'dateTime': day.strftime('%Y-%m-%dT' + end + ':00+01:00')}}
+
+
+def allday(days, summary):
+    day = datetime.utcnow() - timedelta(days=days)
+    return {'id': 'allday%d' % days,
+            'summary': summary,
+            'start': {'date': day.strftime('%Y-%m-%d')},
+            'end': {'date': (day + timedelta(days=1)).strftime('%Y-%m-%d')}}
+
+
+def record(cassette, request, response):
+    cassette.add(request.method, request.uri, 200,
+                 {'content-type': 'application/json; charset=UTF-8'},
+                 json.dumps(response).encode('utf-8'))
+
+
+tmpdir = tempfile.mkdtemp()
+cassette_file = os.path.join(tmpdir, 'gcalendar.json')
+cassette = replay.Cassette(cassette_file, 'record')
+
+# Requests are only built here to get their URLs for the cassette
+builder = build_from_document(discovery_document({})[0], http=replay.ReplayHttp(cassette))
+record(cassette, builder.events().list(calendarId='paulboot@gmail.com',
+                                       timeMin='x', timeMax='x', maxResults=10,
+                                       singleEvents=True, orderBy='startTime'),
+       {'items': [event(1, 'Vrij:')]})
+days_request = builder.events().list(calendarId='paulboot@gmail.com',
+                                     timeMin='x', timeMax='x', maxResults=250,
+                                     singleEvents=True, orderBy='startTime')
+record(cassette, days_request,
+       {'items': [allday(3, 'Verjaardag'), event(3, 'Uren: NP8 Km: K MKBoZ K'), event(2, 'Vrij:'),
+                  event(2, 'Lunch', '12:00', '13:00')],
+        'nextPageToken': 'page2'})
+days_request.uri += '&pageToken=page2'
+record(cassette, days_request, {'items': [event(1, 'Uren: NP4 P4? Km: K MKBoZ K')]})
+
+os.environ['NAEMON_REPLAY'] = cassette_file
 try:
-    gcredentials = service_account.Credentials.from_service_account_file(
-        '/etc/naemon/secrets/gsecrets.json', scopes=SCOPES)
-except FileNotFoundError:
-    raise FileNotFoundError('File with gsecrets not found') from None
-except Exception:
-    raise
-
-gcalendar = build('calendar', 'v3', credentials=gcredentials)
+    gcalendar = build_calendar(cache_file=os.path.join(tmpdir, 'cache.json'))
+finally:
+    del os.environ['NAEMON_REPLAY']
 c = Calendar(gcalendar)
 
 
@@ -32,9 +84,110 @@ class TestCalendarCheck(unittest.TestCase):
     def test_eventsum(self):
         self.assertEqual(c._eventsum(), 'Vrij:')
 
+    def test_days(self):
+        metrics = dict((metric.name, metric.value)
+                       for metric in Calendar(gcalendar, days=3).probe())
+        day = (datetime.utcnow() - timedelta(days=1)).strftime('%Y-%m-%d')
+        self.assertEqual(metrics['calendar_' + day], 'Uren: NP4 P4? Km: K MKBoZ K')
+        self.assertEqual(metrics['hour_' + day], 8)
+        self.assertEqual(metrics['total'], 16)
+
+    def test_lazy_imports(self):
+        output = subprocess.check_output(
+            [sys.executable, '-c', 'import sys, check_gcalendar; '
+             'print([name for name in sys.modules if name.startswith("google")])'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), universal_newlines=True)
+        self.assertEqual(output.strip(), '[]')
+
     def tearDown(self):
         print('Bye Test')
 
 
+class RequestLog(replay.ReplayHttp):
+    """ReplayHttp that keeps the requested URIs."""
+
+    def __init__(self, cassette):
+        super(RequestLog, self).__init__(cassette)
+        self.uris = []
+
+    def request(self, uri, *args, **kwargs):
+        self.uris.append(uri)
+        return super(RequestLog, self).request(uri, *args, **kwargs)
+
+
+class TestCalendarSync(unittest.TestCase):
+    """Calendar --sync against replayed sync responses."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmpdir, 'cache.json')
+        self.cassette = replay.Cassette(os.path.join(self.tmpdir, 'sync.json'), 'record')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def sync_request(self, **kwargs):
+        return builder.events().list(calendarId='paulboot@gmail.com', singleEvents=True,
+                                     maxResults=250, **kwargs)
+
+    def probe(self):
+        self.http = RequestLog(replay.Cassette(self.cassette.filename))
+        calendar = build_from_document(discovery_document({})[0], http=self.http)
+        return dict((metric.name, metric.value) for metric in
+                    Calendar(calendar, days=3, sync=True, cache_file=self.cache_file).probe())
+
+    def test_incremental(self):
+        record(self.cassette, self.sync_request(timeMin='x'),
+               {'items': [event(KEEP_DAYS + 5, 'Uren: NP8 Km: K MKBoZ K'),
+                          event(2, 'Uren: NP8 Km: K MKBoZ K'), event(1, 'Vrij:'),
+                          allday(1, 'Verjaardag')],
+                'nextSyncToken': 'token1'})
+        record(self.cassette, self.sync_request(syncToken='token1'),
+               {'items': [{'id': 'event2', 'status': 'cancelled'},
+                          event(1, 'Uren: NP4 Km: K MKBoZ K')],
+                'nextSyncToken': 'token2'})
+
+        self.assertEqual(self.probe()['total'], 8)
+        self.assertIn('timeMin=', self.http.uris[0])
+        store = load_cache(self.cache_file)['sync']
+        self.assertEqual((store['token'], sorted(store['events'])),
+                         ('token1', ['allday1', 'event1', 'event2']))
+
+        # An event that got too old since the last run is dropped as well
+        cache = load_cache(self.cache_file)
+        cache['sync']['events']['event%d' % (KEEP_DAYS + 1)] = event(KEEP_DAYS + 1, 'Vrij:')
+        with open(self.cache_file, 'w') as f:
+            json.dump(cache, f)
+        metrics = self.probe()
+        self.assertEqual(metrics['total'], 4)
+        self.assertIn('syncToken=token1', self.http.uris[0])
+        self.assertNotIn('timeMin=', self.http.uris[0])
+        store = load_cache(self.cache_file)['sync']
+        self.assertEqual((store['token'], sorted(store['events'])),
+                         ('token2', ['allday1', 'event1']))
+
+    def test_expired_token(self):
+        with open(self.cache_file, 'w') as f:
+            json.dump({'sync': {'token': 'expired',
+                                'events': {'event3': event(3, 'Uren: NP8 Km: K MKBoZ K')}}},
+                      f)
+        self.cassette.add('GET', self.sync_request(syncToken='expired').uri, 410,
+                          {'content-type': 'application/json; charset=UTF-8'},
+                          json.dumps({'error': {'code': 410, 'message': 'Sync token is no '
+                                                'longer valid'}}).encode('utf-8'))
+        record(self.cassette, self.sync_request(timeMin='x'),
+               {'items': [event(1, 'Uren: NP4 Km: K MKBoZ K')], 'nextSyncToken': 'token1'})
+
+        self.assertEqual(self.probe()['total'], 4)
+        self.assertEqual(len(self.http.uris), 2)
+        self.assertIn('timeMin=', self.http.uris[1])
+        store = load_cache(self.cache_file)['sync']
+        self.assertEqual((store['token'], sorted(store['events'])), ('token1', ['event1']))
+
+
+def tearDownModule():
+    shutil.rmtree(tmpdir)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -7,16 +7,16 @@
 import argparse
 import logging
 import nagiosplugin
+import plugin_profile
 import re
 import datetime
 import subprocess
-from jinja2 import Environment, PackageLoader, select_autoescape
 import locale
 from typing import List, Dict, Any
 import ipaddress
 from pprint import pprint
 
-locale.setlocale(locale.LC_ALL, 'nl_NL.UTF-8')
+# jinja2 and the nl_NL locale are only loaded once the arguments are valid
 
 # Graphite
 G_HOST = 'localhost'
@@ -206,6 +206,7 @@ class RttLoss(nagiosplugin.Resource):
     def generate_html(self):
         """Generate HTML using the self.status dictionary."""
         logging.info('Start generating HTML in generate_html')
+        from jinja2 import Environment, PackageLoader, select_autoescape
         env = Environment(loader=PackageLoader('check_rttloss', TEMPLATE_PATH), autoescape=select_autoescape(['html', 'xml']))
         template = env.get_template('fping-index.html')
 
@@ -269,11 +270,13 @@ def main():
                       help='a file with target hosts')
     argp.add_argument('-s', '--sort-by', choices=['targetname', 'targetip'], default='targetip',
                       help='sort the output by targetname or targetip')
+    plugin_profile.add_arguments(argp)
     args = argp.parse_args()
 
     # Configure logging based on verbosity
     log_level = args.log_level.upper()
     setup_logging(log_level)
+    locale.setlocale(locale.LC_ALL, 'nl_NL.UTF-8')
 
     check = nagiosplugin.Check(
         RttLoss(args.limit_rtt_time, args.limit_loss_perc, args.hosts, args.file, args.sort_by),
@@ -282,7 +285,8 @@ def main():
         nagiosplugin.ScalarContext('loss', args.warning_loss_hosts, args.critical_loss_hosts,
                                    fmt_metric='#{value} hosts loss failure'),
         RttLossSummary())
-    check.main(args.verbose, args.timeout)
+    plugin_profile.run_check(check, 'check_rttloss2', args,
+                             verbose=args.verbose, timeout=args.timeout)
 
 if __name__ == '__main__':
     main()
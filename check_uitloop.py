@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # Copyright (c) Paul Boot (paulboot(at)gmail.com)
 # See also LICENSE.txt
 
@@ -9,7 +9,7 @@
 # second context is not a scalar but a text output scalar, just used for reporting.
 
 # Dependancies
-# sudo apt-get install python-pip
+# sudo apt-get install python3-pip
 # sudo pip --proxy http://gg.nl:8080/ install nagiosplugin --upgrade
 # sudo locale-gen nl_NL.UTF-8
 
@@ -18,12 +18,14 @@
 
 # from __future__ import unicode_literals
 import argparse
-import pickle
 import logging
 import nagiosplugin
 
+import plugin_profile
+import result_cache
+import uitloop_cache
+
 import locale
-locale.setlocale(locale.LC_ALL, 'nl_NL.UTF-8')
 
 # Globals
 NO_PROXY = {
@@ -31,8 +33,8 @@ NO_PROXY = {
     'https': ''
 }
 
-pickle_path = '/usr/local/naemon/var/'
-pickle_file = '_check_uitloop_all.pkl'
+cache_path = '/usr/local/naemon/var/'
+cache_file = '_check_uitloop_all.cache'
 
 # Parsed data format
 # <item>
@@ -57,11 +59,12 @@ _log = logging.getLogger('nagiosplugin')
 class UITLOOP(nagiosplugin.Resource):
     """Resource creation"""
 
-    def __init__(self, departmentname, uitloopminuten, hostname):
+    def __init__(self, departmentname, uitloopminuten, hostname, max_age=None):
 
         self.departmentname = str(departmentname)
         self.uitloopminuten = int(uitloopminuten)
         self.hostname = str(hostname)
+        self.max_age = max_age
 
     def probe(self):
 
@@ -77,23 +80,21 @@ class UITLOOP(nagiosplugin.Resource):
         maxuitloopminuten = 0
         aantaluitloopresources = 0
 
-        input = open(pickle_path + self.hostname + pickle_file, 'rb')
-        alluitloopdict = pickle.load(input)
-        input.close()
-        # pprint.pprint(alluitloopdict)
-
-        for departmentname in alluitloopdict:
-            if departmentname == self.departmentname:
-                for resource in alluitloopdict[departmentname]:
-                    if alluitloopdict[departmentname][resource]['uitloopminuten'] > self.uitloopminuten:
-                        _log.debug('###DEBUG Found resoure: %s with exceded uitloop: %d min.',
-                                   resource, alluitloopdict[departmentname][resource]['uitloopminuten'])
-                        if not uitloopdict.has_key(departmentname):
-                            uitloopdict[departmentname] = {}
-                        if not uitloopdict[departmentname].has_key(resource):
-                            uitloopdict[departmentname][resource] = {}
-                        uitloopdict[departmentname][resource]['uitloopminuten'] = alluitloopdict[departmentname][resource]['uitloopminuten']
-                        aantaluitloopresources += 1
+        try:
+            departmentdict, timestamp = uitloop_cache.read_department(
+                cache_path + self.hostname + cache_file, self.departmentname,
+                self.max_age)
+        except uitloop_cache.UitloopCacheError as e:
+            raise nagiosplugin.CheckError(str(e))
+        _log.debug('###DEBUG Read uitloop cache from timestamp: %s', timestamp)
+
+        for resource in departmentdict:
+            if departmentdict[resource]['uitloopminuten'] > self.uitloopminuten:
+                _log.debug('###DEBUG Found resoure: %s with exceded uitloop: %d min.',
+                           resource, departmentdict[resource]['uitloopminuten'])
+                uitloopdict.setdefault(self.departmentname, {})[resource] = {
+                    'uitloopminuten': departmentdict[resource]['uitloopminuten']}
+                aantaluitloopresources += 1
 
         return [nagiosplugin.Metric('aantaluitloopresources', aantaluitloopresources, min=0),
                 nagiosplugin.Metric('tekst', uitloopdict)]
@@ -109,7 +110,7 @@ class UitloopSummary(nagiosplugin.Summary):
             for naam in results['tekst'].metric.value[afdeling]:
                 problemText += "%s: %d min. " % (naam,
                                                  results['tekst'].metric.value[afdeling][naam]['uitloopminuten'])
-        return problemText.encode('ascii', 'ignore')
+        return problemText.encode('ascii', 'ignore').decode('ascii')
 
     def verbose(self, results):
         verboseText = '\nEr is uitloop geconstateerd op de volgende afdelingen:\n'
@@ -118,7 +119,7 @@ class UitloopSummary(nagiosplugin.Summary):
             for naam in results['tekst'].metric.value[afdeling]:
                 verboseText += "%s: %d minuten. " % (
                     naam, results['tekst'].metric.value[afdeling][naam]['uitloopminuten'])
-        return verboseText.encode('ascii', 'ignore')
+        return verboseText.encode('ascii', 'ignore').decode('ascii')
 
 
 @nagiosplugin.guarded
@@ -140,17 +141,26 @@ def main():
                       help='host name argument for webservices URL')
     argp.add_argument('-p', '--port', type=int, default=80,
                       help='port number (default: 80)')
+    argp.add_argument('-m', '--max-age', type=int, default=900,
+                      help='maximale leeftijd van de uitloop cache in seconden (default: 900)')
+    plugin_profile.add_arguments(argp)
+    result_cache.add_arguments(argp)
     args = argp.parse_args()
-    check = nagiosplugin.Check(UITLOOP(args.departmentname,
-                                       args.uitloopminuten,
-                                       args.hostname),
+    locale.setlocale(locale.LC_ALL, 'nl_NL.UTF-8')
+    check = nagiosplugin.Check(result_cache.cached_resource(
+                                   result_cache.from_arguments('check_uitloop', args),
+                                   UITLOOP(args.departmentname,
+                                           args.uitloopminuten,
+                                           args.hostname,
+                                           args.max_age)),
                                nagiosplugin.ScalarContext('aantaluitloopresources',
                                                           args.warning,
                                                           args.critical,
                                                           fmt_metric='{value} maximale uitloop in minuten'),
                                nagiosplugin.Context('tekst'),
                                UitloopSummary())
-    check.main(verbose=args.verbose, timeout=args.timeout)
+    plugin_profile.run_check(check, 'check_uitloop', args,
+                             verbose=args.verbose, timeout=args.timeout)
 
 
 if __name__ == '__main__':
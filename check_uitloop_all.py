@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 # Copyright (c) Paul Boot (paulboot(at)gmail.com)
 # See also LICENSE.txt
 
@@ -12,7 +12,7 @@
 # second context is not a scalar but a text output scalar, just used for reporting.
 
 # Dependancies
-# sudo apt-get install python-pip
+# sudo apt-get install python3-pip
 # sudo pip --proxy http://proxy.gg.nl:8080/ install nagiosplugin --upgrade
 # sudo locale-gen nl_NL.UTF-8
 
@@ -20,16 +20,18 @@
 # wget --no-proxy -O output.txt
 #   http://gg.nl/PlanService/getfeed.aspx?id=uitloop&link=schedule&showzerodelay=n
 
-import requests
 import argparse
-import pickle
+import functools
 import logging
 import nagiosplugin
 import re
-from lxml import etree
+
+import naemon_submit
+import plugin_profile
+import uitloop_cache
+import uitloop_fetch
 
 import locale
-locale.setlocale(locale.LC_ALL, 'nl_NL.UTF-8')
 
 
 # Globals
@@ -42,8 +44,9 @@ NO_PROXY = {
 }
 
 URL_uitloop = '/PlanService/getfeed.aspx?id=uitloop&link=schedule&showzerodelay=n'
-pickle_path = '/usr/local/naemon/var/'
-pickle_file = '_check_uitloop_all.pkl'
+cache_path = '/usr/local/naemon/var/'
+cache_file = '_check_uitloop_all.cache'
+feed_file = '_uitloop_feed.xml'
 
 # Parsed data format
 # <item>
@@ -61,17 +64,137 @@ pickle_file = '_check_uitloop_all.pkl'
 # </item>
 
 # Parse title line: 'Uitloop Cardiologie - dr. v.d. Plas: 30 minuten'
+# only used when the logisp:* fields are missing in an <item>
+
+# lxml, requests (in uitloop_fetch) and sqlite3 (in uitloop_history) are
+# imported on the code path that needs them, not when the plugin starts
 
 _log = logging.getLogger('nagiosplugin')
 
 
+def parse_feed(source):
+    """Stream the uitloop feed and yield one dict per <item>.
+
+    Every <item> is handled as soon as its end tag is parsed and cleared
+    afterwards, so memory use does not grow with the size of the feed and
+    parsing overlaps with the download when source is a response stream.
+
+    :param source: file-like object or filename with the feed XML
+    :returns: iterator of dicts with the keys department, departmentname,
+        resource, uitloopminuten and pubDate
+    """
+    from lxml import etree
+
+    for event, item in etree.iterparse(source, events=('end',), tag='item',
+                                       recover=True, encoding='utf-8'):
+        fields = {}
+        for child in item:
+            if isinstance(child.tag, str):
+                # Undeclared prefixes are kept in the tag name by recover mode
+                name = child.tag.rsplit('}', 1)[-1].split(':')[-1]
+                fields[name] = (child.text or '').strip()
+
+        # Free the parsed item and the already handled siblings before it
+        item.clear()
+        while item.getprevious() is not None:
+            del item.getparent()[0]
+
+        try:
+            yield {'department': fields.get('department', ''),
+                   'departmentname': fields['departmentname'],
+                   'resource': fields['resource'],
+                   'uitloopminuten': int(fields['uitloopminuten']),
+                   'pubDate': fields.get('pubDate', '')}
+            continue
+        except (KeyError, ValueError):
+            pass
+
+        title = fields.get('title', '')
+        _log.debug('Found <item> without logisp fields, <title>: %s', title)
+        searchObj = re.match(r'Uitloop\s(.*?)\s-\s(.*?):\s(\d*)\sminuten.', title)
+        if searchObj:
+            yield {'department': fields.get('department', ''),
+                   'departmentname': searchObj.group(1),
+                   'resource': searchObj.group(2),
+                   'uitloopminuten': int(searchObj.group(3)),
+                   'pubDate': fields.get('pubDate', '')}
+        else:
+            _log.info('Uitloop string NOT found in <title> line: %s', title)
+
+
+def load_departments(filename):
+    """Read the departments to submit passive results for.
+
+    One department per line: 'departmentname;uitloopminuten;warning;critical'
+    with an optional fifth field for the service description, which defaults
+    to 'UITLOOP-<departmentname>'. Empty lines and lines starting with # are
+    skipped.
+    """
+    departments = []
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = [field.strip() for field in line.split(';')]
+            if len(fields) not in (4, 5):
+                raise ValueError('Invalid department line: %s' % line)
+            departments.append({
+                'departmentname': fields[0],
+                'uitloopminuten': int(fields[1]),
+                'warning': fields[2],
+                'critical': fields[3],
+                'service': fields[4] if len(fields) == 5 else 'UITLOOP-' + fields[0]})
+    return departments
+
+
+def evaluate_department(departmentname, departmentdict, uitloopminuten,
+                        warning, critical):
+    """Evaluate one department like check_uitloop does.
+
+    :returns: (state code, plugin output with perfdata)
+    """
+    exceeded = dict((resource, departmentdict[resource]['uitloopminuten'])
+                    for resource in departmentdict
+                    if departmentdict[resource]['uitloopminuten'] > uitloopminuten)
+    aantaluitloopresources = len(exceeded)
+    if not nagiosplugin.Range(str(critical)).match(aantaluitloopresources):
+        code, state = naemon_submit.STATE_CRITICAL, 'CRITICAL'
+    elif not nagiosplugin.Range(str(warning)).match(aantaluitloopresources):
+        code, state = naemon_submit.STATE_WARNING, 'WARNING'
+    else:
+        code, state = naemon_submit.STATE_OK, 'OK'
+
+    if code == naemon_submit.STATE_OK:
+        text = '%d maximale uitloop in minuten' % aantaluitloopresources
+    else:
+        text = '%s - ' % departmentname
+        for naam in sorted(exceeded):
+            text += '%s: %d min. ' % (naam, exceeded[naam])
+        text = text.encode('ascii', 'ignore').decode('ascii').strip()
+    return code, 'UITLOOP %s - %s | aantaluitloopresources=%d;%s;%s;0' % (
+        state, text, aantaluitloopresources, warning, critical)
+
+
 class UITLOOP(nagiosplugin.Resource):
     """Resource creation"""
 
-    def __init__(self, uitloopminuten, hostname):
+    def __init__(self, uitloopminuten, hostname, max_age=900, refresh_after=60,
+                 connect_timeout=5, read_timeout=45, departments=None,
+                 passive_host=None, submit=None, history_db=None):
 
         self.uitloopminuten = int(uitloopminuten)
         self.hostname = str(hostname)
+        self.departments = departments or []
+        self.passive_host = passive_host or self.hostname
+        self.submit = submit or naemon_submit.submit_command_file
+        self.history_db = history_db
+        self.fetcher = uitloop_fetch.FeedFetcher(
+            'http://' + self.hostname + URL_uitloop,
+            cache_path + self.hostname + feed_file,
+            max_age=max_age, refresh_after=refresh_after,
+            connect_timeout=connect_timeout, read_timeout=read_timeout,
+            proxies=NO_PROXY)
 
     def probe(self):
 
@@ -84,46 +207,69 @@ class UITLOOP(nagiosplugin.Resource):
         # pprint.pprint(uitloopdict)
 
         uitloopdict = {}
+        alluitloopdict = {}
+        items = []
         aantaluitloopafdelingen = 0
 
-        URL = 'http://' + self.hostname + URL_uitloop
-        _log.debug('###DEBUG fetching URL: %s', URL)
-
-        r = requests.get(URL, proxies=NO_PROXY)
-        _log.debug('###DEBUG URL_uitloop status code: %r', r.status_code)
-        # print r.content
-
-        parser = etree.XMLParser(ns_clean=True, recover=True, encoding='utf-8')
-        xml = etree.fromstring(r.content, parser)
-
-        for element in xml.iter():
-            if element.tag == 'title' and element.text != 'Uitloop':
-                _log.debug('Found <title> tag with contents: %s', element.text)
-                searchObj = re.match(r'Uitloop\s(.*?)\s-\s(.*?):\s(\d*)\sminuten.', element.text)
-                if searchObj:
-                    departmentname = searchObj.group(1)
-                    resource = searchObj.group(2)
-                    uitloopminuten = int(searchObj.group(3))
-
-                    if departmentname not in ignoredepartments:
-                        if uitloopminuten > self.uitloopminuten:
-                            if not uitloopdict.has_key(departmentname):
-                                uitloopdict[departmentname] = {}
-                            if not uitloopdict[departmentname].has_key(resource):
-                                uitloopdict[departmentname][resource] = {}
-                            uitloopdict[departmentname][resource]['uitloopminuten'] = uitloopminuten
-                            aantaluitloopafdelingen += 1
-                else:
-                    _log.info('Uitloop string NOT found in <title> line: %s', element.text)
+        # Served from the last good copy or streamed into the parser
+        try:
+            feed = self.fetcher.open()
+        except uitloop_fetch.FeedFetchError as e:
+            raise nagiosplugin.CheckError(str(e))
+
+        with feed:
+            for item in parse_feed(feed):
+                if self.history_db:
+                    items.append(item)
+                departmentname = item['departmentname']
+                resource = item['resource']
+                uitloopminuten = item['uitloopminuten']
+                _log.debug('Found <item> %s - %s: %d minuten',
+                           departmentname, resource, uitloopminuten)
+
+                if departmentname not in ignoredepartments:
+                    alluitloopdict.setdefault(departmentname, {})[resource] = {
+                        'uitloopminuten': uitloopminuten}
+                    if uitloopminuten > self.uitloopminuten:
+                        uitloopdict.setdefault(departmentname, {})[resource] = {
+                            'uitloopminuten': uitloopminuten}
+                        aantaluitloopafdelingen += 1
+        _log.debug('###DEBUG feed fetched at %s, from cache: %s',
+                   self.fetcher.fetched, self.fetcher.from_cache)
         # pprint.pprint(uitloopdict))
-        output = open(pickle_path + self.hostname + pickle_file, 'wb', -1)
-        pickle.dump(uitloopdict, output)
-        output.close()
+        # All resources are published, every check_uitloop applies its own limit
+        uitloop_cache.write_cache(cache_path + self.hostname + cache_file,
+                                  alluitloopdict, self.fetcher.fetched)
+        if self.departments:
+            self.submit_departments(alluitloopdict)
+        if self.history_db:
+            import uitloop_history
+
+            with uitloop_history.UitloopHistory(self.history_db) as history:
+                added = history.append(items, self.fetcher.fetched)
+            _log.debug('###DEBUG added %d of %d items to history', added, len(items))
 
         return [nagiosplugin.Metric('aantaluitloopafdelingen', aantaluitloopafdelingen, min=0),
                 nagiosplugin.Metric('tekst', uitloopdict)]
 
 
+    def submit_departments(self, alluitloopdict):
+        """Submit a passive result per department from this feed snapshot."""
+        results = []
+        for department in self.departments:
+            code, output = evaluate_department(
+                department['departmentname'],
+                alluitloopdict.get(department['departmentname'], {}),
+                department['uitloopminuten'], department['warning'],
+                department['critical'])
+            _log.debug('###DEBUG passive result %s: %s', department['service'], output)
+            results.append(naemon_submit.CheckResult(
+                self.passive_host, department['service'], code, output,
+                self.fetcher.fetched))
+        self.submit(results)
+        _log.info('Submitted %d passive department results', len(results))
+
+
 class UitloopSummary(nagiosplugin.Summary):
     """Status regel output functies."""
 
@@ -134,7 +280,7 @@ class UitloopSummary(nagiosplugin.Summary):
             for naam in results['tekst'].metric.value[afdeling]:
                 problemText += "%s: %d min. " % (naam,
                                                  results['tekst'].metric.value[afdeling][naam]['uitloopminuten'])
-        return problemText.encode('ascii', 'ignore')
+        return problemText.encode('ascii', 'ignore').decode('ascii')
 
     def verbose(self, results):
         verboseText = '\nEr is uitloop geconstateerd op de volgende afdelingen:\n'
@@ -143,7 +289,7 @@ class UitloopSummary(nagiosplugin.Summary):
             for naam in results['tekst'].metric.value[afdeling]:
                 verboseText += "%s: %d minuten. " % (
                     naam, results['tekst'].metric.value[afdeling][naam]['uitloopminuten'])
-        return verboseText.encode('ascii', 'ignore')
+        return verboseText.encode('ascii', 'ignore').decode('ascii')
 
 
 @nagiosplugin.guarded
@@ -163,14 +309,54 @@ def main():
                       help='host name argument for webservices URL')
     argp.add_argument('-p', '--port', type=int, default=80,
                       help='port number (default: 80)')
+    argp.add_argument('-m', '--max-age', type=int, default=900,
+                      help='maximale leeftijd van de bewaarde feed in seconden (default: 900)')
+    argp.add_argument('-r', '--refresh-after', type=int, default=60,
+                      help='gebruik de bewaarde feed zonder request tot REFRESH_AFTER seconden, ververs hem '
+                           'daarna op de achtergrond (default: 60)')
+    argp.add_argument('--connect-timeout', type=float, default=5,
+                      help='connect timeout in seconden (default: 5)')
+    argp.add_argument('--read-timeout', type=float, default=45,
+                      help='read timeout in seconden (default: 45)')
+    argp.add_argument('-D', '--departments', metavar='FILE',
+                      help='bestand met per regel afdeling;uitloopminuten;warning;critical[;service] '
+                           'waarvoor een passief resultaat wordt ingediend')
+    argp.add_argument('--passive-host',
+                      help='Naemon host naam voor de passieve resultaten (default: HOSTNAME)')
+    argp.add_argument('--command-file', default=naemon_submit.COMMAND_FILE,
+                      help='Naemon command file (default: %(default)s)')
+    argp.add_argument('--spool-dir',
+                      help='schrijf de passieve resultaten naar deze checkresults spool directory '
+                           'in plaats van naar de command file')
+    argp.add_argument('--submit-socket', metavar='SOCKET',
+                      help='stuur de passieve resultaten naar naemon_submitd op deze socket, '
+                           'de command file als die niet bereikbaar is')
+    argp.add_argument('--history-db', metavar='FILE',
+                      help='voeg alle items uit de feed toe aan deze SQLite historie database')
+    plugin_profile.add_arguments(argp)
     args = argp.parse_args()
+    locale.setlocale(locale.LC_ALL, 'nl_NL.UTF-8')
+    departments = load_departments(args.departments) if args.departments else None
+    if args.submit_socket:
+        submit = functools.partial(naemon_submit.submit_socket_or_command_file,
+                                   path=args.submit_socket, command_file=args.command_file)
+    elif args.spool_dir:
+        submit = functools.partial(naemon_submit.submit_spool, spool_dir=args.spool_dir)
+    else:
+        submit = functools.partial(naemon_submit.submit_command_file,
+                                   command_file=args.command_file)
+    # No result_cache here: every run publishes the uitloop cache, the
+    # passive results and the history, only the feed fetch is cached
     check = nagiosplugin.Check(
-        UITLOOP(args.uitloopminuten, args.hostname),
+        UITLOOP(args.uitloopminuten, args.hostname, args.max_age,
+                args.refresh_after, args.connect_timeout, args.read_timeout,
+                departments, args.passive_host, submit, args.history_db),
         nagiosplugin.ScalarContext('aantaluitloopafdelingen', args.warning,
                                    args.critical, fmt_metric='{value} maximale uitloop in minuten'),
         nagiosplugin.Context('tekst'),
         UitloopSummary())
-    check.main(verbose=args.verbose, timeout=args.timeout)
+    plugin_profile.run_check(check, 'check_uitloop_all', args,
+                             verbose=args.verbose, timeout=args.timeout)
 
 
 if __name__ == '__main__':
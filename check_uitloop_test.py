@@ -0,0 +1,414 @@
+#!/usr/bin/python3
+
+import functools
+import http.server
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import nagiosplugin
+import requests
+
+import check_uitloop
+import check_uitloop_all
+import naemon_submit
+import replay
+import uitloop_cache
+import uitloop_fetch
+import uitloop_history
+
+UITLOOPDICT = {
+    'Cardiologie': {'dr. v.d. P': {'uitloopminuten': 25},
+                    'dr. Jansen': {'uitloopminuten': 60}},
+    'Oogheelkunde': {'dr. Ørsted': {'uitloopminuten': 50}},
+}
+
+
+class TestUitloopCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'host_check_uitloop_all.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        uitloop_cache.write_cache(self.filename, UITLOOPDICT, 1000.0)
+        for departmentname in UITLOOPDICT:
+            self.assertEqual(uitloop_cache.read_department(self.filename, departmentname),
+                             (UITLOOPDICT[departmentname], 1000.0))
+        self.assertEqual(uitloop_cache.read_all(self.filename), (UITLOOPDICT, 1000.0))
+
+    def test_unknown_department(self):
+        uitloop_cache.write_cache(self.filename, UITLOOPDICT, 1000.0)
+        self.assertEqual(uitloop_cache.read_department(self.filename, 'Dialyse'),
+                         ({}, 1000.0))
+
+    def test_stale(self):
+        uitloop_cache.write_cache(self.filename, UITLOOPDICT, time.time() - 600)
+        self.assertRaises(uitloop_cache.StaleCacheError, uitloop_cache.read_department,
+                          self.filename, 'Cardiologie', 300)
+        self.assertEqual(uitloop_cache.read_department(self.filename, 'Cardiologie', 900)[0],
+                         UITLOOPDICT['Cardiologie'])
+
+    def test_missing_and_version(self):
+        self.assertRaises(uitloop_cache.UitloopCacheError, uitloop_cache.read_department,
+                          self.filename, 'Cardiologie')
+        with open(self.filename, 'wb') as f:
+            f.write(b'{"version": 0, "timestamp": 0, "index": {}}\n')
+        self.assertRaises(uitloop_cache.UitloopCacheError, uitloop_cache.read_department,
+                          self.filename, 'Cardiologie')
+
+    def test_atomic_replace(self):
+        uitloop_cache.write_cache(self.filename, UITLOOPDICT, 1000.0)
+        uitloop_cache.write_cache(self.filename, {}, 2000.0)
+        self.assertEqual(os.listdir(self.tmpdir), [os.path.basename(self.filename)])
+        self.assertEqual(uitloop_cache.read_all(self.filename), ({}, 2000.0))
+
+
+def history_item(departmentname, resource, minutes, pubdate):
+    return {'department': 'A00104', 'departmentname': departmentname,
+            'resource': resource, 'uitloopminuten': minutes, 'pubDate': pubdate}
+
+
+class TestUitloopHistory(unittest.TestCase):
+    def setUp(self):
+        fd, self.filename = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+        self.history = uitloop_history.UitloopHistory(self.filename)
+
+    def tearDown(self):
+        self.history.close()
+        os.remove(self.filename)
+
+    def test_percentile(self):
+        self.assertEqual(uitloop_history.percentile([], 50), None)
+        self.assertEqual(uitloop_history.percentile([10], 90), 10)
+        values = list(range(1, 11))
+        self.assertEqual(uitloop_history.percentile(values, 50), 5)
+        self.assertEqual(uitloop_history.percentile(values, 90), 9)
+
+    def test_append_and_query(self):
+        items = [history_item('Cardiologie', 'dr. %d' % i, i * 10,
+                              'Tue, 03 May 2018 09:%02d:00 GMT' % i) for i in range(1, 11)]
+        items.append(history_item('Oogheelkunde', 'dr. X', 50, 'Tue, 03 May 2018 14:00:00 GMT'))
+        self.assertEqual(self.history.append(items), 11)
+        # The same feed snapshot again adds nothing
+        self.assertEqual(self.history.append(items), 0)
+
+        stats = self.history.percentiles()
+        self.assertEqual(stats['Cardiologie'], {'count': 10, 'p50': 50, 'p90': 90, 'max': 100})
+        self.assertEqual(stats['Oogheelkunde']['max'], 50)
+
+        stats = self.history.percentiles('Cardiologie', by_hour=True)
+        self.assertEqual(len(stats), 1)
+        (name, hour), row = stats.popitem()
+        self.assertEqual(name, 'Cardiologie')
+        self.assertEqual(hour, time.localtime(1525338060).tm_hour)
+        self.assertEqual(row['count'], 10)
+
+        self.assertEqual(self.history.percentiles(start=1525360000), {})
+        self.assertEqual(self.history.prune(1525360000), 11)
+
+    def test_missing_pubdate(self):
+        self.history.append([history_item('Cardiologie', 'dr. A', 20, '')], 1525339311)
+        self.assertEqual(self.history.percentiles(end=1525339311)['Cardiologie']['count'], 1)
+
+
+FEED = b"""<?xml version="1.0" encoding="utf-8"?>
+<rss version="2.0" xmlns:logisp="http://www.logisp.nl/rss">
+<channel>
+<title>Uitloop</title>
+<item>
+<pubDate>Tue, 03 May 2018 09:21:51 GMT</pubDate>
+<title>Uitloop Cardiologie - dr. v.d. P: 25 minuten.</title>
+<logisp:type>uitloop</logisp:type>
+<logisp:department>A00104</logisp:department>
+<logisp:departmentname>Cardiologie</logisp:departmentname>
+<logisp:resource>dr. v.d. P</logisp:resource>
+<logisp:uitloopminuten>25</logisp:uitloopminuten>
+</item>
+</channel>
+</rss>
+"""
+
+
+class FeedHandler(http.server.BaseHTTPRequestHandler):
+    """Local stand-in for the planning service feed."""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        time.sleep(server.delay)
+        if self.headers.get('If-None-Match') == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('Content-Length', str(len(server.body)))
+        self.send_header('ETag', server.etag)
+        self.send_header('Last-Modified', 'Tue, 03 May 2018 09:21:51 GMT')
+        self.end_headers()
+        self.wfile.write(server.body)
+
+    def log_message(self, *args):
+        pass
+
+
+STALE_PLUGIN = '''
+import sys, uitloop_fetch
+with uitloop_fetch.FeedFetcher(sys.argv[1], sys.argv[2], refresh_after=0).open() as feed:
+    print(len(feed.read()))
+'''
+
+
+class TestFeedFetcher(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FeedHandler)
+        self.server.requests = []
+        self.server.delay = 0
+        self.server.etag = '"v1"'
+        self.server.body = FEED
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/PlanService/getfeed.aspx' % self.server.server_port
+        self.cachefile = os.path.join(self.tmpdir, 'host_uitloop_feed.xml')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def fetcher(self, **kwargs):
+        return uitloop_fetch.FeedFetcher(self.url, self.cachefile, **kwargs)
+
+    def test_fetch_and_cache(self):
+        fetcher = self.fetcher()
+        with fetcher.open() as feed:
+            self.assertEqual(feed.read(), FEED)
+        self.assertFalse(fetcher.from_cache)
+        with open(self.cachefile, 'rb') as f:
+            self.assertEqual(f.read(), FEED)
+
+        fetcher = self.fetcher(refresh_after=60)
+        with fetcher.open() as feed:
+            self.assertEqual(feed.read(), FEED)
+        self.assertTrue(fetcher.from_cache)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_incomplete_body_not_published(self):
+        with self.assertRaises(RuntimeError):
+            with self.fetcher().open() as feed:
+                feed.read(10)
+                raise RuntimeError('parser failed')
+        self.assertFalse(os.path.exists(self.cachefile))
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_conditional_revalidate(self):
+        with self.fetcher().open() as feed:
+            feed.read()
+        self.assertTrue(self.fetcher().revalidate())
+        self.assertEqual(self.server.requests[-1].get('If-None-Match'), '"v1"')
+        self.assertEqual(self.server.requests[-1].get('If-Modified-Since'),
+                         'Tue, 03 May 2018 09:21:51 GMT')
+
+        self.server.etag = '"v2"'
+        self.server.body = FEED.replace(b'25', b'55')
+        self.assertTrue(self.fetcher().revalidate())
+        with open(self.cachefile, 'rb') as f:
+            self.assertIn(b'55', f.read())
+
+    def test_stale_while_revalidate(self):
+        with self.fetcher().open() as feed:
+            feed.read()
+        self.server.delay = 1.0
+        self.server.etag = '"v2"'
+        self.server.body = FEED.replace(b'25', b'55')
+        fetcher = self.fetcher(refresh_after=0)
+        start = time.time()
+        with fetcher.open() as feed:
+            self.assertEqual(feed.read(), FEED)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertTrue(fetcher.from_cache)
+
+        # The detached refresher publishes the new copy
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            with open(self.cachefile, 'rb') as f:
+                if b'55' in f.read():
+                    break
+            time.sleep(0.1)
+        else:
+            self.fail('feed copy not refreshed in the background')
+
+    def test_refresher_detached(self):
+        with self.fetcher().open() as feed:
+            feed.read()
+        self.server.delay = 2.0
+        self.server.etag = '"v2"'
+        # A plugin answering from the stale copy, its output pipe must reach
+        # EOF without waiting for the refresher
+        plugin = subprocess.Popen(
+            [sys.executable, '-c', STALE_PLUGIN, self.url, self.cachefile],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        start = time.time()
+        stdout, stderr = plugin.communicate(timeout=10)
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual(stdout, b'%d\n' % len(FEED))
+
+    def test_slow_backend_without_copy(self):
+        self.server.delay = 1.0
+        fetcher = self.fetcher(read_timeout=0.2)
+        self.assertRaises(uitloop_fetch.FeedFetchError, fetcher.open)
+
+    def test_expired_copy(self):
+        with self.fetcher().open() as feed:
+            feed.read()
+        self.server.delay = 1.0
+        fetcher = self.fetcher(max_age=0, read_timeout=0.2)
+        self.assertRaises(uitloop_fetch.FeedFetchError, fetcher.open)
+
+
+FEED_ITEM = """<item>
+<pubDate>Tue, 03 May 2018 09:%02d:00 GMT</pubDate>
+<title>Uitloop %s - %s: %d minuten.</title>
+<logisp:department>A00104</logisp:department>
+<logisp:departmentname>%s</logisp:departmentname>
+<logisp:resource>%s</logisp:resource>
+<logisp:uitloopminuten>%d</logisp:uitloopminuten>
+</item>
+"""
+
+
+def feed(items):
+    """Build a feed from (departmentname, resource, minutes) tuples."""
+    body = ''.join(FEED_ITEM % (i % 60, name, resource, minutes, name, resource, minutes)
+                   for i, (name, resource, minutes) in enumerate(items))
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<rss version="2.0" xmlns:logisp="http://www.logisp.nl/rss"><channel>\n'
+            '<title>Uitloop</title>\n%s</channel></rss>\n' % body).encode('utf-8')
+
+
+class TestParseFeed(unittest.TestCase):
+    def test_logisp_fields(self):
+        items = list(check_uitloop_all.parse_feed(io.BytesIO(feed([
+            ('Cardiologie', 'dr. v.d. P', 25), ('Oogheelkunde', 'dr. Ørsted', 50)]))))
+        self.assertEqual(len(items), 2)
+        self.assertEqual(items[0], {'department': 'A00104', 'departmentname': 'Cardiologie',
+                                    'resource': 'dr. v.d. P', 'uitloopminuten': 25,
+                                    'pubDate': 'Tue, 03 May 2018 09:00:00 GMT'})
+        self.assertEqual(items[1]['resource'], 'dr. Ørsted')
+
+    def test_title_fallback(self):
+        xml = (b'<rss><channel><title>Uitloop</title>'
+               b'<item><title>Uitloop Cardiologie - dr. v.d. P: 25 minuten.</title></item>'
+               b'<item><title>Geen uitloop</title></item></channel></rss>')
+        items = list(check_uitloop_all.parse_feed(io.BytesIO(xml)))
+        self.assertEqual([(item['departmentname'], item['resource'], item['uitloopminuten'])
+                          for item in items], [('Cardiologie', 'dr. v.d. P', 25)])
+
+
+class TestUitloopProbe(unittest.TestCase):
+    """UITLOOP.probe of both plugins against a replayed feed."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_path = check_uitloop_all.cache_path
+        check_uitloop_all.cache_path = check_uitloop.cache_path = self.tmpdir + '/'
+        cassette = replay.Cassette(os.path.join(self.tmpdir, 'uitloop.json'), 'record')
+        cassette.add('GET', 'http://planning' + check_uitloop_all.URL_uitloop, 200,
+                     {'ETag': '"v1"'},
+                     feed([('Cardiologie', 'dr. A', 60), ('Cardiologie', 'dr. B', 20),
+                           ('Dialyse', 'dr. C', 90), ('Oogheelkunde', 'dr. D', 50)]))
+        self.session = requests.Session()
+        replay.install(self.session, replay.Cassette(cassette.filename))
+
+    def tearDown(self):
+        check_uitloop_all.cache_path = check_uitloop.cache_path = self.cache_path
+        shutil.rmtree(self.tmpdir)
+
+    def test_probe(self):
+        submitted = []
+        departments = [{'departmentname': 'Cardiologie', 'uitloopminuten': 45,
+                        'warning': '0', 'critical': '1', 'service': 'UITLOOP-Cardiologie'},
+                       {'departmentname': 'Kindergeneeskunde', 'uitloopminuten': 45,
+                        'warning': '0', 'critical': '1', 'service': 'UITLOOP-Kinderen'}]
+        resource = check_uitloop_all.UITLOOP(45, 'planning', departments=departments,
+                                             submit=submitted.extend,
+                                             history_db=os.path.join(self.tmpdir, 'h.sqlite'))
+        resource.fetcher.session = self.session
+        metrics = dict((metric.name, metric.value) for metric in resource.probe())
+        self.assertEqual(metrics['aantaluitloopafdelingen'], 2)
+        self.assertEqual(sorted(metrics['tekst']), ['Cardiologie', 'Oogheelkunde'])
+
+        self.assertEqual([(result.service, result.code) for result in submitted],
+                         [('UITLOOP-Cardiologie', naemon_submit.STATE_WARNING),
+                          ('UITLOOP-Kinderen', naemon_submit.STATE_OK)])
+        with uitloop_history.UitloopHistory(os.path.join(self.tmpdir, 'h.sqlite')) as history:
+            self.assertEqual(history.percentiles()['Dialyse']['max'], 90)
+
+        # check_uitloop reads its own department from the published cache
+        metrics = dict((metric.name, metric.value) for metric in
+                       check_uitloop.UITLOOP('Cardiologie', 10, 'planning', 900).probe())
+        self.assertEqual(metrics['aantaluitloopresources'], 2)
+        self.assertRaises(nagiosplugin.CheckError, check_uitloop.UITLOOP('Cardiologie', 10, 'planning', -1).probe)
+
+    def test_submit_socket_fallback(self):
+        # --submit-socket without a running naemon_submitd
+        command_file = os.path.join(self.tmpdir, 'naemon.cmd')
+        os.mkfifo(command_file)
+        submit = functools.partial(naemon_submit.submit_socket_or_command_file,
+                                   path=os.path.join(self.tmpdir, 'submit.sock'),
+                                   command_file=command_file)
+        departments = [{'departmentname': 'Cardiologie', 'uitloopminuten': 45,
+                        'warning': '0', 'critical': '1', 'service': 'UITLOOP-Cardiologie'}]
+        resource = check_uitloop_all.UITLOOP(45, 'planning', departments=departments,
+                                             submit=submit)
+        resource.fetcher.session = self.session
+        with os.fdopen(os.open(command_file, os.O_RDWR | os.O_NONBLOCK)) as fifo:
+            resource.probe()
+            lines = fifo.read().splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn('PROCESS_SERVICE_CHECK_RESULT;planning;UITLOOP-Cardiologie;1;', lines[0])
+
+
+LAZY_IMPORTS = '''
+import json, sys, time
+import check_uitloop_all, uitloop_fetch
+loaded = [name for name in ('lxml', 'requests', 'sqlite3') if name in sys.modules]
+with open(sys.argv[1], 'wb') as f:
+    f.write(b'<rss/>')
+with open(sys.argv[1] + '.meta', 'w') as f:
+    json.dump({'fetched': time.time()}, f)
+with uitloop_fetch.FeedFetcher('http://planning/', sys.argv[1]).open() as feed:
+    feed.read()
+if 'requests' in sys.modules:
+    loaded.append('requests when served from the copy')
+print(','.join(loaded))
+'''
+
+
+class TestLazyImports(unittest.TestCase):
+    def test_startup(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            output = subprocess.check_output(
+                [sys.executable, '-c', LAZY_IMPORTS, os.path.join(tmpdir, 'feed.xml')],
+                cwd=os.path.dirname(os.path.abspath(__file__)), universal_newlines=True)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(output.strip(), '')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+# Copyright (c) Paul Boot (paulboot(at)gmail.com)
+# See also LICENSE.txt
+
+"""Resident worker that runs the Python plugins without a new interpreter.
+
+Every Naemon check normally starts a new interpreter that imports
+nagiosplugin, lxml, requests, googleapiclient and so on again. The worker
+imports the plugins and their dependencies once and listens on a Unix
+socket; check_worker_client.py is the small command Naemon runs instead
+of the plugin, it forwards the arguments and prints the result with the
+plugin's exit code.
+
+Every run is handled in a child forked from the preloaded worker:
+
+- the plugin runs as __main__ with its own sys.argv, file descriptors 1
+  and 2 are captured, including the output of its subprocesses
+- state a run changes (module globals, logging, locale) dies with the child
+- a run that does not finish within its timeout is answered with UNKNOWN
+  and its child is killed
+
+Protocol, one JSON line each way:
+
+    {"plugin": "check_uitloop", "argv": ["-d", "Cardiologie"], "timeout": 55}
+    {"code": 0, "stdout": "UITLOOP OK - ...\\n", "stderr": ""}
+
+A plugin the worker does not serve is answered with "unknown": true.
+
+Example:
+
+    ./check_worker.py -s /usr/local/naemon/var/check_worker.sock
+    ./check_worker_client.py check_uitloop -d Cardiologie -H planning
+"""
+
+import argparse
+import importlib
+import json
+import logging
+import os
+import signal
+import socketserver
+import sys
+import tempfile
+import threading
+import traceback
+
+SOCKET = '/usr/local/naemon/var/check_worker.sock'
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Plugin name: (file, modules the plugin imports lazily on its check path)
+PLUGINS = {
+    'check_dns': ('check_dns.py', ['dns.message', 'dns.query', 'dns.resolver']),
+    'check_fpinguru': ('check_fpinguru', ['jinja2']),
+    'check_gcalendar': ('check_gcalendar.py', ['google.auth.transport.requests',
+                                               'google.oauth2.service_account',
+                                               'googleapiclient.discovery',
+                                               'googleapiclient.errors', 'replay']),
+    'check_rttloss2': ('check_rttloss2.py', ['jinja2']),
+    'check_uitloop': ('check_uitloop.py', []),
+    'check_uitloop_all': ('check_uitloop_all.py', ['lxml.etree', 'requests', 'replay',
+                                                   'uitloop_history']),
+}
+
+MAX_REQUEST = 65536
+
+_log = logging.getLogger('check_worker')
+
+
+class Plugin(object):
+    """A plugin script compiled once, with its dependencies imported."""
+
+    def __init__(self, name, filename, preload=()):
+        self.name = name
+        self.filename = filename
+        with open(filename) as f:
+            self.code = compile(f.read(), filename, 'exec')
+        # Running the top level once imports everything the plugin imports at
+        # start up, the plugins only do their work in main()
+        exec(self.code, {'__name__': '__preload__', '__file__': filename})
+        for module in preload:
+            try:
+                importlib.import_module(module)
+            except ImportError as e:
+                _log.warning('%s: cannot preload %s: %s', name, module, e)
+
+    def run(self, argv):
+        """Run the plugin as __main__ and return its exit code."""
+        sys.argv = [self.filename] + list(argv)
+        try:
+            exec(self.code, {'__name__': '__main__', '__file__': self.filename})
+        except SystemExit as e:
+            if e.code is None:
+                return 0
+            if isinstance(e.code, int):
+                return e.code
+            print(e.code, file=sys.stderr)
+            return 1
+        except Exception:
+            traceback.print_exc()
+            return 3
+        return 0
+
+
+def load_plugins(names, extra=()):
+    """Return {name: Plugin} for the given PLUGINS names and NAME=FILE pairs."""
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+    plugins = {}
+    for name in names:
+        filename, preload = PLUGINS[name]
+        plugins[name] = Plugin(name, os.path.join(HERE, filename), preload)
+    for pair in extra:
+        name, filename = pair.split('=', 1)
+        plugins[name] = Plugin(name, os.path.abspath(filename))
+    return plugins
+
+
+class _Capture(object):
+    """Redirect file descriptors 1 and 2 to temporary files."""
+
+    def __enter__(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.files = [tempfile.TemporaryFile(), tempfile.TemporaryFile()]
+        for fd, f in zip((1, 2), self.files):
+            os.dup2(f.fileno(), fd)
+        return self
+
+    def read(self):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        output = []
+        for f in self.files:
+            f.seek(0)
+            output.append(f.read().decode('utf-8', 'replace'))
+        return output
+
+    def __exit__(self, *exc):
+        for f in self.files:
+            f.close()
+
+
+class RunHandler(socketserver.StreamRequestHandler):
+    """Runs one request, in a child forked by the server."""
+
+    def handle(self):
+        self.lock = threading.Lock()
+        self.answered = False
+        try:
+            request = json.loads(self.rfile.readline(MAX_REQUEST).decode('utf-8'))
+            if request['plugin'] not in self.server.plugins:
+                # The client runs the plugin itself
+                self.answer(3, 'UNKNOWN - check_worker does not serve %s\n' % request['plugin'],
+                            '', unknown=True)
+                return
+            plugin = self.server.plugins[request['plugin']]
+            argv = [str(arg) for arg in request.get('argv', [])]
+            timeout = float(request.get('timeout', self.server.timeout_default))
+        except (ValueError, KeyError, TypeError) as e:
+            self.answer(3, 'UNKNOWN - check_worker: invalid request: %s\n' % e, '')
+            return
+
+        # Answers and ends this child when the plugin does not finish in time
+        watchdog = threading.Timer(timeout, self.expire, (plugin.name, timeout))
+        watchdog.daemon = True
+        watchdog.start()
+        # The plugin configures logging itself, as in a new interpreter
+        for handler in logging.root.handlers[:]:
+            logging.root.removeHandler(handler)
+        with _Capture() as capture:
+            code = plugin.run(argv)
+            stdout, stderr = capture.read()
+        watchdog.cancel()
+        self.answer(code, stdout, stderr)
+
+    def expire(self, name, timeout):
+        self.answer(3, 'UNKNOWN - %s timed out after %s seconds\n' % (name, timeout), '')
+        # The child leads its own process group, this ends the plugin's
+        # subprocesses together with the child itself
+        os.killpg(0, signal.SIGKILL)
+
+    def answer(self, code, stdout, stderr, unknown=False):
+        with self.lock:
+            if self.answered:
+                return
+            self.answered = True
+            response = {'code': code, 'stdout': stdout, 'stderr': stderr}
+            if unknown:
+                response['unknown'] = True
+            response = json.dumps(response)
+            try:
+                self.wfile.write(response.encode('utf-8') + b'\n')
+                self.wfile.flush()
+            except OSError as e:
+                _log.warning('Client went away: %s', e)
+
+
+class WorkerServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """Forks a child per connection from the preloaded worker."""
+
+    max_children = 64
+    block_on_close = False
+
+    def __init__(self, path, plugins, timeout=55):
+        self.plugins = plugins
+        self.timeout_default = timeout
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, RunHandler)
+        os.chmod(path, 0o660)
+
+    def process_request(self, request, client_address):
+        pid = os.fork()
+        if pid:
+            self.active_children = self.active_children or set()
+            self.active_children.add(pid)
+            self.close_request(request)
+            return
+        # Own process group, so a timeout also ends the plugin's subprocesses
+        os.setpgid(0, 0)
+        status = 1
+        try:
+            self.finish_request(request, client_address)
+            status = 0
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            try:
+                self.shutdown_request(request)
+            finally:
+                os._exit(status)
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argp.add_argument('-s', '--socket', default=SOCKET,
+                      help='Unix socket to listen on (default: %(default)s)')
+    argp.add_argument('-p', '--plugins', nargs='+', choices=sorted(PLUGINS),
+                      default=sorted(PLUGINS), metavar='NAME',
+                      help='plugins to serve (default: all of %s)' % ', '.join(sorted(PLUGINS)))
+    argp.add_argument('-P', '--plugin', action='append', default=[], metavar='NAME=FILE',
+                      help='also serve the plugin script FILE as NAME, may be repeated')
+    argp.add_argument('-t', '--timeout', type=float, default=55,
+                      help='timeout of a run when the client sends none (default: 55)')
+    argp.add_argument('-v', '--verbose', action='store_true',
+                      help='log every run')
+    args = argp.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s check_worker %(levelname)s %(message)s')
+    plugins = load_plugins(args.plugins, args.plugin)
+    _log.info('Serving %s on %s', ', '.join(sorted(plugins)), args.socket)
+    server = WorkerServer(args.socket, plugins, args.timeout)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+
+
+if __name__ == '__main__':
+    main()
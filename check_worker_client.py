@@ -0,0 +1,96 @@
+#!/usr/bin/python3 -S
+# Copyright (c) Paul Boot (paulboot(at)gmail.com)
+# See also LICENSE.txt
+
+"""Run a plugin in the resident check_worker and behave like the plugin.
+
+The plugin output is printed and the plugin exit code returned, so Naemon
+sees no difference. When the worker is not running or does not serve the
+plugin, the plugin is started directly. Only the standard library is
+imported and python runs with -S, without site-packages, to keep the start
+short.
+
+Environment: CHECK_WORKER_SOCKET and CHECK_WORKER_TIMEOUT (default: 55). The
+run timeout plus ANSWER_MARGIN must stay below Naemon's service_check_timeout
+(default: 60), so the UNKNOWN of a hanging run still reaches Naemon.
+
+define command {
+  command_name  check_uitloop
+  command_line  $USER1$/check_worker_client.py check_uitloop -d $ARG1$ -H $HOSTADDRESS$
+}
+"""
+
+import json
+import os
+import socket
+import sys
+
+SOCKET = os.environ.get('CHECK_WORKER_SOCKET', '/usr/local/naemon/var/check_worker.sock')
+TIMEOUT = float(os.environ.get('CHECK_WORKER_TIMEOUT', 55))
+# Seconds the client waits for the answer after the run timeout
+ANSWER_MARGIN = 3
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def run(plugin, argv, path=SOCKET, timeout=TIMEOUT):
+    """Run plugin with argv in the worker.
+
+    :returns: (exit code, stdout, stderr)
+    :raises OSError: the worker cannot be reached
+    :raises LookupError: the worker does not serve plugin
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(timeout + ANSWER_MARGIN)
+        client.connect(path)
+        # The worker may have started the plugin from here on, so it is not
+        # run again directly
+        response = b''
+        try:
+            client.sendall(json.dumps({'plugin': plugin, 'argv': argv,
+                                       'timeout': timeout}).encode('utf-8') + b'\n')
+            while not response.endswith(b'\n'):
+                data = client.recv(65536)
+                if not data:
+                    break
+                response += data
+        except socket.timeout:
+            return 3, 'UNKNOWN - check_worker did not answer within %s seconds\n' % timeout, ''
+        except OSError as e:
+            return 3, 'UNKNOWN - check_worker connection failed: %s\n' % e, ''
+    finally:
+        client.close()
+    try:
+        response = json.loads(response.decode('utf-8'))
+    except ValueError:
+        return 3, 'UNKNOWN - check_worker ended the run without an answer\n', ''
+    if response.get('unknown'):
+        raise LookupError(response['stdout'].strip())
+    return response['code'], response['stdout'], response['stderr']
+
+
+def run_direct(plugin, argv):
+    """Replace this process with the plugin, for when the worker is down."""
+    for filename in (os.path.join(HERE, plugin), os.path.join(HERE, plugin + '.py')):
+        if os.path.isfile(filename):
+            os.execv(sys.executable, [sys.executable, filename] + argv)
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] in ('-h', '--help'):
+        print('usage: %s PLUGIN [ARGUMENT ...]' % os.path.basename(argv[0]))
+        return 3
+    plugin, args = argv[1], argv[2:]
+    try:
+        code, stdout, stderr = run(plugin, args)
+    except (OSError, LookupError) as e:
+        run_direct(plugin, args)
+        print('UNKNOWN - check_worker cannot run %s (%s) and it is not found' % (plugin, e))
+        return 3
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    return code
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
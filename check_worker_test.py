@@ -0,0 +1,122 @@
+#!/usr/bin/python3
+
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+import check_worker_client
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+PLUGINS = {
+    'state': '''
+import json, sys
+if __name__ == '__main__':
+    json.runs = getattr(json, 'runs', 0) + 1
+    print('runs %d argv %s' % (json.runs, ' '.join(sys.argv[1:])))
+    sys.stderr.write('warning on stderr\\n')
+    sys.exit(2)
+''',
+    'child': '''
+import subprocess
+if __name__ == '__main__':
+    subprocess.run(['echo', 'output of a subprocess'])
+''',
+    'slow': '''
+import time
+if __name__ == '__main__':
+    time.sleep(30)
+''',
+}
+
+
+class TestCheckWorker(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.socket = os.path.join(cls.tmpdir, 'worker.sock')
+        command = [sys.executable, os.path.join(HERE, 'check_worker.py'),
+                   '-s', cls.socket, '-p', 'check_uitloop']
+        for name, source in PLUGINS.items():
+            filename = os.path.join(cls.tmpdir, name + '.py')
+            with open(filename, 'w') as f:
+                f.write(source)
+            command += ['-P', '%s=%s' % (name, filename)]
+        cls.worker = subprocess.Popen(command)
+        for attempt in range(100):
+            if os.path.exists(cls.socket):
+                break
+            time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.worker.terminate()
+        cls.worker.wait()
+        shutil.rmtree(cls.tmpdir)
+
+    def run_plugin(self, plugin, argv=(), timeout=10):
+        return check_worker_client.run(plugin, list(argv), self.socket, timeout)
+
+    def test_plugin(self):
+        code, stdout, stderr = self.run_plugin('check_uitloop', ['--help'])
+        self.assertEqual(code, 0)
+        self.assertTrue(stdout.startswith('usage: check_uitloop.py'))
+
+    def test_exit_code_and_isolation(self):
+        for run in range(2):
+            self.assertEqual(self.run_plugin('state', ['-x', 'y']),
+                             (2, 'runs 1 argv -x y\n', 'warning on stderr\n'))
+
+    def test_subprocess_output(self):
+        self.assertEqual(self.run_plugin('child'), (0, 'output of a subprocess\n', ''))
+
+    def test_timeout(self):
+        start = time.monotonic()
+        code, stdout, stderr = self.run_plugin('slow', timeout=0.5)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual((code, stdout), (3, 'UNKNOWN - slow timed out after 0.5 seconds\n'))
+        # The worker keeps serving
+        self.assertEqual(self.run_plugin('child')[0], 0)
+
+    def test_not_served(self):
+        self.assertRaises(LookupError, self.run_plugin, 'check_dns')
+        self.assertRaises(OSError, check_worker_client.run, 'state', [],
+                          os.path.join(self.tmpdir, 'missing.sock'))
+
+    def test_connection_reset(self):
+        path = os.path.join(self.tmpdir, 'reset.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        self.addCleanup(server.close)
+
+        def worker():
+            # Closed with the request unread, the client gets ECONNRESET
+            connection, address = server.accept()
+            time.sleep(0.2)
+            connection.close()
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        code, stdout, stderr = check_worker_client.run('state', [], path, 5)
+        thread.join(5)
+        self.assertEqual(code, 3)
+        self.assertTrue(stdout.startswith('UNKNOWN - check_worker connection failed'))
+
+    def test_client_fallback(self):
+        env = dict(os.environ, CHECK_WORKER_SOCKET=os.path.join(self.tmpdir, 'missing.sock'))
+        result = subprocess.run([sys.executable, os.path.join(HERE, 'check_worker_client.py'),
+                                 'check_uitloop', '--help'], env=env,
+                                stdout=subprocess.PIPE, universal_newlines=True)
+        self.assertEqual(result.returncode, 0)
+        self.assertTrue(result.stdout.startswith('usage: check_uitloop.py'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+
+"""In-process authoritive DNS stub servers for testing check_dns offline.
+
+A StubNetwork starts a stub resolver on 127.0.0.1 and one stub nameserver per
+entry in nameservers on 127.0.0.2, 127.0.0.3, ... all listening on the same
+UDP port. The resolver answers the NS query for the domain and the A queries
+for the nameserver names, so check_dns finds the stub nameservers as the
+authoritive nameservers of the domain.
+
+Every stub nameserver serves the records of the network, optionally
+overridden per nameserver to simulate inconsistent answers, and can inject
+latency and packet loss.
+
+Example:
+
+    records = {('www.example.nl', 'A'): ['192.0.2.1']}
+    with StubNetwork('example.nl', records,
+                     [{}, {'latency': 0.05}, {'loss': 1.0}]) as port:
+        check_dns.dnscheck('www.example.nl', dns.rdatatype.A,
+                           ['192.0.2.1'], 0.5, port=port)
+"""
+
+import random
+import socket
+import threading
+
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.resolver
+import dns.rrset
+
+TTL = 300
+
+
+class StubServer(object):
+    """Single UDP DNS server answering from a dict of records.
+
+    :param address: loopback address to listen on
+    :param port: UDP port, 0 picks a free port
+    :param records: dict mapping (name, type) to a list of rdata texts,
+        e.g. {('example.nl', 'MX'): ['10 mx1.example.nl.']}
+    :param latency: seconds to wait before sending every answer
+    :param loss: fraction of queries that is silently dropped
+    :param seed: seed for the loss random generator
+    """
+
+    def __init__(self, address, port, records, latency=0.0, loss=0.0,
+                 seed=None):
+        self.records = dict(((dns.name.from_text(name), rdtype.upper()), rdatas)
+                            for (name, rdtype), rdatas in records.items())
+        self.latency = latency
+        self.loss = loss
+        self.queries = 0
+        self.dropped = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((address, port))
+        self.address, self.port = self.sock.getsockname()
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        try:
+            # Wakes up the blocking recvfrom() in the server thread
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._thread.join(1.0)
+        self.sock.close()
+
+    def _serve(self):
+        while True:
+            try:
+                wire, peer = self.sock.recvfrom(65535)
+            except OSError:
+                return
+            if not wire:
+                return
+            with self._lock:
+                self.queries += 1
+                if self.loss and self._random.random() < self.loss:
+                    self.dropped += 1
+                    continue
+            response = self.answer(dns.message.from_wire(wire)).to_wire()
+            if self.latency:
+                timer = threading.Timer(self.latency, self._send,
+                                        (response, peer))
+                timer.daemon = True
+                timer.start()
+            else:
+                self._send(response, peer)
+
+    def _send(self, response, peer):
+        try:
+            self.sock.sendto(response, peer)
+        except OSError:
+            pass
+
+    def answer(self, query):
+        response = dns.message.make_response(query)
+        response.flags |= dns.flags.AA
+        question = query.question[0]
+        name = question.name
+        rdtype = dns.rdatatype.to_text(question.rdtype)
+        for qtype in (rdtype, 'CNAME'):
+            rdatas = self.records.get((name, qtype))
+            if rdatas:
+                response.answer.append(dns.rrset.from_text_list(
+                    name, TTL, dns.rdataclass.IN, qtype, rdatas))
+                break
+        else:
+            if not any(key[0] == name for key in self.records):
+                response.set_rcode(dns.rcode.NXDOMAIN)
+        return response
+
+
+class StubNetwork(object):
+    """Context manager running a stub resolver and stub nameservers.
+
+    :param domain: zone the stub nameservers are authoritive for
+    :param records: dict of records served by every nameserver
+    :param nameservers: list of dicts with StubServer keyword arguments
+        (latency, loss, seed) per nameserver, a 'records' key is merged
+        over the shared records
+    :returns: the UDP port all stub servers listen on
+    """
+
+    def __init__(self, domain, records, nameservers=({}, {})):
+        self.domain = domain
+        self.records = records
+        self.nameservers = list(nameservers)
+        self.resolver = None
+        self.servers = []
+        self._default_resolver = None
+
+    def __enter__(self):
+        nsnames = ['ns%d.%s' % (i + 1, self.domain)
+                   for i in range(len(self.nameservers))]
+        resolver_records = {(self.domain, 'NS'): [n + '.' for n in nsnames]}
+        for i, nsname in enumerate(nsnames):
+            resolver_records[(nsname, 'A')] = ['127.0.0.%d' % (i + 2)]
+        self.resolver = StubServer('127.0.0.1', 0, resolver_records).start()
+        port = self.resolver.port
+        for i, options in enumerate(self.nameservers):
+            options = dict(options)
+            records = dict(self.records)
+            records.update(options.pop('records', {}))
+            self.servers.append(StubServer('127.0.0.%d' % (i + 2), port,
+                                           records, **options).start())
+
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = ['127.0.0.1']
+        resolver.port = port
+        resolver.lifetime = 2.0
+        self._default_resolver = dns.resolver.default_resolver
+        dns.resolver.default_resolver = resolver
+        return port
+
+    def __exit__(self, *exc_info):
+        dns.resolver.default_resolver = self._default_resolver
+        for server in self.servers + [self.resolver]:
+            server.stop()
+        self.servers = []
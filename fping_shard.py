@@ -0,0 +1,254 @@
+#!/usr/bin/python3
+# Copyright (c) Paul Boot (paulboot(at)gmail.com)
+# See also LICENSE.txt
+
+"""Probe workers for check_fpinguru, so a target list is spread over hosts.
+
+One fping process on one host can only probe so many targets within a check
+interval. check_fpinguru --workers ADDRESS ... acts as coordinator: it
+splits the targets into one shard per worker, sends each worker its shard
+and merges the results of all workers into one status and one report.
+
+A worker is this script running on a probe host, listening on host:port or
+on a Unix socket path. It runs fping on the shard it receives and answers
+with compact result batches. Protocol, JSON lines:
+
+    {"targets": ["host1", "host2"], "count": 10, "size": 1250, "interval": 30}
+    {"results": [["host1", "10.20.11.1", [1.1, null, 1.3]], ...]}
+    ...
+    {"done": 2}
+
+A lost packet is null. A worker that fails answers {"error": "..."}.
+
+fping runs with raw socket privileges, so a worker only listens on the
+loopback address unless told otherwise, only answers coordinators given with
+--allow, and limits count, size and interval to what check_fpinguru uses.
+
+Example:
+
+    ./fping_shard.py --listen 0.0.0.0:7439 --allow 192.0.2.10
+    ./check_fpinguru -f hosts.txt --workers probe1:7439 probe2:7439
+"""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import re
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+
+FPING = '/usr/bin/fping'
+PORT = 7439
+# Results per answer line
+BATCH_SIZE = 500
+MAX_REQUEST = 16 * 1024 * 1024
+# Allowed (minimum, maximum) of the fping options a coordinator sends,
+# check_fpinguru sends 10 packets of 1250 bytes 30 ms apart
+LIMITS = {'count': (1, 10), 'size': (0, 1250), 'interval': (30, 1000)}
+LOOPBACK = ('127.0.0.1', '::1')
+
+_log = logging.getLogger('fping_shard')
+
+_RESULT = re.compile(r'([^ ]*)\s+\(([^ ]*)\)\s+: (.+$)')
+
+
+def fping_command(targets, count=10, size=1250, interval=30, fping=FPING):
+    return [fping, '-i', str(interval), '-q', '-R', '-d', '-A', '-M', '-b', str(size),
+            '-C', str(count)] + list(targets)
+
+
+def parse_fping(output):
+    """Return [(name, ip, responses)] of fping -C output, None for a lost packet."""
+    hosts = []
+    for line in output.splitlines():
+        m = _RESULT.match(line.strip())
+        if m:
+            responses = [None if result == '-' else float(result)
+                         for result in m.group(3).split(' ')]
+            hosts.append((m.group(1), m.group(2), responses))
+    return hosts
+
+
+def run_fping(targets, count=10, size=1250, interval=30, fping=FPING, timeout=120):
+    """Run fping on targets and return its parsed results.
+
+    :raises subprocess.TimeoutExpired: fping did not finish within timeout
+    """
+    cmd = fping_command(targets, count, size, interval, fping)
+    _log.debug('Starting fping with "%s" command', cmd)
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    _log.debug('Found output: "%s"', result.stderr)
+    if result.returncode != 0:
+        _log.info('Fping command returned non-zero exit status %d', result.returncode)
+    return parse_fping(result.stderr)
+
+
+def limit(name, value):
+    """Return value clamped to the LIMITS of the fping option name."""
+    low, high = LIMITS[name]
+    return min(max(int(value), low), high)
+
+
+def shard(targets, shards):
+    """Split targets round robin, so slow parts of a list are spread too."""
+    return [targets[i::shards] for i in range(shards) if targets[i::shards]]
+
+
+def _connect(address, timeout):
+    if '/' in address:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.settimeout(timeout)
+        client.connect(address)
+        return client
+    host, _, port = address.rpartition(':')
+    return socket.create_connection((host or address, int(port) if host else PORT), timeout)
+
+
+def probe_worker(address, targets, count=10, size=1250, interval=30, timeout=150):
+    """Have the worker at address probe targets and return its results.
+
+    :raises OSError: the worker cannot be reached or did not answer
+    :raises ValueError: the worker answered with an error
+    """
+    client = _connect(address, timeout)
+    try:
+        client.sendall(json.dumps({'targets': targets, 'count': count, 'size': size,
+                                   'interval': interval}).encode('utf-8') + b'\n')
+        hosts = []
+        for line in client.makefile('rb'):
+            answer = json.loads(line.decode('utf-8'))
+            if 'error' in answer:
+                raise ValueError('%s: %s' % (address, answer['error']))
+            if 'done' in answer:
+                return hosts
+            hosts.extend((name, ip, responses) for name, ip, responses in answer['results'])
+    finally:
+        client.close()
+    raise OSError('%s: connection closed before all results were sent' % address)
+
+
+def probe(targets, workers, count=10, size=1250, interval=30, timeout=150):
+    """Probe targets sharded over workers and return the merged results.
+
+    All shards are probed at the same time. One failing worker fails the
+    probe, a report without part of the targets would look healthy.
+
+    :raises OSError: a worker cannot be reached
+    :raises ValueError: a worker answered with an error
+    """
+    shards = shard(list(targets), len(workers))
+    hosts = []
+    with concurrent.futures.ThreadPoolExecutor(len(shards) or 1) as executor:
+        futures = [executor.submit(probe_worker, worker, targets, count, size, interval,
+                                   timeout)
+                   for worker, targets in zip(workers, shards)]
+        for worker, future in zip(workers, futures):
+            results = future.result()
+            _log.debug('Worker %s probed %d hosts', worker, len(results))
+            hosts.extend(results)
+    return hosts
+
+
+class ShardHandler(socketserver.StreamRequestHandler):
+    """Probe the shard of one coordinator connection."""
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline(MAX_REQUEST).decode('utf-8'))
+            targets = [str(target) for target in request['targets']]
+            count, size, interval = (limit(key, request.get(key, default)) for key, default in
+                                     (('count', 10), ('size', 1250), ('interval', 30)))
+            # Targets are fping arguments
+            if any(not target or target.startswith('-') for target in targets):
+                raise ValueError('invalid target')
+        except (ValueError, KeyError, TypeError) as e:
+            self.send({'error': 'invalid request: %s' % e})
+            return
+        _log.info('Probing %d targets for %s', len(targets), self.client_address or 'local')
+        try:
+            hosts = run_fping(targets, count, size, interval, self.server.fping,
+                              self.server.fping_timeout)
+        except (OSError, subprocess.SubprocessError) as e:
+            self.send({'error': 'fping failed: %s' % e})
+            return
+        for start in range(0, len(hosts), self.server.batch_size):
+            self.send({'results': hosts[start:start + self.server.batch_size]})
+        self.send({'done': len(hosts)})
+
+    def send(self, answer):
+        self.wfile.write(json.dumps(answer, separators=(',', ':')).encode('utf-8') + b'\n')
+
+
+class _UnixShardServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _TCPShardServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    allowed = frozenset(LOOPBACK)
+
+    def verify_request(self, request, client_address):
+        if client_address[0] in self.allowed:
+            return True
+        _log.warning('Refused coordinator %s', client_address[0])
+        return False
+
+
+def make_server(address, fping=FPING, fping_timeout=120, batch_size=BATCH_SIZE, allow=()):
+    """Return a worker server on host:port or a Unix socket path.
+
+    :param allow: addresses of the coordinators that may connect over TCP,
+        besides the loopback addresses
+    """
+    if '/' in address:
+        if os.path.exists(address):
+            os.unlink(address)
+        server = _UnixShardServer(address, ShardHandler)
+        os.chmod(address, 0o660)
+    else:
+        host, _, port = address.rpartition(':')
+        server = _TCPShardServer((host, int(port)), ShardHandler)
+        server.allowed = frozenset(LOOPBACK) | frozenset(allow)
+    server.fping = fping
+    server.fping_timeout = fping_timeout
+    server.batch_size = batch_size
+    return server
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argp.add_argument('-l', '--listen', default='127.0.0.1:%d' % PORT,
+                      help='host:port or Unix socket path to listen on (default: %(default)s)')
+    argp.add_argument('-a', '--allow', action='append', default=[], metavar='ADDRESS',
+                      help='IP address of a coordinator that may connect over TCP, '
+                           'may be repeated (default: only the loopback addresses)')
+    argp.add_argument('--fping', default=FPING,
+                      help='fping binary (default: %(default)s)')
+    argp.add_argument('-t', '--timeout', type=int, default=120,
+                      help='abort fping after TIMEOUT seconds (default: 120)')
+    argp.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE,
+                      help='results per answer line (default: %d)' % BATCH_SIZE)
+    argp.add_argument('-v', '--verbose', action='store_true',
+                      help='log every shard')
+    args = argp.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s fping_shard %(levelname)s %(message)s')
+    server = make_server(args.listen, args.fping, args.timeout, args.batch_size, args.allow)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if '/' in args.listen:
+            os.unlink(args.listen)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+import fping_shard
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Answers every target with RTT, a target named lost* without responses
+FAKE_FPING = '''#!%s
+import sys
+args = sys.argv[1:]
+count = int(args[args.index('-C') + 1])
+for number, target in enumerate(args[args.index('-C') + 2:]):
+    responses = ['-'] * count if target.startswith('lost') else ['%%.2f' %% RTT] * count
+    sys.stderr.write('%%s (10.0.0.%%d)  : %%s\\n' %% (target, number + 1, ' '.join(responses)))
+'''
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class TestFpingShard(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.workers = []
+        cls.addresses = [os.path.join(cls.tmpdir, 'worker.sock'),
+                         '127.0.0.1:%d' % free_port()]
+        # Every worker answers with its own RTT, to see which worker probed a target
+        for number, address in enumerate(cls.addresses):
+            fping = os.path.join(cls.tmpdir, 'fping%d' % number)
+            with open(fping, 'w') as f:
+                f.write((FAKE_FPING % sys.executable).replace('RTT', str(number + 1)))
+            os.chmod(fping, stat.S_IRWXU)
+            cls.workers.append(subprocess.Popen(
+                [sys.executable, os.path.join(HERE, 'fping_shard.py'), '-l', address,
+                 '--fping', fping, '-b', '2']))
+        for address in cls.addresses:
+            for attempt in range(100):
+                try:
+                    fping_shard._connect(address, 1).close()
+                    break
+                except OSError:
+                    time.sleep(0.05)
+
+    @classmethod
+    def tearDownClass(cls):
+        for worker in cls.workers:
+            worker.terminate()
+            worker.wait()
+        shutil.rmtree(cls.tmpdir)
+
+    def test_shard(self):
+        self.assertEqual(fping_shard.shard(list('abcde'), 2), [['a', 'c', 'e'], ['b', 'd']])
+        self.assertEqual(fping_shard.shard(['a'], 3), [['a']])
+
+    def test_parse_fping(self):
+        self.assertEqual(fping_shard.parse_fping(
+            'host1 (10.20.11.1)  : 1.10 - 1.30\nICMP Host Unreachable from 10.0.0.1\n'),
+            [('host1', '10.20.11.1', [1.1, None, 1.3])])
+
+    def test_probe(self):
+        targets = ['host%d' % number for number in range(7)] + ['lost1']
+        hosts = fping_shard.probe(targets, self.addresses, count=3)
+        self.assertEqual(sorted(name for name, ip, responses in hosts), sorted(targets))
+        responses = dict((name, responses) for name, ip, responses in hosts)
+        self.assertEqual(responses['host0'], [1.0, 1.0, 1.0])
+        self.assertEqual(responses['host1'], [2.0, 2.0, 2.0])
+        self.assertEqual(responses['lost1'], [None, None, None])
+
+    def test_limits(self):
+        self.assertEqual(fping_shard.limit('count', 1000000), 10)
+        self.assertEqual(fping_shard.limit('size', 65000), 1250)
+        self.assertEqual(fping_shard.limit('interval', 1), 30)
+        self.assertEqual(fping_shard.limit('count', 3), 3)
+        hosts = fping_shard.probe_worker(self.addresses[1], ['host1'], count=1000000)
+        self.assertEqual(len(hosts[0][2]), 10)
+
+    def test_allow(self):
+        server = fping_shard.make_server('127.0.0.1:0', allow=['192.0.2.10'])
+        try:
+            self.assertTrue(server.verify_request(None, ('127.0.0.1', 40000)))
+            self.assertTrue(server.verify_request(None, ('192.0.2.10', 40000)))
+            self.assertFalse(server.verify_request(None, ('192.0.2.11', 40000)))
+        finally:
+            server.server_close()
+
+    def test_errors(self):
+        self.assertRaises(ValueError, fping_shard.probe_worker, self.addresses[0], ['-x'])
+        self.assertRaises(OSError, fping_shard.probe, ['host1', 'host2'],
+                          [self.addresses[0], os.path.join(self.tmpdir, 'missing.sock')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,414 @@
+#!/usr/bin/python3
+# Copyright (c) Paul Boot (paulboot(at)gmail.com)
+# See also LICENSE.txt
+
+"""Submit passive service check results to Naemon in one buffered write.
+
+Python counterpart of submit_passive_check_result.sh for plugins that report
+many services at once. Results are written either as
+PROCESS_SERVICE_CHECK_RESULT lines to the external command file or as one
+file in the checkresults spool directory.
+
+Submitter queues results from many producer threads and writes them in
+batches from one background thread, with backpressure and retries.
+naemon_submitd.py runs a Submitter behind a Unix socket for producers in
+other processes, submit_socket() sends results to it.
+
+Example:
+
+    results = [CheckResult('host', 'UITLOOP-Cardiologie', 0, 'UITLOOP OK')]
+    submit_command_file(results)
+
+    with Submitter(functools.partial(submit_spool, spool_dir=SPOOL_DIR)) as submitter:
+        for result in results:
+            submitter.put(result)
+
+From a shell, one result or many lines on stdin without a fork per result:
+
+    ./naemon_submit.py host 'Port Scans' 2 'Port scan from 192.0.2.1'
+    producer | ./naemon_submit.py -
+"""
+
+import argparse
+import collections
+import errno
+import fcntl
+import json
+import logging
+import os
+import queue
+import random
+import re
+import select
+import socket
+import stat
+import string
+import sys
+import threading
+import time
+
+COMMAND_FILE = '/var/lib/naemon/naemon.cmd'
+SPOOL_DIR = '/var/lib/naemon/spool/checkresults'
+SUBMIT_SOCKET = '/usr/local/naemon/var/naemon_submit.sock'
+
+STATE_OK = 0
+STATE_WARNING = 1
+STATE_CRITICAL = 2
+STATE_UNKNOWN = 3
+
+
+class CheckResult(collections.namedtuple(
+        'CheckResult', ['host', 'service', 'code', 'output', 'timestamp'])):
+    """One passive service check result.
+
+    :raises ValueError: host or service contains a newline or a semicolon,
+        which would end the external command or start another one
+    """
+
+    __slots__ = ()
+
+    def __new__(cls, host, service, code, output, timestamp=None):
+        for name, value in (('host', host), ('service', service)):
+            if not isinstance(value, str) or _UNSAFE.search(value):
+                raise ValueError('Invalid %s name: %r' % (name, value))
+        return super(CheckResult, cls).__new__(cls, host, service, code, output, timestamp)
+
+
+_NAME_CHARACTERS = string.ascii_letters + string.digits
+# Characters that end a field or a line of the command file
+_UNSAFE = re.compile(r'[\n\r;]')
+
+_log = logging.getLogger('naemon_submit')
+
+
+def _escape(output):
+    """Naemon reads one line per result, escape newlines in long output."""
+    return output.strip().replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def format_command(result):
+    timestamp = int(result.timestamp or time.time())
+    return '[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s\n' % (
+        timestamp, result.host, result.service, result.code,
+        _escape(result.output))
+
+
+def submit_command_file(results, command_file=COMMAND_FILE):
+    """Append all results to the command file with as few writes as possible.
+
+    Writes to a FIFO are only atomic up to PIPE_BUF bytes, so the lines are
+    grouped in chunks of at most PIPE_BUF bytes that never split a line.
+    """
+    chunks = []
+    chunk = b''
+    for result in results:
+        line = format_command(result).encode('utf-8')
+        if chunk and len(chunk) + len(line) > select.PIPE_BUF:
+            chunks.append(chunk)
+            chunk = b''
+        chunk += line
+    if chunk:
+        chunks.append(chunk)
+    if not chunks:
+        return 0
+
+    # Opening a FIFO without a reader fails instead of hanging while Naemon
+    # is down, the writes block again so a full pipe slows the writer down.
+    # Never created here, a regular file would swallow the results and keep
+    # Naemon from creating its FIFO.
+    fd = os.open(command_file, os.O_WRONLY | os.O_APPEND | os.O_NONBLOCK)
+    try:
+        if not stat.S_ISFIFO(os.fstat(fd).st_mode):
+            raise OSError(errno.EINVAL, 'Not a FIFO', command_file)
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+        for chunk in chunks:
+            while chunk:
+                chunk = chunk[os.write(fd, chunk):]
+    finally:
+        os.close(fd)
+    return len(chunks)
+
+
+def format_checkresult(result):
+    timestamp = result.timestamp or time.time()
+    return ('### Nagios Service Check Result ###\n'
+            '# Time: %s\n'
+            'host_name=%s\n'
+            'service_description=%s\n'
+            'check_type=1\n'
+            'check_options=0\n'
+            'scheduled_check=0\n'
+            'reschedule_check=0\n'
+            'latency=0.0\n'
+            'start_time=%.6f\n'
+            'finish_time=%.6f\n'
+            'early_timeout=0\n'
+            'exited_ok=1\n'
+            'return_code=%d\n'
+            'output=%s\n'
+            '\n') % (time.ctime(timestamp), result.host, result.service,
+                     timestamp, timestamp, result.code, _escape(result.output))
+
+
+def _create_checkresult(spool_dir):
+    """Create a new checkresult file, return (fd, filename).
+
+    Naemon only reaps files named c followed by exactly 6 characters,
+    tempfile names are longer.
+    """
+    while True:
+        filename = os.path.join(spool_dir, 'c' + ''.join(
+            random.choice(_NAME_CHARACTERS) for i in range(6)))
+        try:
+            return os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o660), filename
+        except FileExistsError:
+            continue
+
+
+def submit_spool(results, spool_dir=SPOOL_DIR):
+    """Write all results to one checkresult file in the spool directory.
+
+    Naemon only reads a checkresult file once the matching .ok file exists,
+    so the .ok file is created after the results are written completely.
+    """
+    results = list(results)
+    if not results:
+        return None
+    fd, filename = _create_checkresult(spool_dir)
+    with os.fdopen(fd, 'w') as f:
+        f.write('### Active Check Result File ###\n')
+        f.write('file_time=%d\n\n' % time.time())
+        for result in results:
+            f.write(format_checkresult(result))
+    os.chmod(filename, 0o660)
+    open(filename + '.ok', 'w').close()
+    return filename
+
+
+def parse_line(line):
+    """Return the CheckResult of one producer line.
+
+    Accepted are a JSON object with the CheckResult fields, an external
+    command '[timestamp] PROCESS_SERVICE_CHECK_RESULT;host;service;code;output'
+    and the arguments of submit_passive_check_result.sh
+    'host;service;code;output'. The output may contain semicolons.
+
+    :raises ValueError: the line is not a valid result
+    """
+    line = line.strip()
+    if line.startswith('{'):
+        fields = json.loads(line)
+        for name in ('host', 'service', 'output'):
+            if not isinstance(fields.get(name), str):
+                raise ValueError('%s must be a string' % name)
+        # bool is an int subclass, but not a plugin exit code
+        if not isinstance(fields.get('code'), int) or isinstance(fields['code'], bool):
+            raise ValueError('code must be an integer')
+        timestamp = fields.get('timestamp')
+        if timestamp is not None and not isinstance(timestamp, (int, float)):
+            raise ValueError('timestamp must be a number')
+        return CheckResult(fields['host'], fields['service'], int(fields['code']),
+                           fields['output'], timestamp)
+    timestamp = None
+    if line.startswith('['):
+        stamp, line = line[1:].split('] ', 1)
+        timestamp = int(stamp)
+        command, line = line.split(';', 1)
+        if command != 'PROCESS_SERVICE_CHECK_RESULT':
+            raise ValueError('Unsupported command: %s' % command)
+    host, service, code, output = line.split(';', 3)
+    return CheckResult(host, service, int(code), output, timestamp)
+
+
+def format_json(result):
+    return json.dumps(result._asdict()) + '\n'
+
+
+def submit_socket(results, path=SUBMIT_SOCKET, timeout=30):
+    """Send results to naemon_submitd and return the number it queued.
+
+    :raises OSError: the daemon cannot be reached or closed the connection
+        without a reply
+    """
+    data = ''.join(format_json(result) for result in results).encode('utf-8')
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall(data)
+        client.shutdown(socket.SHUT_WR)
+        reply = b''
+        while True:
+            chunk = client.recv(64)
+            if not chunk:
+                break
+            reply += chunk
+    finally:
+        client.close()
+    if not reply.strip():
+        raise OSError(errno.ECONNRESET, 'naemon_submitd closed the connection without a reply',
+                      path)
+    return int(reply)
+
+
+def submit_socket_or_command_file(results, path=SUBMIT_SOCKET, command_file=COMMAND_FILE):
+    """Send results to naemon_submitd, or write them to the command file.
+
+    The command file is used when the daemon cannot be reached or fails.
+    Results the daemon skipped as invalid are logged, not written.
+    """
+    try:
+        queued = submit_socket(results, path)
+    except OSError as e:
+        _log.warning('naemon_submitd on %s failed, using %s: %s', path, command_file, e)
+        submit_command_file(results, command_file)
+        return
+    if queued < len(results):
+        _log.warning('naemon_submitd on %s queued %d of %d results', path, queued,
+                     len(results))
+
+
+_FLUSH = object()
+_STOP = object()
+
+
+class Submitter(object):
+    """Collect results from many producers and submit them in batches.
+
+    A background thread takes the queued results and calls submit with up to
+    batch_size results at a time, waiting at most flush_interval seconds for
+    a batch to fill. A failing submit is retried with a doubling delay; a
+    batch that still fails is counted in failed and dropped. While submits
+    are slow or failing the queue fills up and put() blocks, so producers
+    are slowed down instead of using unbounded memory.
+
+    :param submit: function that writes a list of CheckResults, e.g.
+        submit_command_file or a functools.partial of submit_spool
+    :param batch_size: maximum number of results per submit call
+    :param flush_interval: seconds a result waits for more results
+    :param max_queue: number of results that can wait for the thread
+    :param retries: number of retries of a failing submit
+    :param retry_delay: seconds before the first retry
+    """
+
+    def __init__(self, submit=submit_command_file, batch_size=1000, flush_interval=1.0,
+                 max_queue=100000, retries=3, retry_delay=0.5):
+        self.submit = submit
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.queue = queue.Queue(max_queue)
+        self.submitted = 0
+        self.failed = 0
+        self.batches = 0
+        self._thread = threading.Thread(target=self._run, name='naemon_submit')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, result, block=True, timeout=None):
+        """Queue one result.
+
+        :raises queue.Full: the queue stayed full, only with block=False or
+            a timeout
+        """
+        self.queue.put(result, block, timeout)
+
+    def flush(self):
+        """Submit everything queued so far and wait until it is done."""
+        self.queue.put(_FLUSH)
+        self.queue.join()
+
+    def close(self):
+        """Submit everything queued and stop the thread."""
+        self.queue.put(_STOP)
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _run(self):
+        while True:
+            batch = []
+            item = self.queue.get()
+            taken = 1
+            deadline = time.monotonic() + self.flush_interval
+            while item is not _FLUSH and item is not _STOP:
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                taken += 1
+            if batch:
+                self._submit(batch)
+            # flush() waits until every item taken is marked done
+            for done in range(taken):
+                self.queue.task_done()
+            if item is _STOP:
+                return
+
+    def _submit(self, batch):
+        delay = self.retry_delay
+        for attempt in range(self.retries + 1):
+            try:
+                self.submit(batch)
+            except (IOError, OSError) as e:
+                _log.warning('Submitting %d results failed (attempt %d): %s',
+                             len(batch), attempt + 1, e)
+                if attempt < self.retries:
+                    time.sleep(delay)
+                    delay *= 2
+                continue
+            except Exception:
+                # A result submit cannot format, retrying does not help. The
+                # thread keeps running, or put() and flush() would hang.
+                _log.exception('Dropped %d results', len(batch))
+                self.failed += len(batch)
+                return False
+            self.submitted += len(batch)
+            self.batches += 1
+            return True
+        _log.error('Dropped %d results after %d attempts', len(batch), self.retries + 1)
+        self.failed += len(batch)
+        return False
+
+
+def main():
+    argp = argparse.ArgumentParser(
+        description='Submit passive service check results, through naemon_submitd '
+                    'when it is running and else to the command file.')
+    argp.add_argument('result', nargs='*',
+                      help="HOST SERVICE CODE OUTPUT, or - to read one result per line "
+                           "from stdin, see parse_line()")
+    argp.add_argument('-s', '--socket', default=SUBMIT_SOCKET,
+                      help='naemon_submitd socket (default: %(default)s)')
+    argp.add_argument('--command-file', default=COMMAND_FILE,
+                      help='command file when the daemon is not running (default: %(default)s)')
+    args = argp.parse_args()
+
+    if args.result == ['-']:
+        results = []
+        for line in sys.stdin:
+            if line.strip():
+                try:
+                    results.append(parse_line(line))
+                except ValueError as e:
+                    print('Skipped invalid line %r: %s' % (line, e), file=sys.stderr)
+    elif len(args.result) == 4:
+        host, service, code, output = args.result
+        results = [CheckResult(host, service, int(code), output)]
+    else:
+        argp.error('expected HOST SERVICE CODE OUTPUT or -')
+
+    submit_socket_or_command_file(results, args.socket, args.command_file)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,253 @@
+#!/usr/bin/python3
+
+import functools
+import json
+import os
+import queue
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+import naemon_submit
+import naemon_submitd
+from naemon_submit import CheckResult
+
+
+class TestNaemonSubmit(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_format_command(self):
+        result = CheckResult('host', 'UITLOOP-Cardiologie', 2, 'UITLOOP CRITICAL\nlong', 1525339311)
+        self.assertEqual(naemon_submit.format_command(result),
+                         '[1525339311] PROCESS_SERVICE_CHECK_RESULT;host;UITLOOP-Cardiologie;2;'
+                         'UITLOOP CRITICAL\\nlong\n')
+
+    def test_command_file_chunks(self):
+        command_file = os.path.join(self.tmpdir, 'naemon.cmd')
+        os.mkfifo(command_file)
+        results = [CheckResult('host', 'service-%d' % i, 0, 'OK ' + 'x' * 100, 1)
+                   for i in range(100)]
+        # Opened read-write like Naemon does, the writer then finds a reader
+        with os.fdopen(os.open(command_file, os.O_RDWR | os.O_NONBLOCK)) as fifo:
+            chunks = naemon_submit.submit_command_file(results, command_file)
+            lines = fifo.read().splitlines()
+        self.assertGreater(chunks, 1)
+        self.assertEqual(len(lines), 100)
+        self.assertEqual(lines[99], '[1] PROCESS_SERVICE_CHECK_RESULT;host;service-99;0;OK ' + 'x' * 100)
+        self.assertEqual(naemon_submit.submit_command_file([], command_file), 0)
+
+    def test_command_file_missing(self):
+        command_file = os.path.join(self.tmpdir, 'naemon.cmd')
+        results = [CheckResult('host', 'service', 0, 'OK', 1)]
+        self.assertRaises(FileNotFoundError, naemon_submit.submit_command_file, results,
+                          command_file)
+        self.assertFalse(os.path.exists(command_file))
+        # No reader
+        os.mkfifo(command_file)
+        self.assertRaises(OSError, naemon_submit.submit_command_file, results, command_file)
+        os.unlink(command_file)
+        open(command_file, 'w').close()
+        self.assertRaises(OSError, naemon_submit.submit_command_file, results, command_file)
+        self.assertEqual(os.path.getsize(command_file), 0)
+
+    def test_command_injection(self):
+        for host, service in (('host\n[1] SHUTDOWN_PROGRAM', 'svc'), ('host', 'svc;0;OK\r'),
+                              ('host;x', 'svc')):
+            self.assertRaises(ValueError, CheckResult, host, service, 0, 'OK')
+            self.assertRaises(ValueError, naemon_submit.parse_line, json.dumps(
+                {'host': host, 'service': service, 'code': 0, 'output': 'OK'}))
+        self.assertRaises(ValueError, CheckResult, None, 'svc', 0, 'OK')
+
+    def test_spool(self):
+        results = [CheckResult('host', 'a', 0, 'OK', 1525339311),
+                   CheckResult('host', 'b', 1, 'WARNING', 1525339311)]
+        filename = naemon_submit.submit_spool(results, self.tmpdir)
+        self.assertRegex(os.path.basename(filename), r'^c[A-Za-z0-9]{6}$')
+        self.assertTrue(os.path.exists(filename + '.ok'))
+        with open(filename) as f:
+            content = f.read()
+        self.assertTrue(content.startswith('### Active Check Result File ###\n'))
+        self.assertEqual(content.count('### Nagios Service Check Result ###'), 2)
+        self.assertIn('service_description=b\n', content)
+        self.assertIn('return_code=1\n', content)
+        self.assertIn('output=WARNING\n', content)
+
+    def test_parse_line(self):
+        expected = CheckResult('host', 'svc', 2, 'CRITICAL | x=1;2;3', None)
+        self.assertEqual(naemon_submit.parse_line('host;svc;2;CRITICAL | x=1;2;3\n'), expected)
+        self.assertEqual(naemon_submit.parse_line(
+            '[1525339311] PROCESS_SERVICE_CHECK_RESULT;host;svc;2;CRITICAL | x=1;2;3'),
+            expected._replace(timestamp=1525339311))
+        self.assertEqual(naemon_submit.parse_line(naemon_submit.format_json(expected)), expected)
+        self.assertRaises(ValueError, naemon_submit.parse_line, 'host;svc;x;output')
+        self.assertRaises(ValueError, naemon_submit.parse_line, '[1] DISABLE_NOTIFICATIONS;x')
+        self.assertRaises(ValueError, naemon_submit.parse_line,
+                          '{"host": "h", "service": "s", "code": 0, "output": 5}')
+        for code in ('null', '[2]', '"2"', 'true'):
+            self.assertRaises(ValueError, naemon_submit.parse_line,
+                              '{"host": "h", "service": "s", "code": %s, "output": "o"}' % code)
+
+    def test_socket_without_reply(self):
+        path = os.path.join(self.tmpdir, 'submit.sock')
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        self.addCleanup(server.close)
+
+        def daemon():
+            # Reads the results and fails before replying
+            connection, address = server.accept()
+            connection.makefile('rb').read()
+            connection.close()
+        thread = threading.Thread(target=daemon)
+        thread.daemon = True
+        thread.start()
+        command_file = os.path.join(self.tmpdir, 'naemon.cmd')
+        os.mkfifo(command_file)
+        with os.fdopen(os.open(command_file, os.O_RDWR | os.O_NONBLOCK)) as fifo:
+            naemon_submit.submit_socket_or_command_file(
+                [CheckResult('host', 'service', 0, 'OK', 1)], path, command_file)
+            self.assertEqual(fifo.read(), '[1] PROCESS_SERVICE_CHECK_RESULT;host;service;0;OK\n')
+        thread.join(5)
+
+
+def result(i):
+    return CheckResult('host', 'service-%d' % i, i % 4, 'output %d' % i, 1)
+
+
+class TestSubmitter(unittest.TestCase):
+    def test_batches(self):
+        batches = []
+        with naemon_submit.Submitter(batches.append, batch_size=1000, flush_interval=5) as submitter:
+            for i in range(2500):
+                submitter.put(result(i))
+            submitter.flush()
+            self.assertEqual([len(batch) for batch in batches], [1000, 1000, 500])
+            submitter.put(result(2500))
+        self.assertEqual(len(batches), 4)
+        self.assertEqual(submitter.submitted, 2501)
+
+    def test_flush_interval(self):
+        batches = []
+        with naemon_submit.Submitter(batches.append, flush_interval=0.1) as submitter:
+            submitter.put(result(0))
+            time.sleep(0.5)
+            self.assertEqual(batches, [[result(0)]])
+
+    def test_retries(self):
+        calls = []
+
+        def submit(batch):
+            calls.append(batch)
+            if len(calls) < 3:
+                raise OSError('no reader on the FIFO')
+
+        with naemon_submit.Submitter(submit, retry_delay=0.01) as submitter:
+            submitter.put(result(0))
+        self.assertEqual((len(calls), submitter.submitted, submitter.failed), (3, 1, 0))
+
+        with naemon_submit.Submitter(submit, retries=1, retry_delay=0.01) as submitter:
+            calls[:] = []
+            submitter.put(result(0))
+        self.assertEqual((len(calls), submitter.submitted, submitter.failed), (2, 0, 1))
+
+    def test_broken_batch(self):
+        def submit(batch):
+            for result in batch:
+                naemon_submit.format_command(result)
+
+        with naemon_submit.Submitter(submit, batch_size=1, flush_interval=0.01) as submitter:
+            submitter.put(CheckResult('host', 'service', 0, 5))
+            submitter.flush()
+            submitter.put(result(0), timeout=1)
+        self.assertEqual((submitter.submitted, submitter.failed), (1, 1))
+
+    def test_backpressure(self):
+        release = threading.Event()
+        submitter = naemon_submit.Submitter(lambda batch: release.wait(), batch_size=1,
+                                            max_queue=2)
+        submitter.put(result(0))
+        time.sleep(0.1)
+        submitter.put(result(1))
+        submitter.put(result(2))
+        self.assertRaises(queue.Full, submitter.put, result(3), timeout=0.1)
+        release.set()
+        submitter.put(result(3), timeout=5)
+        submitter.close()
+        self.assertEqual(submitter.submitted, 4)
+
+
+class TestSubmitDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.command_file = os.path.join(self.tmpdir, 'naemon.cmd')
+        os.mkfifo(self.command_file)
+        self.socket = os.path.join(self.tmpdir, 'submit.sock')
+        self.submitter = naemon_submit.Submitter(
+            functools.partial(naemon_submit.submit_command_file, command_file=self.command_file),
+            flush_interval=0.05, retry_delay=0.05, retries=5)
+        self.server = naemon_submitd.SubmitServer(self.socket, self.submitter)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_producers(self):
+        # Naemon starts reading the FIFO after the first writes failed
+        time.sleep(0.1)
+        lines = []
+
+        def naemon():
+            # Opened read-write like Naemon does, so the FIFO never signals EOF
+            with os.fdopen(os.open(self.command_file, os.O_RDWR)) as fifo:
+                while len(lines) < 4001:
+                    lines.append(fifo.readline().rstrip('\n'))
+        reader = threading.Thread(target=naemon)
+        reader.daemon = True
+        reader.start()
+
+        producers = [threading.Thread(target=naemon_submit.submit_socket,
+                                      args=([result(p * 1000 + i) for i in range(1000)],
+                                            self.socket))
+                     for p in range(4)]
+        for producer in producers:
+            producer.start()
+        for producer in producers:
+            producer.join()
+        self.assertEqual(naemon_submit.submit_socket(
+            [CheckResult('host', 'last', 0, 'OK', 1)], self.socket), 1)
+        self.submitter.close()
+        reader.join(5)
+        self.assertEqual(len(lines), 4001)
+        self.assertEqual(len(set(lines)), 4001)
+        self.assertEqual(self.submitter.failed, 0)
+
+    def test_invalid_code(self):
+        command_file = os.open(self.command_file, os.O_RDWR | os.O_NONBLOCK)
+        self.addCleanup(os.close, command_file)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        with client:
+            client.connect(self.socket)
+            client.sendall(b'host;first;0;OK\n'
+                           b'{"host": "host", "service": "null", "code": null, "output": "x"}\n'
+                           b'host;last;0;OK\n')
+            client.shutdown(socket.SHUT_WR)
+            self.assertEqual(client.makefile('rb').read(), b'2\n')
+        self.submitter.close()
+        lines = os.read(command_file, 4096).decode('utf-8').splitlines()
+        self.assertEqual([line.split(';')[2] for line in lines], ['first', 'last'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/python3
+# Copyright (c) Paul Boot (paulboot(at)gmail.com)
+# See also LICENSE.txt
+
+"""Daemon that collects passive check results and submits them in batches.
+
+Producers connect to a Unix socket and write one result per line in any
+format naemon_submit.parse_line() accepts. When they close their side the
+daemon answers with the number of results it queued. All results go into
+one naemon_submit.Submitter, which writes them in batches to the command
+file or the checkresults spool directory. When Naemon cannot keep up the
+queue fills and the daemon stops reading, which blocks the producers.
+
+Example:
+
+    ./naemon_submitd.py --spool-dir /var/lib/naemon/spool/checkresults
+    ./naemon_submit.py host UITLOOP-Cardiologie 0 'UITLOOP OK'
+"""
+
+import argparse
+import functools
+import logging
+import os
+import signal
+import socketserver
+import sys
+
+import naemon_submit
+
+_log = logging.getLogger('naemon_submit')
+
+
+class ProducerHandler(socketserver.StreamRequestHandler):
+    """Queue the results of one producer connection."""
+
+    def handle(self):
+        queued = 0
+        for line in self.rfile:
+            line = line.decode('utf-8', 'replace')
+            if not line.strip():
+                continue
+            try:
+                result = naemon_submit.parse_line(line)
+            except (ValueError, KeyError, TypeError) as e:
+                _log.warning('Skipped invalid line %r: %s', line, e)
+                continue
+            self.server.submitter.put(result)
+            queued += 1
+        self.wfile.write(b'%d\n' % queued)
+
+
+class SubmitServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """One thread per producer connection, feeding one Submitter."""
+
+    daemon_threads = True
+
+    def __init__(self, path, submitter):
+        self.submitter = submitter
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, ProducerHandler)
+        os.chmod(path, 0o660)
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argp.add_argument('-s', '--socket', default=naemon_submit.SUBMIT_SOCKET,
+                      help='Unix socket for the producers (default: %(default)s)')
+    argp.add_argument('--command-file', default=naemon_submit.COMMAND_FILE,
+                      help='Naemon command file (default: %(default)s)')
+    argp.add_argument('--spool-dir',
+                      help='write checkresult files to this spool directory instead '
+                           'of the command file')
+    argp.add_argument('-b', '--batch-size', type=int, default=1000,
+                      help='maximum results per write (default: 1000)')
+    argp.add_argument('-i', '--flush-interval', type=float, default=1.0,
+                      help='seconds a result waits for a batch to fill (default: 1)')
+    argp.add_argument('-q', '--max-queue', type=int, default=100000,
+                      help='queued results before producers are blocked (default: 100000)')
+    argp.add_argument('-r', '--retries', type=int, default=3,
+                      help='retries of a failing write (default: 3)')
+    argp.add_argument('-v', '--verbose', action='store_true',
+                      help='log every batch')
+    args = argp.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s naemon_submitd %(levelname)s %(message)s')
+    if args.spool_dir:
+        submit = functools.partial(naemon_submit.submit_spool, spool_dir=args.spool_dir)
+    else:
+        submit = functools.partial(naemon_submit.submit_command_file,
+                                   command_file=args.command_file)
+    if args.verbose:
+        submit = _logged(submit)
+
+    submitter = naemon_submit.Submitter(submit, args.batch_size, args.flush_interval,
+                                        args.max_queue, args.retries)
+    server = SubmitServer(args.socket, submitter)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        os.unlink(args.socket)
+        # Queued results are still written before the daemon exits
+        submitter.close()
+        _log.info('Submitted %d results in %d batches, %d failed',
+                  submitter.submitted, submitter.batches, submitter.failed)
+
+
+def _logged(submit):
+    def logged_submit(results):
+        submit(results)
+        _log.info('Submitted a batch of %d results', len(results))
+    return logged_submit
+
+
+if __name__ == '__main__':
+    main()
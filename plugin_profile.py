@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+# Copyright (c) Paul Boot (paulboot(at)gmail.com)
+# See also LICENSE.txt
+
+"""Opt-in CPU and memory profiling of plugin runs, and a report over runs.
+
+A plugin run is profiled when --profile KINDS is given or NAEMON_PROFILE is
+set in its environment, KINDS is cpu, mem or cpu,mem:
+
+- cpu: cProfile of check.main, written as <plugin>/<time>-<pid>.prof
+- mem: tracemalloc of check.main, the top allocation sites and the peak
+  written as <plugin>/<time>-<pid>.mem.json
+
+in --profile-dir or NAEMON_PROFILE_DIR (default PROFILE_DIR). Without a
+switch nothing is imported or measured.
+
+Run this module to merge the profiles of many runs per plugin into the
+hottest functions and the largest allocation sites:
+
+    NAEMON_PROFILE=cpu,mem ./check_uitloop_all.py -H planning
+    ./plugin_profile.py --top 15 check_uitloop_all
+"""
+
+import argparse
+import glob
+import io
+import json
+import os
+import sys
+import time
+
+PROFILE_DIR = '/usr/local/naemon/var/profiles'
+KINDS = ('cpu', 'mem')
+# Allocation sites kept per run
+TOP_SITES = 100
+
+
+def _kinds(kinds):
+    if kinds is None:
+        kinds = os.environ.get('NAEMON_PROFILE', '')
+    if kinds in ('1', 'all'):
+        return set(KINDS)
+    kinds = set(kind.strip() for kind in kinds.split(',') if kind.strip())
+    unknown = kinds - set(KINDS)
+    if unknown:
+        raise ValueError('Unknown profile kind: %s' % ', '.join(sorted(unknown)))
+    return kinds
+
+
+class Profile(object):
+    """Profile the code in the with block, a no-op when no kinds are set.
+
+    :param plugin: plugin name, the profiles go to a directory of that name
+    :param kinds: 'cpu', 'mem' or 'cpu,mem', None reads NAEMON_PROFILE
+    :param directory: spool directory, None reads NAEMON_PROFILE_DIR
+    """
+
+    def __init__(self, plugin, kinds=None, directory=None, top=TOP_SITES):
+        self.plugin = plugin
+        self.kinds = _kinds(kinds)
+        self.directory = os.path.join(
+            directory or os.environ.get('NAEMON_PROFILE_DIR', PROFILE_DIR), plugin)
+        self.top = top
+        self.profiler = None
+
+    def __enter__(self):
+        if not self.kinds:
+            return self
+        self.started = time.time()
+        if 'mem' in self.kinds:
+            import tracemalloc
+            tracemalloc.start()
+        if 'cpu' in self.kinds:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if not self.kinds:
+            return False
+        # Written also when check.main ends with sys.exit()
+        if self.profiler is not None:
+            self.profiler.disable()
+        duration = time.time() - self.started
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            base = os.path.join(self.directory, '%s.%06d-%d' % (
+                time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started)),
+                self.started % 1 * 1000000, os.getpid()))
+            if self.profiler is not None:
+                self.profiler.dump_stats(base + '.prof')
+            if 'mem' in self.kinds:
+                self._write_memory(base + '.mem.json', duration)
+        except (IOError, OSError) as e:
+            sys.stderr.write('plugin_profile: cannot write profile: %s\n' % e)
+        return False
+
+    def _write_memory(self, filename, duration):
+        import tracemalloc
+        snapshot = tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>')])
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        sites = [{'site': '%s:%d' % (stat.traceback[0].filename, stat.traceback[0].lineno),
+                  'size': stat.size, 'count': stat.count}
+                 for stat in snapshot.statistics('lineno')[:self.top]]
+        with open(filename, 'w') as f:
+            json.dump({'plugin': self.plugin, 'argv': sys.argv[1:], 'started': self.started,
+                       'duration': duration, 'current': current, 'peak': peak,
+                       'sites': sites}, f)
+
+
+def add_arguments(argp):
+    """Add --profile and --profile-dir to a plugin's ArgumentParser."""
+    argp.add_argument('--profile', metavar='KINDS',
+                      help='profile this run: cpu, mem or cpu,mem (default: $NAEMON_PROFILE)')
+    argp.add_argument('--profile-dir', metavar='DIR',
+                      help='directory for the profiles (default: $NAEMON_PROFILE_DIR or %s)'
+                           % PROFILE_DIR)
+
+
+def run_check(check, plugin, args=None, **kwargs):
+    """Call check.main(**kwargs), profiled when switched on.
+
+    :param args: parsed arguments with the options of add_arguments()
+    """
+    with Profile(plugin, getattr(args, 'profile', None), getattr(args, 'profile_dir', None)):
+        check.main(**kwargs)
+
+
+def cpu_report(files, top, sort='cumulative'):
+    """Return the top functions of the merged cProfile files as text."""
+    import pstats
+    out = io.StringIO()
+    stats = pstats.Stats(files[0], stream=out)
+    for filename in files[1:]:
+        stats.add(filename)
+    # Instead of a header line for every merged run
+    stats.files = []
+    stats.strip_dirs().sort_stats(sort).print_stats(top)
+    return out.getvalue()
+
+
+def memory_report(files, top):
+    """Merge the allocation sites of the runs.
+
+    :returns: (peak sizes of the runs, [(site, mean size, mean count, runs)])
+    """
+    peaks = []
+    sites = {}
+    for filename in files:
+        with open(filename) as f:
+            run = json.load(f)
+        peaks.append(run['peak'])
+        for site in run['sites']:
+            total = sites.setdefault(site['site'], [0, 0, 0])
+            total[0] += site['size']
+            total[1] += site['count']
+            total[2] += 1
+    ranked = sorted(((site, size / len(files), count / len(files), runs)
+                     for site, (size, count, runs) in sites.items()),
+                    key=lambda item: item[1], reverse=True)
+    return peaks, ranked[:top]
+
+
+def prune(directory, days):
+    """Remove profiles older than days days, return the number removed."""
+    before = time.time() - days * 86400
+    removed = 0
+    for filename in glob.glob(os.path.join(directory, '*', '*')):
+        if os.path.getmtime(filename) < before:
+            os.unlink(filename)
+            removed += 1
+    return removed
+
+
+def main():
+    argp = argparse.ArgumentParser(description='Merge the profiles of plugin runs.')
+    argp.add_argument('plugins', nargs='*',
+                      help='plugins to report (default: all in the directory)')
+    argp.add_argument('-d', '--dir', default=os.environ.get('NAEMON_PROFILE_DIR', PROFILE_DIR),
+                      help='profile directory (default: %(default)s)')
+    argp.add_argument('-n', '--top', type=int, default=20,
+                      help='number of functions and allocation sites (default: 20)')
+    argp.add_argument('-s', '--sort', default='cumulative',
+                      choices=['cumulative', 'tottime', 'ncalls'],
+                      help='order of the functions (default: cumulative)')
+    argp.add_argument('--days', type=float,
+                      help='only runs of the last DAYS days')
+    argp.add_argument('--prune', type=float, metavar='DAYS',
+                      help='remove profiles older than DAYS days and exit')
+    args = argp.parse_args()
+
+    if args.prune is not None:
+        print('Removed %d profiles' % prune(args.dir, args.prune))
+        return 0
+
+    plugins = args.plugins or sorted(name for name in os.listdir(args.dir)
+                                     if os.path.isdir(os.path.join(args.dir, name)))
+    since = time.time() - args.days * 86400 if args.days else 0
+    for plugin in plugins:
+        files = [filename for filename in sorted(glob.glob(os.path.join(args.dir, plugin, '*')))
+                 if os.path.getmtime(filename) >= since]
+        cpu = [filename for filename in files if filename.endswith('.prof')]
+        mem = [filename for filename in files if filename.endswith('.mem.json')]
+        print('=== %s: %d cpu and %d mem profiles' % (plugin, len(cpu), len(mem)))
+        if cpu:
+            print(cpu_report(cpu, args.top, args.sort))
+        if mem:
+            peaks, sites = memory_report(mem, args.top)
+            print('Peak traced memory: mean %.1f KiB, max %.1f KiB' % (
+                sum(peaks) / len(peaks) / 1024.0, max(peaks) / 1024.0))
+            print('%10s %9s %5s  %s' % ('mean KiB', 'mean blks', 'runs', 'allocation site'))
+            for site, size, count, runs in sites:
+                print('%10.1f %9.0f %5d  %s' % (size / 1024.0, count, runs, site))
+            print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
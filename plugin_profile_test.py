@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import plugin_profile
+
+
+def work():
+    return sorted(str(i) * 10 for i in range(20000))
+
+
+class TestPluginProfile(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.environ = dict(os.environ)
+        os.environ.pop('NAEMON_PROFILE', None)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.tmpdir)
+
+    def files(self, plugin='plugin'):
+        directory = os.path.join(self.tmpdir, plugin)
+        return sorted(os.listdir(directory)) if os.path.isdir(directory) else []
+
+    def test_off(self):
+        with plugin_profile.Profile('plugin', directory=self.tmpdir):
+            work()
+        self.assertEqual(self.files(), [])
+
+    def test_profile_on_exit(self):
+        os.environ['NAEMON_PROFILE'] = 'cpu,mem'
+        for run in range(2):
+            with self.assertRaises(SystemExit):
+                with plugin_profile.Profile('plugin', directory=self.tmpdir):
+                    # Still referenced when the snapshot is taken
+                    data = work()
+                    sys.exit(2)
+        files = self.files()
+        self.assertEqual(len([name for name in files if name.endswith('.prof')]), 2)
+        self.assertEqual(len([name for name in files if name.endswith('.mem.json')]), 2)
+
+        paths = [os.path.join(self.tmpdir, 'plugin', name) for name in files]
+        text = plugin_profile.cpu_report([p for p in paths if p.endswith('.prof')], 5)
+        self.assertIn('(work)', text)
+        peaks, sites = plugin_profile.memory_report(
+            [p for p in paths if p.endswith('.mem.json')], 5)
+        self.assertGreater(max(peaks), 0)
+        self.assertTrue(any('plugin_profile_test.py' in site for site, size, count, runs in sites))
+
+    def test_kinds(self):
+        self.assertEqual(plugin_profile.Profile('plugin', 'all').kinds, {'cpu', 'mem'})
+        self.assertEqual(plugin_profile.Profile('plugin', 'mem').kinds, {'mem'})
+        self.assertRaises(ValueError, plugin_profile.Profile, 'plugin', 'cpu,disk')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+# Copyright (c) Paul Boot (paulboot(at)gmail.com)
+# See also LICENSE.txt
+
+"""Record/replay HTTP transport for offline testing and benchmarking.
+
+The API backed plugins can be pointed at a cassette, a JSON file with
+recorded HTTP responses. In record mode every request goes to the real
+service and its response is appended to the cassette; in replay mode the
+responses come from the cassette only and no network is used.
+
+Environment:
+
+    NAEMON_REPLAY          cassette file, unset disables the layer
+    NAEMON_REPLAY_MODE     replay (default) or record
+    NAEMON_REPLAY_LATENCY  seconds of latency added to every replayed response
+    NAEMON_REPLAY_IGNORE   comma separated query parameters that are ignored
+                           when matching a request (default: timeMin,timeMax)
+
+Example, record once and replay afterwards:
+
+    NAEMON_REPLAY=gcalendar.json NAEMON_REPLAY_MODE=record ./check_gcalendar.py
+    NAEMON_REPLAY=gcalendar.json ./check_gcalendar.py
+
+Requests with the same method, URL and query (minus ignored parameters)
+are replayed in recorded order, the last recorded response is repeated.
+uitloop_fetch mounts a ReplayAdapter on its requests.Session and
+check_gcalendar passes a ReplayHttp to googleapiclient.
+"""
+
+import base64
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+import requests
+import requests.adapters
+import urllib3
+
+DEFAULT_IGNORE = ('timeMin', 'timeMax')
+
+# Headers that no longer describe the recorded, decoded body
+_DROP_HEADERS = ('content-encoding', 'transfer-encoding', 'content-length')
+
+
+class ReplayError(Exception):
+    """No recorded response matches the request."""
+
+
+class Cassette(object):
+    """Recorded HTTP interactions in a JSON file.
+
+    :param filename: cassette file, created in record mode
+    :param mode: 'replay' or 'record'
+    :param latency: seconds to wait before returning a replayed response
+    :param ignore_params: query parameters ignored when matching requests
+    """
+
+    def __init__(self, filename, mode='replay', latency=0.0,
+                 ignore_params=DEFAULT_IGNORE):
+        if mode not in ('replay', 'record'):
+            raise ValueError('Invalid replay mode: %s' % mode)
+        self.filename = filename
+        self.mode = mode
+        self.latency = latency
+        self.ignore_params = set(ignore_params)
+        self.interactions = []
+        self._cursor = {}
+        self._lock = threading.Lock()
+        try:
+            with open(filename) as f:
+                self.interactions = json.load(f)['interactions']
+        except FileNotFoundError:
+            if mode == 'replay':
+                raise
+
+    @property
+    def recording(self):
+        return self.mode == 'record'
+
+    def key(self, method, url):
+        scheme, netloc, path, query, fragment = urlsplit(url)
+        query = urlencode(sorted((name, value) for name, value
+                                 in parse_qsl(query, keep_blank_values=True)
+                                 if name not in self.ignore_params))
+        return '%s %s' % (method.upper(), urlunsplit((scheme, netloc, path, query, '')))
+
+    def add(self, method, url, status, headers, body):
+        """Record one response and save the cassette."""
+        interaction = {'method': method.upper(), 'url': url, 'status': status,
+                       'headers': dict((name, value) for name, value in headers.items()
+                                       if name.lower() not in _DROP_HEADERS)}
+        try:
+            interaction['body'] = body.decode('utf-8')
+        except UnicodeDecodeError:
+            interaction['body_base64'] = base64.b64encode(body).decode('ascii')
+        with self._lock:
+            self.interactions.append(interaction)
+            self.save()
+        return interaction
+
+    def save(self):
+        directory = os.path.dirname(os.path.abspath(self.filename))
+        fd, tmpname = tempfile.mkstemp(dir=directory, prefix='.replay-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump({'interactions': self.interactions}, f, indent=1)
+        os.replace(tmpname, self.filename)
+
+    def lookup(self, method, url):
+        """Return the next recorded interaction for the request."""
+        key = self.key(method, url)
+        with self._lock:
+            matches = [interaction for interaction in self.interactions
+                       if self.key(interaction['method'], interaction['url']) == key]
+            if not matches:
+                raise ReplayError('No recorded response for %s' % key)
+            cursor = self._cursor.get(key, 0)
+            self._cursor[key] = cursor + 1
+        if self.latency:
+            time.sleep(self.latency)
+        return matches[min(cursor, len(matches) - 1)]
+
+
+def interaction_body(interaction):
+    if 'body_base64' in interaction:
+        return base64.b64decode(interaction['body_base64'])
+    return interaction.get('body', '').encode('utf-8')
+
+
+class ReplayAdapter(requests.adapters.BaseAdapter):
+    """requests transport adapter that records to or replays from a cassette.
+
+    Replayed responses have a streamable raw body, so code reading
+    response.raw works the same as against the real service.
+    """
+
+    def __init__(self, cassette):
+        super(ReplayAdapter, self).__init__()
+        self.cassette = cassette
+        self.real = requests.adapters.HTTPAdapter()
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None,
+             proxies=None):
+        if self.cassette.recording:
+            response = self.real.send(request, stream=False, timeout=timeout,
+                                      verify=verify, cert=cert, proxies=proxies)
+            interaction = self.cassette.add(request.method, request.url,
+                                            response.status_code, response.headers,
+                                            response.content)
+        else:
+            interaction = self.cassette.lookup(request.method, request.url)
+        raw = urllib3.HTTPResponse(body=io.BytesIO(interaction_body(interaction)),
+                                   headers=interaction['headers'],
+                                   status=interaction['status'],
+                                   preload_content=False)
+        return self.real.build_response(request, raw)
+
+    def close(self):
+        self.real.close()
+
+
+class ReplayHttp(object):
+    """httplib2.Http compatible object for googleapiclient.
+
+    :param cassette: Cassette to record to or replay from
+    :param http: real (authorized) Http object used in record mode
+    """
+
+    def __init__(self, cassette, http=None):
+        self.cassette = cassette
+        self.http = http
+
+    def request(self, uri, method='GET', body=None, headers=None,
+                redirections=5, connection_type=None):
+        import httplib2
+
+        if self.cassette.recording:
+            response, content = self.http.request(uri, method=method, body=body,
+                                                  headers=headers,
+                                                  redirections=redirections,
+                                                  connection_type=connection_type)
+            headers = dict((name, value) for name, value in response.items()
+                           if name != 'status')
+            interaction = self.cassette.add(method, uri, response.status,
+                                            headers, content)
+        else:
+            interaction = self.cassette.lookup(method, uri)
+        info = dict(interaction['headers'])
+        info['status'] = str(interaction['status'])
+        return httplib2.Response(info), interaction_body(interaction)
+
+
+_cassette = None
+
+
+def from_environment():
+    """Return the Cassette configured with NAEMON_REPLAY, None when unset."""
+    global _cassette
+    filename = os.environ.get('NAEMON_REPLAY')
+    if not filename:
+        return None
+    if _cassette is None or _cassette.filename != filename:
+        ignore = os.environ.get('NAEMON_REPLAY_IGNORE')
+        _cassette = Cassette(filename,
+                             os.environ.get('NAEMON_REPLAY_MODE', 'replay'),
+                             float(os.environ.get('NAEMON_REPLAY_LATENCY', 0)),
+                             ignore.split(',') if ignore is not None else DEFAULT_IGNORE)
+    return _cassette
+
+
+def install(session, cassette=None):
+    """Mount a ReplayAdapter on session for the given or configured cassette.
+
+    :returns: the cassette, None when the replay layer is not enabled
+    """
+    cassette = cassette or from_environment()
+    if cassette is not None:
+        adapter = ReplayAdapter(cassette)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+    return cassette
@@ -0,0 +1,125 @@
+#!/usr/bin/python3
+
+"""Offline benchmark of the API backed checks on replayed responses.
+
+Times the uitloop feed parser, UITLOOP.probe of check_uitloop_all and
+Calendar.probe of check_gcalendar (yesterday and a --days range) against
+cassettes with synthetic responses, see replay. No network is used.
+
+Example:
+  ./replay_bench.py --items 5000 --runs 20 --latency 0.01
+"""
+
+import argparse
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import requests
+from googleapiclient.discovery import build_from_document
+
+import check_gcalendar
+import check_uitloop_all
+import replay
+
+DEPARTMENTS = ['Cardiologie', 'Chirurgie', 'Dermatologie', 'Gynaecologie',
+               'Interne Geneeskunde', 'Kindergeneeskunde', 'Longziekten',
+               'Neurologie', 'Oogheelkunde', 'Orthopedie', 'Radiologie', 'Urologie']
+
+ITEM = ('<item><pubDate>Tue, 03 May 2018 09:%02d:00 GMT</pubDate>'
+        '<title>Uitloop %s - dr. %d: %d minuten.</title>'
+        '<logisp:department>A%05d</logisp:department>'
+        '<logisp:departmentname>%s</logisp:departmentname>'
+        '<logisp:resource>dr. %d</logisp:resource>'
+        '<logisp:uitloopminuten>%d</logisp:uitloopminuten></item>\n')
+
+
+def uitloop_feed(items):
+    body = []
+    for i in range(items):
+        name = DEPARTMENTS[i % len(DEPARTMENTS)]
+        minutes = (i * 7) % 120
+        body.append(ITEM % (i % 60, name, i, minutes, i % len(DEPARTMENTS), name, i, minutes))
+    return ('<?xml version="1.0" encoding="utf-8"?>\n'
+            '<rss version="2.0" xmlns:logisp="http://www.logisp.nl/rss"><channel>\n'
+            '<title>Uitloop</title>\n%s</channel></rss>\n' % ''.join(body)).encode('utf-8')
+
+
+def calendar_events(days):
+    items = []
+    for day in range(1, days + 1):
+        date = (datetime.utcnow() - timedelta(days=day)).strftime('%Y-%m-%d')
+        items.append({'id': 'event%d' % day, 'summary': 'Uren: NP4 P4 Km: K MKBoZ K',
+                      'start': {'dateTime': date + 'T08:00:00+01:00'},
+                      'end': {'dateTime': date + 'T08:30:00+01:00'}})
+    return {'items': items}
+
+
+def timed(runs, function):
+    start = time.perf_counter()
+    for run in range(runs):
+        function()
+    return (time.perf_counter() - start) / runs
+
+
+def report(name, seconds, extra=''):
+    print('%-32s %9.3f ms/run %s' % (name, seconds * 1000, extra))
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argp.add_argument('-n', '--items', type=int, default=1000,
+                      help='number of items in the uitloop feed (default: 1000)')
+    argp.add_argument('-r', '--runs', type=int, default=10,
+                      help='runs per benchmark (default: 10)')
+    argp.add_argument('-l', '--latency', type=float, default=0.0,
+                      help='latency in seconds per replayed response')
+    argp.add_argument('-d', '--days', type=int, default=7,
+                      help='days for the Calendar range benchmark (default: 7)')
+    args = argp.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # uitloop feed parser and UITLOOP.probe
+        feed = uitloop_feed(args.items)
+        seconds = timed(args.runs, lambda: sum(1 for item in
+                                               check_uitloop_all.parse_feed(io.BytesIO(feed))))
+        report('parse_feed', seconds, '%d items, %.0f items/s' % (args.items, args.items / seconds))
+
+        cassette = replay.Cassette(os.path.join(tmpdir, 'uitloop.json'), 'record',
+                                   latency=args.latency)
+        cassette.add('GET', 'http://planning' + check_uitloop_all.URL_uitloop, 200, {}, feed)
+        cassette.mode = 'replay'
+        session = requests.Session()
+        replay.install(session, cassette)
+        check_uitloop_all.cache_path = tmpdir + '/'
+        resource = check_uitloop_all.UITLOOP(45, 'planning', max_age=0)
+        resource.fetcher.session = session
+        report('UITLOOP.probe', timed(args.runs, resource.probe),
+               '%d bytes feed' % len(feed))
+
+        # Calendar.probe
+        cassette = replay.Cassette(os.path.join(tmpdir, 'gcalendar.json'), 'record',
+                                   latency=args.latency)
+        document = check_gcalendar.discovery_document({})[0]
+        gcalendar = build_from_document(document, http=replay.ReplayHttp(cassette))
+        for max_results, events in ((10, calendar_events(1)), (250, calendar_events(args.days))):
+            request = gcalendar.events().list(calendarId=check_gcalendar.CALENDAR_ID,
+                                              timeMin='x', timeMax='x', maxResults=max_results,
+                                              singleEvents=True, orderBy='startTime')
+            cassette.add('GET', request.uri, 200, {'content-type': 'application/json'},
+                         json.dumps(events).encode('utf-8'))
+        cassette.mode = 'replay'
+        report('Calendar.probe', timed(args.runs, check_gcalendar.Calendar(gcalendar).probe))
+        report('Calendar.probe --days %d' % args.days,
+               timed(args.runs, check_gcalendar.Calendar(gcalendar, args.days).probe))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
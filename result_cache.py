@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+# Copyright (c) Paul Boot (paulboot(at)gmail.com)
+# See also LICENSE.txt
+
+"""Share probe results between runs of a plugin for a time to live.
+
+Plugins are often scheduled more often than their source changes. With
+--result-ttl SECONDS the result of a run is kept in --result-cache-dir
+(default: $NAEMON_RESULT_CACHE_DIR or CACHE_DIR) under the plugin and its
+arguments, and runs with the same arguments within SECONDS return it
+without touching the network.
+
+Only one run fetches at a time: a run that finds no fresh result takes a
+lock on the entry, and runs started meanwhile wait for that lock and then
+return the result the first run stored. A result that raises is not
+stored.
+
+For nagiosplugin plugins cached_resource() wraps the Resource:
+
+    result_cache.add_arguments(argp)
+    args = argp.parse_args()
+    cache = result_cache.from_arguments('check_uitloop', args)
+    check = nagiosplugin.Check(result_cache.cached_resource(cache, UITLOOP(...)), ...)
+
+The cached metrics keep their name, value, uom, min, max and context, so
+the values must be JSON data.
+"""
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+CACHE_DIR = '/usr/local/naemon/var/result_cache'
+# Arguments that do not change the result
+IGNORED_ARGS = ('verbose', 'timeout', 'profile', 'profile_dir', 'result_ttl',
+                'result_cache_dir')
+
+_log = logging.getLogger('nagiosplugin')
+
+
+def args_key(args, ignore=IGNORED_ARGS):
+    """Return the parsed arguments that select the result as a key string."""
+    return json.dumps(dict((name, value) for name, value in vars(args).items()
+                           if name not in ignore), sort_keys=True, default=str)
+
+
+class ResultCache(object):
+    """A result of plugin for key, shared between runs for ttl seconds.
+
+    :param ttl: seconds a result is used, 0 disables the cache
+    :param directory: cache directory, None reads NAEMON_RESULT_CACHE_DIR
+    """
+
+    def __init__(self, plugin, key, ttl, directory=None):
+        self.ttl = ttl or 0
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        self.directory = os.path.join(
+            directory or os.environ.get('NAEMON_RESULT_CACHE_DIR', CACHE_DIR), plugin)
+        self.filename = os.path.join(self.directory, name + '.json')
+        self.hit = False
+
+    def get(self, compute, keep=None):
+        """Return the fresh stored result, or store and return compute().
+
+        :param keep: called with a computed result, store it only when true
+        :returns: with a ttl the result as JSON data, also when it was just
+            computed
+        """
+        if self.ttl <= 0:
+            return compute()
+        found, value = self._read()
+        if found:
+            return value
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        with open(self.filename + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Stored by the run that held the lock before
+            found, value = self._read()
+            if found:
+                return value
+            value = json.loads(json.dumps(compute()))
+            if keep is None or keep(value):
+                self._write(value)
+        return value
+
+    def _read(self):
+        try:
+            with open(self.filename) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return False, None
+        age = time.time() - entry['stored']
+        if not 0 <= age < self.ttl:
+            return False, None
+        _log.debug('Result cache hit in %s, %.0f seconds old', self.filename, age)
+        self.hit = True
+        return True, entry['value']
+
+    def _write(self, value):
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, prefix='.result-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'stored': time.time(), 'value': value}, f)
+            os.replace(tmpname, self.filename)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+
+
+def cached_resource(cache, resource, name=None):
+    """Return a nagiosplugin Resource that probes resource through cache.
+
+    :param resource: the Resource, or a callable that creates it, called
+        only when there is no fresh result
+    :param name: check name, default the name of resource
+    """
+    # Not imported at the top, result_cache is also used without nagiosplugin
+    import nagiosplugin
+
+    class CachedResource(nagiosplugin.Resource):
+
+        @property
+        def name(self):
+            return name or resource.name
+
+        def probe(self):
+            return [nagiosplugin.Metric(*fields) for fields in cache.get(self._probe)]
+
+        def _probe(self):
+            probed = resource() if callable(resource) else resource
+            metrics = probed.probe()
+            if isinstance(metrics, nagiosplugin.Metric):
+                metrics = [metrics]
+            return [[metric.name, metric.value, metric.uom, metric.min, metric.max,
+                     metric.context] for metric in metrics]
+
+    return CachedResource()
+
+
+def add_arguments(argp, ttl=0):
+    """Add --result-ttl and --result-cache-dir to a plugin's ArgumentParser."""
+    argp.add_argument('--result-ttl', type=float, default=ttl, metavar='SECONDS',
+                      help='reuse the result of a run with the same arguments for SECONDS, '
+                           '0 disables the result cache (default: %(default)s)')
+    argp.add_argument('--result-cache-dir', metavar='DIR',
+                      help='directory for the results (default: $NAEMON_RESULT_CACHE_DIR or %s)'
+                           % CACHE_DIR)
+
+
+def from_arguments(plugin, args):
+    """Return the ResultCache of the options of add_arguments()."""
+    return ResultCache(plugin, args_key(args), args.result_ttl, args.result_cache_dir)
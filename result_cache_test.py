@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import nagiosplugin
+
+import result_cache
+
+
+def compute_slowly(directory):
+    """Count the computations in a file, as the processes share no memory."""
+    with open(os.path.join(directory, 'computed'), 'a') as f:
+        f.write('x')
+    # All processes ask for the result meanwhile
+    time.sleep(1)
+    return {'value': 42}
+
+
+def get_in_process(directory, results):
+    cache = result_cache.ResultCache('test', 'key', 60, directory)
+    results.put(cache.get(lambda: compute_slowly(directory)))
+
+
+class Counting(nagiosplugin.Resource):
+    def __init__(self):
+        self.probes = 0
+
+    def probe(self):
+        self.probes += 1
+        return [nagiosplugin.Metric('count', self.probes, min=0),
+                nagiosplugin.Metric('detail', {'Cardiologie': {'dr. P': 25}}, context='text')]
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.computed = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def compute(self):
+        self.computed += 1
+        return (self.computed, {1: 'one'})
+
+    def test_ttl(self):
+        cache = result_cache.ResultCache('test', 'key', 0.5, self.tmpdir)
+        self.assertEqual(cache.get(self.compute), [1, {'1': 'one'}])
+        self.assertEqual(cache.get(self.compute), [1, {'1': 'one'}])
+        self.assertTrue(cache.hit)
+        # Another key
+        other = result_cache.ResultCache('test', 'other', 0.5, self.tmpdir)
+        self.assertEqual(other.get(self.compute)[0], 2)
+        time.sleep(0.6)
+        self.assertEqual(cache.get(self.compute)[0], 3)
+        # Off
+        cache = result_cache.ResultCache('test', 'key', 0, self.tmpdir)
+        self.assertEqual(cache.get(self.compute), (4, {1: 'one'}))
+
+    def test_not_kept(self):
+        cache = result_cache.ResultCache('test', 'key', 60, self.tmpdir)
+
+        def fail():
+            raise nagiosplugin.CheckError('feed down')
+        self.assertRaises(nagiosplugin.CheckError, cache.get, fail)
+        self.assertEqual(cache.get(self.compute, keep=lambda value: False)[0], 1)
+        self.assertEqual(cache.get(self.compute)[0], 2)
+        self.assertEqual(cache.get(self.compute)[0], 2)
+
+    def test_single_flight(self):
+        context = multiprocessing.get_context('fork')
+        results = context.Queue()
+        processes = [context.Process(target=get_in_process, args=(self.tmpdir, results))
+                     for process in range(4)]
+        for process in processes:
+            process.start()
+        answers = [results.get(timeout=10) for process in processes]
+        for process in processes:
+            process.join()
+        self.assertEqual(answers, [{'value': 42}] * 4)
+        with open(os.path.join(self.tmpdir, 'computed')) as f:
+            self.assertEqual(f.read(), 'x')
+
+    def test_cached_resource(self):
+        counting = Counting()
+        cache = result_cache.ResultCache('test', 'key', 60, self.tmpdir)
+        for run in range(2):
+            resource = result_cache.cached_resource(cache, counting)
+            metrics = resource.probe()
+        self.assertEqual(counting.probes, 1)
+        self.assertEqual(resource.name, 'Counting')
+        self.assertEqual(metrics, [
+            nagiosplugin.Metric('count', 1, min=0),
+            nagiosplugin.Metric('detail', {'Cardiologie': {'dr. P': 25}}, context='text')])
+
+        created = []
+        resource = result_cache.cached_resource(cache, lambda: created.append(1), 'Lazy')
+        self.assertEqual(resource.probe()[0].value, 1)
+        self.assertEqual((resource.name, created), ('Lazy', []))
+
+
+if __name__ == '__main__':
+    unittest.main()
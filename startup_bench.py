@@ -0,0 +1,183 @@
+#!/usr/bin/python3
+
+"""Cold-start benchmark of the Python plugins.
+
+Naemon starts a new interpreter for every check, so the time spent before
+a plugin prints anything adds up. Every plugin is started RUNS times per
+scenario and the median time to the first byte of output and to exit is
+reported:
+
+  help   --help, argparse only
+  usage  an unknown option, the argument error path
+  check  a real check against recorded responses, for the plugins in
+         CHECKS, see replay
+
+With --worker the plugins are run through check_worker_client.py by a
+resident check_worker listening on that socket instead. The check path
+needs NAEMON_REPLAY in the environment of the plugin and is then skipped.
+
+With --modules the heavy modules that were imported on each path are
+listed, and with --importtime the slowest imports of the help path as
+measured by python -X importtime.
+
+Example:
+  ./startup_bench.py --runs 20 --modules check_uitloop_all.py check_fpinguru
+"""
+
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+PLUGINS = ['check_dns.py', 'check_external_ip.py', 'check_fpinguru',
+           'check_gcalendar.py', 'check_rttloss2.py', 'check_uitloop.py',
+           'check_uitloop_all.py']
+
+SCENARIOS = {'help': ['--help'],
+             'usage': ['--no-such-option']}
+
+
+def gcalendar_check(tmpdir):
+    """Record an hours event of yesterday and return (args, env) of the check."""
+    from googleapiclient.discovery import build_from_document
+
+    import check_gcalendar
+    import replay
+
+    cassette = replay.Cassette(os.path.join(tmpdir, 'gcalendar.json'), 'record')
+    service = build_from_document(check_gcalendar.discovery_document({})[0],
+                                  http=replay.ReplayHttp(cassette))
+    # Only built for its URL, timeMin and timeMax are ignored when replaying
+    request = service.events().list(calendarId=check_gcalendar.CALENDAR_ID, timeMin='x',
+                                    timeMax='x', maxResults=10, singleEvents=True,
+                                    orderBy='startTime')
+    day = datetime.utcnow() - timedelta(days=1)
+    event = {'summary': 'Uren: NP8 Km: K MKBoZ K',
+             'start': {'dateTime': day.strftime('%Y-%m-%dT08:00:00+01:00')},
+             'end': {'dateTime': day.strftime('%Y-%m-%dT08:30:00+01:00')}}
+    cassette.add('GET', request.uri, 200, {'content-type': 'application/json; charset=UTF-8'},
+                 json.dumps({'items': [event]}).encode('utf-8'))
+    return (['--cache-file', os.path.join(tmpdir, 'check_gcalendar_cache.json')],
+            {'NAEMON_REPLAY': cassette.filename})
+
+
+# Plugins with a check path that runs offline, called with a temporary
+# directory for their files
+CHECKS = {'check_gcalendar.py': gcalendar_check}
+
+HEAVY = ['dns.resolver', 'google.oauth2', 'googleapiclient', 'jinja2', 'lxml',
+         'nagiosplugin', 'requests', 'sqlite3', 'urllib.request']
+
+# Runs the plugin as __main__ and reports the heavy modules it imported
+MODULES = """
+import runpy, sys
+heavy = sys.argv.pop(1).split(',')
+sys.argv.pop(0)
+try:
+    runpy.run_path(sys.argv[0], run_name='__main__')
+except BaseException:
+    pass
+sys.__stderr__.write('\\nMODULES %s\\n' % ','.join(m for m in heavy if m in sys.modules))
+"""
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def start(plugin, args, worker=None, env=None):
+    """Return (seconds to first output byte, seconds to exit) of one run.
+
+    :param env: environment variables added for the plugin
+    """
+    env = dict(os.environ, **env or {})
+    if worker:
+        command = [sys.executable, '-S', os.path.join(HERE, 'check_worker_client.py'),
+                   os.path.splitext(plugin)[0]]
+        env['CHECK_WORKER_SOCKET'] = worker
+    else:
+        command = [sys.executable, os.path.join(HERE, plugin)]
+    start = time.perf_counter()
+    process = subprocess.Popen(command + args, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                               cwd=HERE)
+    process.stdout.read(1)
+    first = time.perf_counter() - start
+    process.communicate()
+    return first, time.perf_counter() - start
+
+
+def loaded_modules(plugin, args, env=None):
+    result = subprocess.run([sys.executable, '-c', MODULES, ','.join(HEAVY),
+                             os.path.join(HERE, plugin)] + args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            cwd=HERE, env=dict(os.environ, **env or {}),
+                            universal_newlines=True)
+    for line in result.stderr.splitlines():
+        if line.startswith('MODULES '):
+            return line.split(' ', 1)[1] or '-'
+    return '?'
+
+
+def slowest_imports(plugin, args, count):
+    """Top count imports by cumulative time from python -X importtime."""
+    result = subprocess.run([sys.executable, '-X', 'importtime',
+                             os.path.join(HERE, plugin)] + args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            cwd=HERE, universal_newlines=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        # Only top level imports, nested ones are part of their cumulative time
+        if not name[1:].startswith(' '):
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:count]
+
+
+def main():
+    argp = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    argp.add_argument('plugins', nargs='*', default=PLUGINS,
+                      help='plugins to start (default: all)')
+    argp.add_argument('-r', '--runs', type=int, default=10,
+                      help='runs per plugin and scenario (default: 10)')
+    argp.add_argument('-w', '--worker', metavar='SOCKET',
+                      help='run the plugins in the check_worker on SOCKET')
+    argp.add_argument('-m', '--modules', action='store_true',
+                      help='list the heavy modules imported on each path')
+    argp.add_argument('-i', '--importtime', type=int, metavar='COUNT', default=0,
+                      help='list the COUNT slowest imports of the help path')
+    args = argp.parse_args()
+
+    tmpdir = tempfile.mkdtemp(prefix='startup_bench-')
+    try:
+        print('%-22s %-6s %10s %10s' % ('plugin', 'path', 'first ms', 'exit ms'))
+        for plugin in args.plugins:
+            scenarios = [(scenario, plugin_args, None)
+                         for scenario, plugin_args in sorted(SCENARIOS.items())]
+            if plugin in CHECKS and not args.worker:
+                scenarios.append(('check',) + CHECKS[plugin](tmpdir))
+            for scenario, plugin_args, env in scenarios:
+                runs = [start(plugin, plugin_args, args.worker, env)
+                        for run in range(args.runs)]
+                line = '%-22s %-6s %10.1f %10.1f' % (
+                    plugin, scenario,
+                    statistics.median(first for first, end in runs) * 1000,
+                    statistics.median(end for first, end in runs) * 1000)
+                if args.modules:
+                    line += '  ' + loaded_modules(plugin, plugin_args, env)
+                print(line)
+            for cumulative, name in slowest_imports(plugin, SCENARIOS['help'],
+                                                    args.importtime):
+                print('%33s %8.1f ms  %s' % ('', cumulative / 1000.0, name))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
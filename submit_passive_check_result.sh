@@ -10,6 +10,9 @@
 
 #./submit_check_result host_name 'Port Scans' 2 'Port scan from host $TARGET$ on port $PORT$ firewalled.'"
 
+# For many results use naemon_submit.py, which takes one result per line on
+# stdin and hands them to naemon_submitd to be written in batches.
+
 # Naemon Configuration:
 #   Create a service definition and associate it with a host.
 #   Set the max_check_attempts directive in the service definition to 1. This will tell Naemon to immediate force the service into a hard state when a non-OK state is reported.
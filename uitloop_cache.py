@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+# Copyright (c) Paul Boot (paulboot(at)gmail.com)
+# See also LICENSE.txt
+
+"""Shared uitloop cache written by check_uitloop_all and read by check_uitloop.
+
+File format (version 1):
+
+    {"version": 1, "timestamp": 1525339311.0, "index": {"Cardiologie": [0, 42], ...}}\\n
+    {"dr. v.d. P": {"uitloopminuten": 25}}{"...": ...}
+
+The first line is a JSON header with the format version, the time the feed
+was parsed and per department the [offset, length] of its JSON slice in the
+body after the header. A reader only parses the header and its own slice.
+
+The file is published atomically: it is written to a temporary file in the
+same directory and renamed over the previous cache, so a reader never sees a
+half-written file.
+"""
+
+import json
+import os
+import tempfile
+import time
+
+CACHE_VERSION = 1
+
+
+class UitloopCacheError(Exception):
+    """The cache file is missing, unreadable or of another version."""
+
+
+class StaleCacheError(UitloopCacheError):
+    """The cache file is older than the allowed maximum age."""
+
+
+def write_cache(filename, uitloopdict, timestamp=None):
+    """Atomically publish uitloopdict {department: {resource: {...}}}."""
+    if timestamp is None:
+        timestamp = time.time()
+    index = {}
+    body = []
+    offset = 0
+    for departmentname in sorted(uitloopdict):
+        data = json.dumps(uitloopdict[departmentname],
+                          sort_keys=True).encode('utf-8')
+        index[departmentname] = [offset, len(data)]
+        body.append(data)
+        offset += len(data)
+    header = json.dumps({'version': CACHE_VERSION,
+                         'timestamp': timestamp,
+                         'index': index}, sort_keys=True).encode('utf-8')
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmpname = tempfile.mkstemp(dir=directory, prefix='.uitloop-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header + b'\n')
+            f.writelines(body)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+def _read_header(f, filename):
+    try:
+        header = json.loads(f.readline().decode('utf-8'))
+    except ValueError:
+        raise UitloopCacheError('Invalid uitloop cache header in %s' % filename)
+    if header.get('version') != CACHE_VERSION:
+        raise UitloopCacheError('Unsupported uitloop cache version %r in %s' %
+                                (header.get('version'), filename))
+    return header
+
+
+def read_department(filename, departmentname, max_age=None):
+    """Return ({resource: {...}}, timestamp) for one department.
+
+    A department without data returns an empty dict. Raises
+    StaleCacheError when the cache is older than max_age seconds.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            header = _read_header(f, filename)
+            age = time.time() - header['timestamp']
+            if max_age is not None and age > max_age:
+                raise StaleCacheError('Uitloop cache %s is %d seconds old' %
+                                      (filename, age))
+            entry = header['index'].get(departmentname)
+            if entry is None:
+                return {}, header['timestamp']
+            offset, length = entry
+            f.seek(f.tell() + offset)
+            data = f.read(length)
+    except (IOError, OSError) as e:
+        raise UitloopCacheError('Cannot read uitloop cache: %s' % e)
+    return json.loads(data.decode('utf-8')), header['timestamp']
+
+
+def read_all(filename):
+    """Return ({department: {resource: {...}}}, timestamp) for all departments."""
+    try:
+        with open(filename, 'rb') as f:
+            header = _read_header(f, filename)
+            body = f.read()
+    except (IOError, OSError) as e:
+        raise UitloopCacheError('Cannot read uitloop cache: %s' % e)
+    uitloopdict = {}
+    for departmentname, (offset, length) in header['index'].items():
+        uitloopdict[departmentname] = json.loads(
+            body[offset:offset + length].decode('utf-8'))
+    return uitloopdict, header['timestamp']
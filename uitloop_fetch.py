@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+# Copyright (c) Paul Boot (paulboot(at)gmail.com)
+# See also LICENSE.txt
+
+"""Conditional, stale-while-revalidate fetch of the uitloop feed.
+
+Generating the uitloop feed takes about 30 seconds, so the last good copy is
+kept on disk together with its ETag and Last-Modified headers:
+
+- younger than refresh_after seconds: the copy is served, no request is made
+- younger than max_age seconds: the copy is served and a detached background
+  process revalidates it with If-None-Match/If-Modified-Since
+- older or missing: the feed is fetched synchronously with explicit connect
+  and read timeouts, the body is streamed to the caller while it is written
+  to a new copy that is published when the body is read completely
+
+All requests of a process share one requests.Session so connections are
+reused. requests is only imported when a request is made, a run that is
+served from the copy does not load it.
+
+Example:
+
+    fetcher = FeedFetcher(URL, '/usr/local/naemon/var/host_uitloop_feed.xml')
+    with fetcher.open() as feed:
+        for item in parse_feed(feed):
+            ...
+"""
+
+import errno
+import fcntl
+import json
+import logging
+import os
+import signal
+import tempfile
+import time
+
+_log = logging.getLogger('nagiosplugin')
+
+_session = None
+
+
+def shared_session():
+    """Return the requests.Session shared by all fetches of this process."""
+    global _session
+    if _session is None:
+        import requests
+        import replay
+
+        _session = requests.Session()
+        # Uses the recorded responses of NAEMON_REPLAY when set, see replay
+        replay.install(_session)
+    return _session
+
+
+class FeedFetchError(Exception):
+    """The feed could not be fetched and no usable copy is available."""
+
+
+class FeedFetcher(object):
+    """Fetch url into cachefile, see the module documentation.
+
+    :param url: URL of the feed
+    :param cachefile: file for the last good copy, the headers are kept in
+        cachefile.meta
+    :param max_age: maximum age in seconds of a copy that may be served
+    :param refresh_after: age in seconds after which a served copy is
+        revalidated in the background
+    :param connect_timeout: seconds to wait for the connection
+    :param read_timeout: seconds to wait between bytes of the response
+    :param session: requests.Session to use instead of shared_session()
+    :param proxies: proxies passed to every request
+    """
+
+    def __init__(self, url, cachefile, max_age=900, refresh_after=60,
+                 connect_timeout=5, read_timeout=45, session=None,
+                 proxies=None):
+        self.url = url
+        self.cachefile = cachefile
+        self.metafile = cachefile + '.meta'
+        self.max_age = max_age
+        self.refresh_after = refresh_after
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = session
+        self.proxies = proxies
+        self.fetched = None
+        self.from_cache = False
+
+    def _read_meta(self):
+        try:
+            with open(self.metafile) as f:
+                meta = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not os.path.exists(self.cachefile):
+            return {}
+        return meta
+
+    def _write_meta(self, meta):
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.metafile)),
+                                       prefix='.uitloop-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(meta, f)
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, self.metafile)
+
+    def _request(self, meta):
+        import requests
+
+        session = self.session if self.session is not None else shared_session()
+        headers = {}
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        _log.debug('###DEBUG fetching URL: %s headers: %r', self.url, headers)
+        try:
+            r = session.get(self.url, headers=headers, proxies=self.proxies,
+                            timeout=self.timeout, stream=True)
+        except requests.RequestException as e:
+            raise FeedFetchError('Fetching %s failed: %s' % (self.url, e))
+        _log.debug('###DEBUG URL status code: %r', r.status_code)
+        if r.status_code not in (200, 304):
+            r.close()
+            raise FeedFetchError('Fetching %s returned HTTP status %d' %
+                                 (self.url, r.status_code))
+        return r
+
+    def _response_meta(self, r):
+        return {'etag': r.headers.get('ETag'),
+                'last_modified': r.headers.get('Last-Modified'),
+                'fetched': time.time()}
+
+    def _serve_cache(self, meta):
+        self.fetched = meta['fetched']
+        self.from_cache = True
+        return open(self.cachefile, 'rb')
+
+    def open(self):
+        """Return a file-like object with the feed, use it as a context manager."""
+        meta = self._read_meta()
+        age = time.time() - meta['fetched'] if meta else None
+        if age is not None and age < self.max_age:
+            _log.debug('###DEBUG serving feed copy of %d seconds old', age)
+            if age >= self.refresh_after:
+                self.revalidate_in_background()
+            return self._serve_cache(meta)
+
+        r = self._request(meta)
+        if r.status_code == 304:
+            r.close()
+            meta['fetched'] = time.time()
+            self._write_meta(meta)
+            return self._serve_cache(meta)
+        r.raw.decode_content = True
+        newmeta = self._response_meta(r)
+        self.fetched = newmeta['fetched']
+        self.from_cache = False
+        return _TeeReader(r, self, newmeta)
+
+    def _publish(self, tmpname, meta):
+        os.chmod(tmpname, 0o644)
+        os.replace(tmpname, self.cachefile)
+        self._write_meta(meta)
+
+    def revalidate(self):
+        """Synchronously refresh the copy, skipped when a refresh is running."""
+        with open(self.cachefile + '.lock', 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    _log.debug('###DEBUG feed refresh already running')
+                    return False
+                raise
+            meta = self._read_meta()
+            r = self._request(meta)
+            if r.status_code == 304:
+                r.close()
+                meta['fetched'] = time.time()
+                self._write_meta(meta)
+                return True
+            r.raw.decode_content = True
+            with _TeeReader(r, self, self._response_meta(r)) as feed:
+                while feed.read(65536):
+                    pass
+            return True
+
+    def revalidate_in_background(self):
+        """Run revalidate() in a detached process and return immediately."""
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            return
+        # First child: fork the refresher and exit, so it is reparented
+        try:
+            if os.fork() == 0:
+                os.setsid()
+                signal.alarm(0)
+                self._detach()
+                try:
+                    self.revalidate()
+                except Exception as e:
+                    _log.warning('Background feed refresh failed: %s', e)
+                finally:
+                    os._exit(0)
+        finally:
+            os._exit(0)
+
+
+    def _detach(self):
+        """Let go of the plugin's file descriptors in the refresher.
+
+        Naemon, or check_worker, reads the plugin output until every copy of
+        the pipes is closed, the refresher would make it wait for the refresh.
+        """
+        # Pooled connections are closed before their descriptors are reused
+        for session in (self.session, _session):
+            if session is not None:
+                session.close()
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        os.closerange(3, os.sysconf('SC_OPEN_MAX'))
+
+
+class _TeeReader(object):
+    """File-like response body that is copied to a new cache file.
+
+    The copy is published when the body has been read to the end and
+    discarded otherwise, leaving the context without an exception reads the
+    rest of the body.
+    """
+
+    def __init__(self, response, fetcher, meta):
+        self.response = response
+        self.fetcher = fetcher
+        self.meta = meta
+        self.complete = False
+        fd, self.tmpname = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(fetcher.cachefile)),
+            prefix='.uitloop-')
+        self.copy = os.fdopen(fd, 'wb')
+
+    def read(self, size=-1):
+        data = self.response.raw.read(size if size and size > 0 else None)
+        if data:
+            self.copy.write(data)
+        else:
+            self.complete = True
+        return data
+
+    def close(self):
+        if self.copy.closed:
+            return
+        self.response.close()
+        self.copy.close()
+        if self.complete:
+            self.fetcher._publish(self.tmpname, self.meta)
+        else:
+            os.unlink(self.tmpname)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            # The parser may stop before it has seen the end of the body
+            while not self.complete and self.read(65536):
+                pass
+        self.close()
@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+# Copyright (c) Paul Boot (paulboot(at)gmail.com)
+# See also LICENSE.txt
+
+"""Historical store of uitloop delays with per-department percentiles.
+
+check_uitloop_all.py --history-db FILE appends every parsed feed item
+(department, resource, minutes, pubDate) to an SQLite database. An item is
+stored once per pubDate, so a feed copy served repeatedly from cache is not
+counted twice.
+
+Report for management, p50/p90/max per department over the last 30 days and
+per hour of the day:
+
+    ./uitloop_history.py /usr/local/naemon/var/host_uitloop_history.sqlite --days 30
+    ./uitloop_history.py /usr/local/naemon/var/host_uitloop_history.sqlite --by-hour -d Cardiologie
+"""
+
+import argparse
+import email.utils
+import math
+import sqlite3
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS uitloop (
+    pubdate INTEGER NOT NULL,
+    hour INTEGER NOT NULL,
+    department TEXT NOT NULL,
+    departmentname TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    uitloopminuten INTEGER NOT NULL,
+    UNIQUE (departmentname, resource, pubdate)
+);
+CREATE INDEX IF NOT EXISTS uitloop_departmentname_pubdate
+    ON uitloop (departmentname, pubdate);
+CREATE INDEX IF NOT EXISTS uitloop_pubdate ON uitloop (pubdate);
+"""
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return None
+    rank = max(int(math.ceil(p / 100.0 * len(values))), 1)
+    return values[rank - 1]
+
+
+def parse_pubdate(pubdate, default):
+    """Return the RFC 822 pubDate as epoch seconds, default when invalid."""
+    try:
+        parsed = email.utils.parsedate_tz(pubdate)
+    except (TypeError, ValueError):
+        parsed = None
+    if not parsed:
+        return int(default)
+    return int(email.utils.mktime_tz(parsed))
+
+
+class UitloopHistory(object):
+    """SQLite backed store of uitloop feed items."""
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, timeout=30)
+        self.db.executescript(SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, items, fetched=None):
+        """Store parse_feed() items, items without pubDate get fetched as time.
+
+        :returns: number of new rows
+        """
+        if fetched is None:
+            fetched = time.time()
+        rows = []
+        for item in items:
+            pubdate = parse_pubdate(item.get('pubDate'), fetched)
+            rows.append((pubdate, time.localtime(pubdate).tm_hour,
+                         item.get('department', ''), item['departmentname'],
+                         item['resource'], int(item['uitloopminuten'])))
+        with self.db:
+            before = self.db.total_changes
+            self.db.executemany(
+                'INSERT OR IGNORE INTO uitloop (pubdate, hour, department, '
+                'departmentname, resource, uitloopminuten) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            return self.db.total_changes - before
+
+    def prune(self, before):
+        """Remove all items published before the epoch time before."""
+        with self.db:
+            return self.db.execute('DELETE FROM uitloop WHERE pubdate < ?',
+                                   (int(before),)).rowcount
+
+    def percentiles(self, departmentname=None, start=None, end=None,
+                    by_hour=False):
+        """Return delay statistics per department, or per (department, hour).
+
+        :param departmentname: only this department
+        :param start: epoch time of the oldest pubDate to include
+        :param end: epoch time of the newest pubDate to include
+        :param by_hour: group per hour of the day as well
+        :returns: dict mapping departmentname or (departmentname, hour) to a
+            dict with count, p50, p90 and max in minutes
+        """
+        where = []
+        params = []
+        if departmentname is not None:
+            where.append('departmentname = ?')
+            params.append(departmentname)
+        if start is not None:
+            where.append('pubdate >= ?')
+            params.append(int(start))
+        if end is not None:
+            where.append('pubdate <= ?')
+            params.append(int(end))
+        sql = 'SELECT departmentname, hour, uitloopminuten FROM uitloop'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY departmentname, hour, uitloopminuten'
+
+        groups = {}
+        for name, hour, minutes in self.db.execute(sql, params):
+            key = (name, hour) if by_hour else name
+            groups.setdefault(key, []).append(minutes)
+        for values in groups.values():
+            values.sort()
+        return dict((key, {'count': len(values),
+                           'p50': percentile(values, 50),
+                           'p90': percentile(values, 90),
+                           'max': values[-1]})
+                    for key, values in groups.items())
+
+
+def main():
+    argp = argparse.ArgumentParser(
+        description='Uitloop p50/p90/max per afdeling uit de historie database')
+    argp.add_argument('database', help='SQLite database van check_uitloop_all --history-db')
+    argp.add_argument('-d', '--departmentname', help='alleen deze afdeling')
+    argp.add_argument('--days', type=float, default=30,
+                      help='aantal dagen terug (default: 30)')
+    argp.add_argument('--by-hour', action='store_true',
+                      help='per uur van de dag')
+    argp.add_argument('--prune', type=float, metavar='DAYS',
+                      help='verwijder items ouder dan DAYS dagen')
+    args = argp.parse_args()
+
+    with UitloopHistory(args.database) as history:
+        if args.prune is not None:
+            removed = history.prune(time.time() - args.prune * 86400)
+            print('%d items verwijderd' % removed)
+            return
+        stats = history.percentiles(args.departmentname,
+                                    time.time() - args.days * 86400,
+                                    by_hour=args.by_hour)
+    print('%-30s %4s %6s %5s %5s %5s' % ('afdeling', 'uur', 'aantal', 'p50', 'p90', 'max'))
+    for key in sorted(stats):
+        name, hour = key if args.by_hour else (key, '')
+        row = stats[key]
+        print('%-30s %4s %6d %5d %5d %5d' % (name, hour, row['count'], row['p50'],
+                                            row['p90'], row['max']))
+
+
+if __name__ == '__main__':
+    main()